@@ -1,17 +1,290 @@
-from fastapi import FastAPI, HTTPException
+import time
+# 记录模块开始导入的时间，用于启动耗时报告
+_MODULE_IMPORT_STARTED = time.perf_counter()
+# 各组依赖的导入耗时（秒）：按导入顺序计的增量，包含这一组首次加载的间接依赖
+IMPORT_TIMINGS = {}
+_import_mark = _MODULE_IMPORT_STARTED
+
+def _record_import(name):
+    """记录从上一次记录到现在的耗时"""
+    global _import_mark
+    now = time.perf_counter()
+    IMPORT_TIMINGS[name] = now - _import_mark
+    _import_mark = now
+
+from pydantic import AfterValidator, AliasChoices, BaseModel, BeforeValidator, ConfigDict, StringConstraints, ValidationError, field_validator
+from pydantic import Field as PydanticField
+_record_import("pydantic")
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+_record_import("fastapi")
 import os
+import re
+import csv
 import json
-from datetime import datetime
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import uuid
+import heapq
+import random
+import secrets
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from html import escape
+from typing import Annotated, Any, List, Literal, Optional, Union
+import sys
 import base64
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import binascii
+import math
+import hashlib
+import bisect
+import importlib
+import atexit
+import logging
+import logging.handlers
+import tempfile
+from contextlib import contextmanager
+from queue import SimpleQueue
+_record_import("stdlib")
+from sqlalchemy import Index, UniqueConstraint, insert, or_, text, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+_record_import("sqlalchemy")
+from sqlmodel import Field, Session, SQLModel, create_engine, select
+_record_import("sqlmodel")
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，只能单进程运行
+    fcntl = None
+
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# 成功路径日志的采样比例，错误日志始终输出
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "0.1"))
+LOG_BODY_MAX_CHARS = int(os.getenv("LOG_BODY_MAX_CHARS", "80"))
+
+class StructuredFormatter(logging.Formatter):
+    """输出文本或JSON日志，附带通过log_event传入的结构化字段"""
+
+    def __init__(self, fmt_type):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+        self.fmt_type = fmt_type
+
+    def format(self, record):
+        fields = getattr(record, "fields", None)
+        if self.fmt_type == "json":
+            entry = {
+                "ts": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "msg": record.getMessage()
+            }
+            if fields:
+                entry.update(fields)
+            if record.exc_info:
+                entry["exc_info"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+        line = self.formatMessage(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """原样把日志记录放入进程内队列，格式化（含异常堆栈）由后台线程完成"""
+
+    def prepare(self, record):
+        return record
+
+
+class SuccessSampler(logging.Filter):
+    """对标记为sampled的成功路径日志按LOG_SUCCESS_SAMPLE_RATE采样"""
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < LOG_SUCCESS_SAMPLE_RATE
+        return True
+
+
+def setup_logging():
+    """日志记录只写入内存队列，由后台线程输出到stdout，请求线程不做I/O"""
+    logger = logging.getLogger("reminder_bot")
+    if logger.handlers:
+        return logger
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    logger.addFilter(SuccessSampler())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+    log_queue = SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+
+logger = setup_logging()
+
+def log_event(level, message, sampled=False, exc_info=None, **fields):
+    """记录一条带结构化字段的日志；级别未启用时不构造记录"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, exc_info=exc_info, extra={"fields": fields, "sampled": sampled})
+
+def redact_email(address):
+    """隐藏邮箱用户名，只保留首字母和域名"""
+    if not address:
+        return address
+    address = str(address)
+    local, sep, domain = address.partition("@")
+    if not sep:
+        return local[:1] + "***"
+    return f"{local[:1]}***@{domain}"
+
+def truncate_text(text, limit=None):
+    """截断日志中的长文本（如邮件正文），只保留开头和总长度"""
+    limit = LOG_BODY_MAX_CHARS if limit is None else limit
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...({len(text)} chars)"
+
+class Counter:
+    """Prometheus计数器，可按一个标签区分"""
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_value, value in values:
+            labels = f'{{{self.label}="{label_value}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    """Prometheus直方图，按一个标签区分
+
+    桶边界固定，observe只做一次二分查找和几次整数加法，不分配新对象。
+    各标签值的计数数组在第一次使用时创建，之后复用。
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # [各桶计数..., +Inf计数, 总和]
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(label_value, list(series)) for label_value, series in self._series.items()]
+        for label_value, series in snapshot:
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+# 发送流水线各阶段：parse（解析payload）、render（模板渲染）、client（获取Gmail客户端）、
+# mime（构建并编码邮件）、execute（调用Gmail API）
+SEND_STAGE_SECONDS = Histogram(
+    "email_send_stage_seconds", "Time spent in each stage of the email send pipeline", "stage"
+)
+EMAIL_SEND_TOTAL = Counter("email_send_total", "Emails sent through the Gmail API", "result")
+GMAIL_HTTP_ERRORS_TOTAL = Counter("gmail_http_errors_total", "Gmail API HttpError responses", "code")
+GMAIL_TOKEN_REFRESH_TOTAL = Counter("gmail_token_refresh_total", "Gmail OAuth token refreshes", "result")
+EMAIL_DIGEST_TOTAL = Counter(
+    "email_digest_total", "Notifications buffered into digests and digest emails flushed", "event"
+)
+METRICS = [SEND_STAGE_SECONDS, EMAIL_SEND_TOTAL, GMAIL_HTTP_ERRORS_TOTAL, GMAIL_TOKEN_REFRESH_TOTAL, EMAIL_DIGEST_TOTAL]
+
+class LazyModules:
+    """按需导入的重量级依赖
+
+    Google客户端库只在第一次真正使用时导入，/health等端点和进程启动不再
+    为它付出导入耗时。每个模块首次导入的耗时记录在timings中。
+    """
+
+    def __init__(self, **modules):
+        self._modules = modules
+        self.timings = {}
+
+    def __getattr__(self, alias):
+        try:
+            name = self._modules[alias]
+        except KeyError:
+            raise AttributeError(alias) from None
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        self.timings.setdefault(name, time.perf_counter() - started)
+        # 缓存到实例属性，之后的访问不再经过__getattr__
+        setattr(self, alias, module)
+        return module
+
+
+google_libs = LazyModules(
+    transport="google.auth.transport.requests",
+    credentials="google.oauth2.credentials",
+    flow="google_auth_oauthlib.flow",
+    auth_httplib2="google_auth_httplib2",
+    discovery="googleapiclient.discovery",
+    errors="googleapiclient.errors",
+    http="googleapiclient.http",
+    httplib2="httplib2",
+    email_policy="email.policy",
+    email_utils="email.utils",
+    smtplib="smtplib",
+)
+
+# 启动阶段耗时（秒）
+STARTUP_TIMINGS = {}
+
+# 启动后是否在后台预先构建Gmail客户端
+GMAIL_WARMUP = os.getenv("GMAIL_WARMUP", "true").lower() == "true"
 
 app = FastAPI(title="LINE Reminder Bot API", version="1.0.0")
 
@@ -26,13 +299,128 @@ app.add_middleware(
 
 # Gmail API配置
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+# token距离过期不足该秒数时由后台任务提前刷新；检查间隔需明显小于该值
+GMAIL_TOKEN_REFRESH_MARGIN = int(os.getenv("GMAIL_TOKEN_REFRESH_MARGIN", "300"))
+GMAIL_TOKEN_CHECK_INTERVAL = float(os.getenv("GMAIL_TOKEN_CHECK_INTERVAL", "60"))
+# 等待其他worker释放token刷新锁的最长秒数
+GMAIL_TOKEN_LOCK_TIMEOUT = float(os.getenv("GMAIL_TOKEN_LOCK_TIMEOUT", "15"))
+# 覆盖Gmail API地址（基准测试时指向本地模拟服务），默认使用Google官方地址
+GMAIL_API_ENDPOINT = os.getenv("GMAIL_API_ENDPOINT")
 
-def generate_medication_email_html(medication_name="薬", scheduled_time="09:00", taken_time=None, status="服用済み"):
-    """生成美观的服药通知邮件HTML"""
-    if taken_time is None:
-        taken_time = datetime.now().strftime("%Y/%m/%d %H:%M")
-    
-    html_template = f"""
+# 发件账号池："名称:凭证文件:token文件"，逗号分隔；未设置时只使用
+# GMAIL_CREDENTIALS_FILE/GMAIL_TOKEN_FILE对应的一个账号
+GMAIL_ACCOUNTS = os.getenv("GMAIL_ACCOUNTS", "")
+# 每个账号每天（UTC）的发送配额
+GMAIL_ACCOUNT_DAILY_QUOTA = int(os.getenv("GMAIL_ACCOUNT_DAILY_QUOTA", "2000"))
+# 选择账号的方式：least_loaded（进行中的发送最少）或quota（剩余配额最多）
+GMAIL_ACCOUNT_ROUTING = os.getenv("GMAIL_ACCOUNT_ROUTING", "least_loaded")
+# 认证失败、达到每日配额后账号移出轮换的秒数
+GMAIL_ACCOUNT_AUTH_COOLDOWN = float(os.getenv("GMAIL_ACCOUNT_AUTH_COOLDOWN", "300"))
+GMAIL_ACCOUNT_QUOTA_COOLDOWN = float(os.getenv("GMAIL_ACCOUNT_QUOTA_COOLDOWN", "3600"))
+
+# Gmail API单次HTTP请求的超时（秒），临时错误（5xx、超时）的重试次数和总耗时预算
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "10"))
+GMAIL_RETRY_MAX = int(os.getenv("GMAIL_RETRY_MAX", "2"))
+GMAIL_RETRY_BASE = float(os.getenv("GMAIL_RETRY_BASE", "0.2"))
+GMAIL_RETRY_BUDGET = float(os.getenv("GMAIL_RETRY_BUDGET", "3"))
+
+# 发送通道熔断器：窗口（秒）内请求数不少于MIN_REQUESTS且失败率达到阈值时打开，
+# OPEN_SECONDS后半开放行少量试探请求；打开期间的请求转入发件队列（queue）或直接返回503（reject）
+CIRCUIT_BREAKER_WINDOW = int(os.getenv("CIRCUIT_BREAKER_WINDOW", "30"))
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv("CIRCUIT_BREAKER_MIN_REQUESTS", "10"))
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "0.5"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_PROBES", "1"))
+CIRCUIT_BREAKER_OPEN_ACTION = os.getenv("CIRCUIT_BREAKER_OPEN_ACTION", "queue")
+
+# 发送通道：gmail（Gmail API）、smtp、null（只丢弃，用于压测）、file（写入EMAIL_FILE_DIR）
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "gmail")
+EMAIL_FILE_DIR = os.getenv("EMAIL_FILE_DIR", "outbox")
+# SMTP通道配置；SMTP_SECURITY可选starttls、ssl或none
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "starttls")
+SMTP_FROM = os.getenv("SMTP_FROM") or SMTP_USERNAME
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+# 连接池大小默认与发送线程数相同；空闲超过SMTP_MAX_IDLE秒的连接丢弃重建
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", os.getenv("EMAIL_SEND_WORKERS", "8")))
+SMTP_MAX_IDLE = float(os.getenv("SMTP_MAX_IDLE", "240"))
+
+# 邮件发送线程池配置：超过排队上限的请求直接返回503
+EMAIL_SEND_WORKERS = int(os.getenv("EMAIL_SEND_WORKERS", "8"))
+EMAIL_SEND_MAX_PENDING = int(os.getenv("EMAIL_SEND_MAX_PENDING", str(EMAIL_SEND_WORKERS * 4)))
+
+# 数据库配置：部署环境使用SUPABASE_DB_URL（Postgres），本地默认SQLite
+DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("SUPABASE_DB_URL") or "sqlite:///pillpal.db"
+MEDICATION_PAGE_SIZE_MAX = int(os.getenv("MEDICATION_PAGE_SIZE_MAX", "200"))
+# 服药统计一次最多返回的汇总行数，服药记录一次最多查询的天数
+ADHERENCE_MAX_ROWS = int(os.getenv("ADHERENCE_MAX_ROWS", "400"))
+INTAKE_RECORDS_MAX_DAYS = int(os.getenv("INTAKE_RECORDS_MAX_DAYS", "93"))
+# 批量导入药物：每批插入的行数、响应中最多列出的错误行数、单行最大字节数
+MEDICATION_IMPORT_BATCH_SIZE = int(os.getenv("MEDICATION_IMPORT_BATCH_SIZE", "500"))
+MEDICATION_IMPORT_MAX_ERRORS = int(os.getenv("MEDICATION_IMPORT_MAX_ERRORS", "100"))
+MEDICATION_IMPORT_MAX_LINE = int(os.getenv("MEDICATION_IMPORT_MAX_LINE", "65536"))
+# 家人通知：邀请码有效期（小时），收件人缓存的有效期（秒）和最大用户数。
+# 成员变化时当前进程立即失效，多worker部署时其他进程最多延迟TTL秒
+FAMILY_INVITE_TTL_HOURS = float(os.getenv("FAMILY_INVITE_TTL_HOURS", "168"))
+FAMILY_CACHE_TTL = float(os.getenv("FAMILY_CACHE_TTL", "60"))
+FAMILY_CACHE_MAX_ENTRIES = int(os.getenv("FAMILY_CACHE_MAX_ENTRIES", "10000"))
+# 请求未指定收件人也没有user_id时使用的收件人，未设置时返回400
+DEFAULT_EMAIL_RECIPIENT = os.getenv("DEFAULT_EMAIL_RECIPIENT", "")
+
+# 事件流（SSE）：每个连接缓冲的事件数（满了丢弃最旧的）、心跳间隔（秒）、
+# 每个进程的最大连接数、断线重连时可按Last-Event-ID补发的最近事件数
+EVENT_STREAM_BUFFER = int(os.getenv("EVENT_STREAM_BUFFER", "100"))
+EVENT_STREAM_HEARTBEAT = float(os.getenv("EVENT_STREAM_HEARTBEAT", "15"))
+EVENT_STREAM_MAX_SUBSCRIBERS = int(os.getenv("EVENT_STREAM_MAX_SUBSCRIBERS", "10000"))
+EVENT_STREAM_REPLAY = int(os.getenv("EVENT_STREAM_REPLAY", "1000"))
+
+# 服药提醒调度配置；多worker部署时只应在一个进程中启用
+REMINDER_SCHEDULER_ENABLED = os.getenv("REMINDER_SCHEDULER_ENABLED", "true").lower() == "true"
+REMINDER_TIMEZONE = timezone(timedelta(hours=float(os.getenv("REMINDER_UTC_OFFSET", "9"))))
+REMINDER_SUBJECT = "お薬の時間です"
+
+# Gmail发送限流配置（每秒邮件数，0表示不限）。Gmail每个用户每秒250配额单位，
+# 每次发送消耗100单位，因此每个发件账号默认2.5封/秒；SMTP通道共用一个同样速率的令牌桶
+GMAIL_RATE_LIMIT = float(os.getenv("GMAIL_RATE_LIMIT", "2.5"))
+GMAIL_RATE_BURST = float(os.getenv("GMAIL_RATE_BURST", "10"))
+GMAIL_RECIPIENT_RATE_LIMIT = float(os.getenv("GMAIL_RECIPIENT_RATE_LIMIT", "0.2"))
+GMAIL_RECIPIENT_RATE_BURST = float(os.getenv("GMAIL_RECIPIENT_RATE_BURST", "5"))
+# 超限时最多等待的秒数，超过则转入发件队列（queue）或直接返回429（reject）
+GMAIL_RATE_MAX_DELAY = float(os.getenv("GMAIL_RATE_MAX_DELAY", "2"))
+GMAIL_RATE_OVERFLOW = os.getenv("GMAIL_RATE_OVERFLOW", "queue")
+# Gmail返回限流错误但没有Retry-After时的暂停秒数
+GMAIL_RATE_DEFAULT_PENALTY = float(os.getenv("GMAIL_RATE_DEFAULT_PENALTY", "5"))
+
+# 幂等键配置：窗口内重复的发送请求直接返回第一次的结果
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+# 就绪探测的后台刷新间隔（秒）
+READINESS_PROBE_INTERVAL = float(os.getenv("READINESS_PROBE_INTERVAL", "15"))
+
+# Gmail批量请求每块的邮件数（Gmail建议不超过50）
+EMAIL_BATCH_CHUNK_SIZE = int(os.getenv("EMAIL_BATCH_CHUNK_SIZE", "50"))
+EMAIL_BATCH_MAX_MESSAGES = int(os.getenv("EMAIL_BATCH_MAX_MESSAGES", "1000"))
+
+# 摘要模式：窗口（秒）内发给同一收件人的服药通知合并为一封邮件，0表示关闭
+EMAIL_DIGEST_WINDOW = float(os.getenv("EMAIL_DIGEST_WINDOW", "0"))
+EMAIL_DIGEST_MAX_ITEMS = int(os.getenv("EMAIL_DIGEST_MAX_ITEMS", "20"))
+
+# 持久化发件队列配置
+EMAIL_QUEUE_DB = os.getenv("EMAIL_QUEUE_DB", "email_queue.db")
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv("EMAIL_QUEUE_MAX_ATTEMPTS", "5"))
+EMAIL_QUEUE_BACKOFF_BASE = float(os.getenv("EMAIL_QUEUE_BACKOFF_BASE", "2"))
+EMAIL_QUEUE_BACKOFF_MAX = float(os.getenv("EMAIL_QUEUE_BACKOFF_MAX", "300"))
+EMAIL_QUEUE_BATCH_SIZE = int(os.getenv("EMAIL_QUEUE_BATCH_SIZE", "20"))
+EMAIL_QUEUE_POLL_INTERVAL = float(os.getenv("EMAIL_QUEUE_POLL_INTERVAL", "5"))
+# 已发送消息的保留时间（小时），过期后删除；发送成功时正文立即丢弃，只保留收件人和主题
+EMAIL_QUEUE_SENT_RETENTION_HOURS = float(os.getenv("EMAIL_QUEUE_SENT_RETENTION_HOURS", "24"))
+
+# 服药通知邮件的外框，$medication_info处放入一个或多个药物信息块
+MEDICATION_EMAIL_LAYOUT = """
     <!DOCTYPE html>
     <html lang="ja">
     <head>
@@ -40,52 +428,52 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>お薬服用のお知らせ</title>
         <style>
-            body {{
+            body {
                 font-family: 'Hiragino Sans', 'Hiragino Kaku Gothic ProN', 'Yu Gothic', 'Meiryo', sans-serif;
                 line-height: 1.6;
                 color: #333;
                 background-color: #f5f5f5;
                 margin: 0;
                 padding: 0;
-            }}
-            .container {{
+            }
+            .container {
                 max-width: 600px;
                 margin: 0 auto;
                 background-color: #ffffff;
                 box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            }}
-            .header {{
+            }
+            .header {
                 background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
                 color: white;
                 padding: 30px 20px;
                 text-align: center;
-            }}
-            .header h1 {{
+            }
+            .header h1 {
                 margin: 0;
                 font-size: 24px;
                 font-weight: 600;
-            }}
-            .header .subtitle {{
+            }
+            .header .subtitle {
                 margin-top: 8px;
                 font-size: 14px;
                 opacity: 0.9;
-            }}
-            .content {{
+            }
+            .content {
                 padding: 30px 20px;
-            }}
-            .medication-card {{
+            }
+            .medication-card {
                 background: linear-gradient(135deg, #e3f2fd 0%, #bbdefb 100%);
                 border-radius: 12px;
                 padding: 25px;
                 margin: 20px 0;
                 border-left: 4px solid #2196f3;
-            }}
-            .medication-header {{
+            }
+            .medication-header {
                 display: flex;
                 align-items: center;
                 margin-bottom: 15px;
-            }}
-            .pill-icon {{
+            }
+            .pill-icon {
                 width: 24px;
                 height: 24px;
                 background-color: #2196f3;
@@ -96,45 +484,45 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
                 margin-right: 10px;
                 color: white;
                 font-size: 12px;
-            }}
-            .medication-title {{
+            }
+            .medication-title {
                 font-size: 18px;
                 font-weight: 600;
                 color: #1976d2;
                 margin: 0;
-            }}
-            .medication-info {{
+            }
+            .medication-info {
                 background-color: white;
                 border-radius: 8px;
                 padding: 15px;
                 margin: 15px 0;
-            }}
-            .info-row {{
+            }
+            .info-row {
                 display: flex;
                 justify-content: space-between;
                 align-items: center;
                 padding: 8px 0;
                 border-bottom: 1px solid #e0e0e0;
-            }}
-            .info-row:last-child {{
+            }
+            .info-row:last-child {
                 border-bottom: none;
-            }}
-            .info-label {{
+            }
+            .info-label {
                 font-weight: 500;
                 color: #666;
-            }}
-            .info-value {{
+            }
+            .info-value {
                 font-weight: 600;
                 color: #333;
-            }}
-            .time-highlight {{
+            }
+            .time-highlight {
                 background-color: #fff3e0;
                 color: #e65100;
                 padding: 4px 8px;
                 border-radius: 4px;
                 font-weight: 600;
-            }}
-            .status-badge {{
+            }
+            .status-badge {
                 display: inline-block;
                 background-color: #4caf50;
                 color: white;
@@ -142,24 +530,24 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
                 border-radius: 20px;
                 font-size: 12px;
                 font-weight: 500;
-            }}
-            .footer {{
+            }
+            .footer {
                 background-color: #f8f9fa;
                 padding: 20px;
                 text-align: center;
                 border-top: 1px solid #e9ecef;
-            }}
-            .footer-text {{
+            }
+            .footer-text {
                 color: #6c757d;
                 font-size: 12px;
                 margin: 0;
-            }}
-            .action-buttons {{
+            }
+            .action-buttons {
                 display: flex;
                 gap: 10px;
                 margin-top: 20px;
-            }}
-            .btn {{
+            }
+            .btn {
                 display: inline-block;
                 padding: 10px 20px;
                 border-radius: 6px;
@@ -168,33 +556,33 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
                 font-size: 14px;
                 text-align: center;
                 flex: 1;
-            }}
-            .btn-primary {{
+            }
+            .btn-primary {
                 background-color: #2196f3;
                 color: white;
-            }}
-            .btn-secondary {{
+            }
+            .btn-secondary {
                 background-color: #f8f9fa;
                 color: #495057;
                 border: 1px solid #dee2e6;
-            }}
-            .health-tip {{
+            }
+            .health-tip {
                 background-color: #e8f5e8;
                 border-left: 4px solid #4caf50;
                 padding: 15px;
                 margin: 20px 0;
                 border-radius: 0 8px 8px 0;
-            }}
-            .health-tip h3 {{
+            }
+            .health-tip h3 {
                 margin: 0 0 8px 0;
                 color: #2e7d32;
                 font-size: 16px;
-            }}
-            .health-tip p {{
+            }
+            .health-tip p {
                 margin: 0;
                 color: #388e3c;
                 font-size: 14px;
-            }}
+            }
         </style>
     </head>
     <body>
@@ -211,24 +599,7 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
                         <h2 class="medication-title">次のお薬</h2>
                     </div>
                     
-                    <div class="medication-info">
-                        <div class="info-row">
-                            <span class="info-label">薬品名</span>
-                            <span class="info-value">{medication_name}</span>
-                        </div>
-                        <div class="info-row">
-                            <span class="info-label">スケジュール時間</span>
-                            <span class="info-value time-highlight">{scheduled_time}</span>
-                        </div>
-                        <div class="info-row">
-                            <span class="info-label">服用状態</span>
-                            <span class="status-badge">{status}</span>
-                        </div>
-                        <div class="info-row">
-                            <span class="info-label">服用時刻</span>
-                            <span class="info-value">{taken_time}</span>
-                        </div>
-                    </div>
+                    $medication_info
                     
                     <div class="action-buttons">
                         <a href="#" class="btn btn-primary">お薬の確認</a>
@@ -250,193 +621,3277 @@ def generate_medication_email_html(medication_name="薬", scheduled_time="09:00"
     </body>
     </html>
     """
-    return html_template
 
-def get_gmail_service():
-    """获取Gmail服务实例"""
-    creds = None
-    credentials_file = os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
-    token_file = os.getenv("GMAIL_TOKEN_FILE", "token.json")
-    
-    # 检查凭证文件是否存在
-    if not os.path.exists(credentials_file):
-        raise HTTPException(status_code=500, detail="Gmail credentials file not found")
+# 单个药物的信息块，$字段在渲染时替换为转义后的值
+MEDICATION_INFO_TEMPLATE = """<div class="medication-info">
+                        <div class="info-row">
+                            <span class="info-label">薬品名</span>
+                            <span class="info-value">$medication_name</span>
+                        </div>
+                        <div class="info-row">
+                            <span class="info-label">スケジュール時間</span>
+                            <span class="info-value time-highlight">$scheduled_time</span>
+                        </div>
+                        <div class="info-row">
+                            <span class="info-label">服用状態</span>
+                            <span class="status-badge">$status</span>
+                        </div>
+                        <div class="info-row">
+                            <span class="info-label">服用時刻</span>
+                            <span class="info-value">$taken_time</span>
+                        </div>
+                    </div>"""
+
+MEDICATION_EMAIL_TEMPLATE = MEDICATION_EMAIL_LAYOUT.replace("$medication_info", MEDICATION_INFO_TEMPLATE)
+
+MEDICATION_EMAIL_CACHE_SIZE = int(os.getenv("MEDICATION_EMAIL_CACHE_SIZE", "1024"))
+
+class CompiledEmailTemplate:
+    """预编译的邮件模板
+
+    导入时把静态文档按$字段切分为固定片段，渲染时只对动态字段做HTML转义
+    并与片段一次性拼接，不再每次重新格式化整份文档。raw中的字段是已渲染的
+    HTML片段，原样插入。
+
+    片段保存为str而不是预先编码的bytes：正文在发件队列（JSON）、摘要合并和
+    请求模型中都以str传递，渲染结果也按str缓存；输出bytes反而要在每次使用时
+    解码一次。utf-8编码只在MimeSkeleton.build中对整份正文做一次。
+    """
+
+    _FIELD = re.compile(r"\$(\w+)")
+    _NEEDS_ESCAPE = re.compile(r"[&<>\"']")
+
+    def __init__(self, source, raw=()):
+        parts = self._FIELD.split(source)
+        self.segments = tuple(parts[0::2])
+        self.fields = tuple(parts[1::2])
+        self.raw = frozenset(raw)
+
+    @classmethod
+    def escape(cls, value):
+        value = str(value)
+        # 大多数字段不含特殊字符，先用一次正则扫描跳过转义
+        return escape(value) if cls._NEEDS_ESCAPE.search(value) else value
+
+    def render(self, **values):
+        segments = self.segments
+        out = [segments[0]]
+        for i, field in enumerate(self.fields, 1):
+            out.append(values[field] if field in self.raw else self.escape(values[field]))
+            out.append(segments[i])
+        return "".join(out)
+
+medication_email_template = CompiledEmailTemplate(MEDICATION_EMAIL_TEMPLATE)
+medication_info_template = CompiledEmailTemplate(MEDICATION_INFO_TEMPLATE)
+medication_digest_template = CompiledEmailTemplate(MEDICATION_EMAIL_LAYOUT, raw=("medication_info",))
+
+@lru_cache(maxsize=MEDICATION_EMAIL_CACHE_SIZE)
+def _render_medication_email(medication_name, scheduled_time, taken_time, status):
+    return medication_email_template.render(
+        medication_name=medication_name,
+        scheduled_time=scheduled_time,
+        taken_time=taken_time,
+        status=status
+    )
+
+def generate_medication_email_html(medication_name="薬", scheduled_time="09:00", taken_time=None, status="服用済み"):
+    """生成美观的服药通知邮件HTML"""
+    started = time.perf_counter()
+    if taken_time is None:
+        taken_time = datetime.now().strftime("%Y/%m/%d %H:%M")
     
-    # 加载已保存的token
-    if os.path.exists(token_file):
+    html = _render_medication_email(str(medication_name), str(scheduled_time), str(taken_time), str(status))
+    SEND_STAGE_SECONDS.observe("render", time.perf_counter() - started)
+    return html
+
+@lru_cache(maxsize=MEDICATION_EMAIL_CACHE_SIZE)
+def _render_medication_info(medication_name, scheduled_time, taken_time, status):
+    return medication_info_template.render(
+        medication_name=medication_name,
+        scheduled_time=scheduled_time,
+        taken_time=taken_time,
+        status=status
+    )
+
+def generate_medication_digest_html(medications):
+    """把多条服药通知合并为一封邮件，每个药物一个信息块，外框与单条通知相同
+
+    medications为包含medication_name、scheduled_time、taken_time、status的dict列表。
+    """
+    started = time.perf_counter()
+    blocks = "\n                    ".join(
+        _render_medication_info(
+            str(item["medication_name"]), str(item["scheduled_time"]),
+            str(item["taken_time"]), str(item["status"])
+        )
+        for item in medications
+    )
+    html = medication_digest_template.render(medication_info=blocks)
+    SEND_STAGE_SECONDS.observe("render", time.perf_counter() - started)
+    return html
+
+def write_file_atomic(path, data):
+    """先写同目录下的临时文件再rename替换，其他进程不会读到写了一半的文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
         try:
-            with open(token_file, 'r') as f:
-                token_data = f.read().strip()
-                if token_data and token_data != '{}':
-                    creds = Credentials.from_authorized_user_file(token_file, SCOPES)
-                    print("✅ 成功加载token文件")
-                else:
-                    print("⚠️ token文件为空，需要重新认证")
-        except Exception as e:
-            print(f"❌ 加载token失败: {e}")
-    
-    # 如果没有有效的凭证，尝试刷新或重新认证
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+@contextmanager
+def token_file_lock(token_file, blocking=True):
+    """同一主机上各worker进程共享的token刷新锁（token文件旁的.lock文件）
+
+    返回是否拿到锁；blocking=False时锁被占用立即返回False，否则最多等待
+    GMAIL_TOKEN_LOCK_TIMEOUT秒。没有fcntl的平台上总是返回True。
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(token_file + ".lock", "a") as lock_file:
+        deadline = time.monotonic() + GMAIL_TOKEN_LOCK_TIMEOUT
+        while True:
             try:
-                creds.refresh(Request())
-                print("✅ 成功刷新token")
-                # 保存刷新后的token
-                with open(token_file, 'w') as token:
-                    token.write(creds.to_json())
-            except Exception as e:
-                print(f"❌ 刷新token失败: {e}")
-                creds = None
-        
-        if not creds:
-            print("❌ 需要重新进行OAuth认证")
-            raise HTTPException(
-                status_code=401, 
-                detail="Gmail authentication required. Please visit /api/gmail/auth to authenticate."
-            )
-    
-    try:
-        service = build('gmail', 'v1', credentials=creds)
-        return service
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to build Gmail service: {str(e)}")
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not blocking or time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(0.05)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
-def send_gmail_message(to_email, subject, body, is_html=False):
-    """发送Gmail邮件"""
-    try:
-        print(f"🔧 开始发送邮件到: {to_email}")
-        service = get_gmail_service()
-        print("✅ Gmail服务获取成功")
-        
-        # 创建邮件
-        message = MIMEMultipart()
-        message['to'] = to_email
-        message['subject'] = subject
-        
-        # 根据内容类型添加邮件正文
-        if is_html or '<html>' in body or '<body>' in body:
-            msg = MIMEText(body, 'html', 'utf-8')
-            print("✅ 使用HTML格式发送邮件")
-        else:
-            msg = MIMEText(body, 'plain', 'utf-8')
-            print("✅ 使用纯文本格式发送邮件")
-        
-        message.attach(msg)
-        
-        print("✅ 邮件内容创建成功")
-        
-        # 编码邮件
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-        print("✅ 邮件编码成功")
-        
-        # 发送邮件
-        print("📤 正在发送邮件...")
-        sent_message = service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
-        print(f"✅ 邮件发送成功，ID: {sent_message['id']}")
-        
-        return {
-            "status": "success",
-            "message_id": sent_message['id'],
-            "thread_id": sent_message['threadId']
-        }
-    except HttpError as error:
-        print(f"❌ Gmail API错误: {error}")
-        raise HTTPException(status_code=500, detail=f"Gmail API error: {error}")
-    except Exception as e:
-        print(f"❌ 发送邮件失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+class GmailClientHolder:
+    """进程内共享的Gmail客户端
 
-# 健康检查端点
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy", "message": "LINE Reminder Bot API is running"}
+    discovery构建只做一次。凭证临近过期时由后台任务调用refresh_ahead提前刷新，
+    多个worker进程通过token文件锁选出一个刷新并原子写回，其他进程检测到
+    token文件变化后换用新凭证，请求路径上不再等待刷新。
+    googleapiclient的httplib2连接不是线程安全的，因此每个线程使用
+    各自的AuthorizedHttp，共享同一份凭证和service。
+    凭证文件和token文件未指定时使用GMAIL_CREDENTIALS_FILE/GMAIL_TOKEN_FILE。
+    认证失败后token文件被改写（例如在另一个worker中完成了OAuth回调）时也会重新加载，
+    加载到凭证后调用on_reload，由发件账号池解除认证失败的暂停。
+    """
 
-# 根端点
-@app.get("/")
-async def root():
-    return {
-        "message": "LINE Reminder Bot API",
-        "version": "1.0.0",
-        "docs": "/docs",
-        "health": "/health"
-    }
+    def __init__(self, scopes, name="default", credentials_file=None, token_file=None):
+        self.scopes = scopes
+        self.name = name
+        self._credentials_file = credentials_file
+        self._token_file = token_file
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._service = None
+        self._creds = None
+        self._token_signature = None
+        self._generation = 0
+        # 认证失败时token文件的签名；文件再次变化前不重复加载
+        self._auth_failed = False
+        self._failed_signature = None
+        self.on_reload = None
 
-# Gmail API相关端点
-@app.get("/api/gmail/status")
-async def gmail_status():
-    """检查Gmail API状态"""
-    credentials_file = os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
-    token_file = os.getenv("GMAIL_TOKEN_FILE", "token.json")
-    
-    # 检查token是否有效
-    token_valid = False
-    if os.path.exists(token_file):
+    @property
+    def credentials_file(self):
+        return self._credentials_file or os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
+
+    @property
+    def token_file(self):
+        return self._token_file or os.getenv("GMAIL_TOKEN_FILE", "token.json")
+
+    @staticmethod
+    def _file_signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # 原子替换会换一个inode，即使mtime和大小碰巧相同也能发现
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def invalidate(self):
+        """丢弃缓存的客户端，下次使用时重新加载"""
+        with self._lock:
+            self._service = None
+            self._creds = None
+            self._token_signature = None
+            self._generation += 1
+
+    def _load_credentials(self, token_file):
+        """从token文件加载凭证，文件为空或损坏时返回None"""
+        if not os.path.exists(token_file):
+            return None
         try:
             with open(token_file, 'r') as f:
                 token_data = f.read().strip()
-                token_valid = token_data and token_data != '{}'
-        except:
-            pass
-    
-    return {
-        "credentials_file_exists": os.path.exists(credentials_file),
-        "token_file_exists": os.path.exists(token_file),
-        "token_valid": token_valid,
-        "gmail_api_ready": os.path.exists(credentials_file) and token_valid,
-        "auth_required": not token_valid
-    }
+            if not token_data or token_data == '{}':
+                log_event(logging.WARNING, "⚠️ token文件为空，需要重新认证", account=self.name)
+                return None
+            creds = google_libs.credentials.Credentials.from_authorized_user_info(json.loads(token_data), self.scopes)
+            log_event(logging.INFO, "✅ 成功加载token文件", account=self.name)
+            return creds
+        except Exception as e:
+            log_event(logging.ERROR, "❌ 加载token失败", account=self.name, error=str(e))
+            return None
 
-@app.get("/api/gmail/auth")
-async def gmail_auth():
-    """启动Gmail OAuth认证流程"""
-    try:
-        credentials_file = os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
-        token_file = os.getenv("GMAIL_TOKEN_FILE", "token.json")
-        
+    def _needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        if creds.expiry is None:
+            return False
+        # google-auth使用naive UTC时间
+        remaining = creds.expiry - datetime.utcnow()
+        return remaining < timedelta(seconds=GMAIL_TOKEN_REFRESH_MARGIN)
+
+    def _refresh(self, creds, token_file):
+        """刷新凭证并原子写回token文件，失败时返回False"""
+        if not creds.refresh_token:
+            return False
+        try:
+            creds.refresh(google_libs.transport.Request())
+            log_event(logging.INFO, "✅ 成功刷新token", account=self.name)
+            write_file_atomic(token_file, creds.to_json())
+            GMAIL_TOKEN_REFRESH_TOTAL.inc("success")
+            return True
+        except Exception as e:
+            GMAIL_TOKEN_REFRESH_TOTAL.inc("failure")
+            log_event(logging.ERROR, "❌ 刷新token失败", account=self.name, error=str(e))
+            return False
+
+    def _refresh_coordinated(self, token_file, blocking):
+        """持有token文件锁时刷新，返回最新的凭证；没拿到锁或文件不可用时返回None
+
+        拿到锁后先重新读取token文件，其他进程可能刚刚刷新过，此时直接使用。
+        刷新的是新加载的凭证对象，不影响正在使用旧凭证的请求。
+        """
+        with token_file_lock(token_file, blocking) as locked:
+            if not locked:
+                return None
+            creds = self._load_credentials(token_file)
+            if creds is None or not self._needs_refresh(creds):
+                return creds
+            self._refresh(creds, token_file)
+            return creds
+
+    def _adopt(self, creds, token_file):
+        """换用新凭证，保留已构建的service；各线程的AuthorizedHttp随generation重建"""
+        self._creds = creds
+        self._token_signature = self._file_signature(token_file)
+        self._auth_failed = False
+        self._generation += 1
+
+    def _reload_if_changed(self, token_file):
+        """token文件被其他进程或重新认证改写时加载新凭证，调用方持有self._lock"""
+        signature = self._file_signature(token_file)
+        if self._creds is None:
+            # 尚未加载过凭证时由get_service按需加载；认证失败后只在文件变化时重新加载
+            if not self._auth_failed or signature == self._failed_signature:
+                return
+        elif signature == self._token_signature:
+            return
+        log_event(logging.INFO, "🔄 token文件已变化，重新加载凭证", account=self.name)
+        creds = self._load_credentials(token_file)
+        if creds is None:
+            self.invalidate()
+            self._auth_failed = True
+            self._failed_signature = signature
+            return
+        self._adopt(creds, token_file)
+        if self.on_reload is not None:
+            self.on_reload()
+
+    def refresh_ahead(self):
+        """后台任务调用：加载其他进程写入的新token，临近过期时抢锁提前刷新
+
+        没拿到锁说明其他worker正在刷新，之后通过文件变化加载。返回是否换用了新凭证。
+        """
+        token_file = self.token_file
+        with self._lock:
+            self._reload_if_changed(token_file)
+            creds = self._creds
+        if creds is None or not self._needs_refresh(creds):
+            return False
+        fresh = self._refresh_coordinated(token_file, blocking=False)
+        if fresh is None or self._needs_refresh(fresh):
+            return False
+        with self._lock:
+            # 刷新期间客户端可能已被重新认证替换，此时不覆盖
+            if self._creds is not creds:
+                return False
+            self._adopt(fresh, token_file)
+        return True
+
+    def get_service(self):
+        """返回缓存的Gmail service，必要时加载凭证
+
+        凭证正常由后台任务提前刷新；只有已经失效时（例如刚启动）才在请求中
+        持锁同步刷新。
+        """
+        credentials_file = self.credentials_file
+        token_file = self.token_file
+
+        # 检查凭证文件是否存在
         if not os.path.exists(credentials_file):
             raise HTTPException(status_code=500, detail="Gmail credentials file not found")
-        
-        # 创建OAuth流程，指定重定向URI
-        flow = InstalledAppFlow.from_client_secrets_file(
-            credentials_file, 
-            SCOPES,
-            redirect_uri='http://localhost:8000/api/gmail/auth/callback'
-        )
-        
-        # 生成授权URL
-        auth_url, _ = flow.authorization_url(
-            prompt='consent',
-            access_type='offline'
-        )
-        
+
+        with self._lock:
+            self._reload_if_changed(token_file)
+
+            creds = self._creds
+            if creds is None:
+                creds = self._load_credentials(token_file)
+
+            if creds and not creds.valid:
+                creds = self._refresh_coordinated(token_file, blocking=True)
+                if creds is not None and not creds.valid:
+                    creds = None
+
+            if not creds:
+                self.invalidate()
+                self._auth_failed = True
+                self._failed_signature = self._file_signature(token_file)
+                log_event(logging.ERROR, "❌ 需要重新进行OAuth认证", account=self.name)
+                raise HTTPException(
+                    status_code=401,
+                    detail="Gmail authentication required. Please visit /api/gmail/auth to authenticate."
+                )
+
+            if self._service is None:
+                try:
+                    client_options = {"api_endpoint": GMAIL_API_ENDPOINT} if GMAIL_API_ENDPOINT else None
+                    self._service = google_libs.discovery.build(
+                        'gmail', 'v1', credentials=creds, cache_discovery=False, client_options=client_options
+                    )
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=f"Failed to build Gmail service: {str(e)}")
+                self._generation += 1
+
+            if creds is not self._creds:
+                # 刷新会重写token文件，记录写入后的签名，避免把自己的写入当作外部变化
+                self._adopt(creds, token_file)
+            return self._service
+
+    def state(self):
+        """返回缓存凭证的状态，不读取磁盘"""
+        with self._lock:
+            creds = self._creds
+        if creds is None:
+            return {"loaded": False, "valid": False, "expiry": None}
         return {
-            "status": "auth_required",
-            "message": "请在浏览器中完成Gmail认证",
-            "auth_url": auth_url,
-            "instructions": [
-                "1. 点击上面的auth_url链接",
-                "2. 在Google页面登录并授权",
-                "3. 授权成功后会自动重定向",
-                "4. 检查认证状态"
-            ]
+            "loaded": True,
+            "valid": creds.valid,
+            "expiry": creds.expiry.isoformat() + "Z" if creds.expiry else None
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to start auth flow: {str(e)}")
 
-@app.get("/api/gmail/auth/callback")
-async def gmail_auth_callback(code: str = None, state: str = None):
-    """处理OAuth回调"""
-    try:
-        if not code:
+    def http(self):
+        """返回当前线程专用的已授权httplib2连接"""
+        local = self._local
+        with self._lock:
+            creds = self._creds
+            generation = self._generation
+        if creds is None:
+            return None
+        if getattr(local, "generation", None) != generation:
+            local.http = google_libs.auth_httplib2.AuthorizedHttp(
+                creds, http=google_libs.httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+            )
+            local.generation = generation
+        return local.http
+
+
+class GmailAccount:
+    """发件账号池中的一个账号：各自的客户端、配额计数和轮换状态"""
+
+    def __init__(self, client, daily_quota):
+        self.name = client.name
+        self.client = client
+        self.daily_quota = daily_quota
+        self.in_flight = 0
+        self.sent_today = 0
+        self.day = None
+        self.status = "ok"
+        self.suspended_until = 0.0
+        self.last_error = None
+
+    def roll_day(self, today):
+        if self.day != today:
+            self.day = today
+            self.sent_today = 0
+            if self.status == "quota_exhausted":
+                self.status = "ok"
+
+    @property
+    def quota_remaining(self):
+        return max(self.daily_quota - self.sent_today, 0)
+
+    def available(self, now):
+        if self.suspended_until > now:
+            return False
+        if self.status in ("auth_error", "rate_limited"):
+            self.status = "ok"
+        if not self.quota_remaining:
+            self.status = "quota_exhausted"
+            return False
+        return True
+
+
+class GmailAccountPool:
+    """发件账号池
+
+    每次发送从可用账号中选出进行中发送最少（least_loaded）或剩余配额最多（quota）
+    的账号。账号被Gmail限流、达到每日配额或认证失败时暂时移出轮换，冷却结束后
+    自动恢复；重新认证后立即恢复。所有账号都不可用时抛出429（带Retry-After），
+    全部因为认证失败时抛出401。
+    """
+
+    def __init__(self, accounts, routing):
+        self.accounts = accounts
+        self.routing = routing
+        self._by_name = {account.name: account for account in accounts}
+        self._lock = threading.Lock()
+        for account in accounts:
+            # 任何worker中token文件被重新写入有效凭证时，立即结束该账号的认证失败暂停
+            account.client.on_reload = lambda account=account: self.clear_auth_error(account)
+
+    @classmethod
+    def from_config(cls, spec, daily_quota, routing):
+        accounts = []
+        for entry in filter(None, (part.strip() for part in spec.split(","))):
+            name, credentials_file, token_file = entry.split(":", 2)
+            accounts.append(GmailAccount(GmailClientHolder(SCOPES, name, credentials_file, token_file), daily_quota))
+        if not accounts:
+            accounts.append(GmailAccount(GmailClientHolder(SCOPES), daily_quota))
+        return cls(accounts, routing)
+
+    @property
+    def primary(self):
+        return self.accounts[0]
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def _sort_key(self, account):
+        if self.routing == "quota":
+            return (-account.quota_remaining, account.in_flight)
+        return (account.in_flight, -account.quota_remaining)
+
+    def acquire(self, excluded=()):
+        """选出一个可用账号并计入进行中的发送，用完后必须调用release"""
+        with self._lock:
+            now = time.monotonic()
+            today = datetime.utcnow().date()
+            for account in self.accounts:
+                account.roll_day(today)
+            candidates = [
+                account for account in self.accounts
+                if account.name not in excluded and account.available(now)
+            ]
+            if not candidates:
+                raise self._unavailable(now)
+            account = min(candidates, key=self._sort_key)
+            account.in_flight += 1
+            return account
+
+    def _unavailable(self, now):
+        waits = []
+        for account in self.accounts:
+            if account.status == "auth_error":
+                continue
+            if account.status == "quota_exhausted" and account.suspended_until <= now:
+                # 本地计数用完，等到UTC零点配额重置
+                tomorrow = datetime.combine(account.day + timedelta(days=1), datetime.min.time())
+                waits.append((tomorrow - datetime.utcnow()).total_seconds())
+            else:
+                waits.append(account.suspended_until - now)
+        if not waits:
+            return HTTPException(
+                status_code=401,
+                detail="Gmail authentication required. Please visit /api/gmail/auth to authenticate."
+            )
+        return HTTPException(
+            status_code=429,
+            detail="All Gmail sender accounts are rate limited or out of quota",
+            headers={"Retry-After": str(max(math.ceil(min(waits)), 1))}
+        )
+
+    def release(self, account):
+        with self._lock:
+            account.in_flight -= 1
+
+    def record_sent(self, account, count=1):
+        with self._lock:
+            account.sent_today += count
+
+    def suspend(self, account, status, seconds, error=None):
+        """把账号移出轮换seconds秒"""
+        with self._lock:
+            account.status = status
+            account.suspended_until = max(account.suspended_until, time.monotonic() + seconds)
+            account.last_error = truncate_text(error) if error else None
+        log_event(
+            logging.WARNING, "⚠️ 发件账号暂停使用",
+            account=account.name, status=status, seconds=round(seconds, 1), error=error
+        )
+
+    def clear_auth_error(self, account):
+        """凭证重新加载后恢复因认证失败暂停的账号，限流和配额暂停不受影响"""
+        with self._lock:
+            if account.status != "auth_error":
+                return
+            account.status = "ok"
+            account.suspended_until = 0.0
+            account.last_error = None
+        log_event(logging.INFO, "✅ 发件账号凭证已更新，恢复使用", account=account.name)
+
+    def reset(self, account):
+        """重新认证后立即恢复账号"""
+        with self._lock:
+            account.status = "ok"
+            account.suspended_until = 0.0
+            account.last_error = None
+
+    def stats(self):
+        """每个账号的轮换状态，只读内存"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                account.name: {
+                    "status": account.status if account.suspended_until > now or account.status == "quota_exhausted" else "ok",
+                    "in_flight": account.in_flight,
+                    "sent_today": account.sent_today,
+                    "quota_remaining": account.quota_remaining,
+                    "suspended_for": round(max(account.suspended_until - now, 0), 1),
+                    "last_error": account.last_error
+                }
+                for account in self.accounts
+            }
+
+
+gmail_accounts = GmailAccountPool.from_config(GMAIL_ACCOUNTS, GMAIL_ACCOUNT_DAILY_QUOTA, GMAIL_ACCOUNT_ROUTING)
+
+def get_gmail_service():
+    """获取主账号的Gmail服务实例"""
+    return gmail_accounts.primary.client.get_service()
+
+class MimeSkeleton:
+    """预先生成的MIME邮件骨架
+
+    输出与MIMEMultipart + MIMEText(body, subtype, 'utf-8') + as_bytes()
+    逐字节一致（分隔符相同时），但分隔符和各段固定头部只在构造时生成一次，
+    正文只做一次utf-8编码和一次base64编码，最后整体编码为Gmail API需要的
+    urlsafe base64。收件人和主题仍由email库的compat32策略折行编码，
+    保证非ASCII主题的编码方式不变。
+    """
+
+    def __init__(self, boundary=None):
+        if boundary is None:
+            # 与email.generator相同的格式；正文经过base64编码，不可能与分隔符冲突
+            boundary = '=' * 15 + '%019d' % random.randrange(sys.maxsize) + '=='
+        self.boundary = boundary
+        delimiter = b'--' + boundary.encode('ascii')
+        self._head = (
+            b'Content-Type: multipart/mixed; boundary="' + boundary.encode('ascii') + b'"\n'
+            b'MIME-Version: 1.0\n'
+        )
+        self._parts = {
+            subtype: (
+                b'\n' + delimiter + b'\n'
+                b'Content-Type: text/' + subtype.encode('ascii') + b'; charset="utf-8"\n'
+                b'MIME-Version: 1.0\n'
+                b'Content-Transfer-Encoding: base64\n\n'
+            )
+            for subtype in ('html', 'plain')
+        }
+        self._tail = b'\n' + delimiter + b'--\n'
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def fold_headers(to_email, subject):
+        """折行编码收件人和主题头部，同一收件人/主题反复出现时直接命中缓存"""
+        compat32 = google_libs.email_policy.compat32
+        return compat32.fold_binary('to', to_email) + compat32.fold_binary('subject', subject)
+
+    @staticmethod
+    def encode_body(data):
+        """与base64.encodebytes输出相同（每行76字符），但只调用一次b2a_base64"""
+        encoded = binascii.b2a_base64(data, newline=False)
+        if not encoded:
+            return b''
+        return b'\n'.join([encoded[i:i + 76] for i in range(0, len(encoded), 76)]) + b'\n'
+
+    def build(self, to_email, subject, body, subtype):
+        """返回完整MIME邮件的字节串"""
+        return b''.join((
+            self._head,
+            self.fold_headers(to_email, subject),
+            self._parts[subtype],
+            self.encode_body(body.encode('utf-8')),
+            self._tail
+        ))
+
+
+mime_skeleton = MimeSkeleton()
+
+class TokenBucket:
+    """令牌桶；令牌可以为负数，表示已经预约了未来的发送时间"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """拿到下一个令牌需要等待的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class GmailRateLimiter:
+    """Gmail发送限流器：每个发件账号各自的令牌桶加上每个收件人各自的令牌桶
+
+    Gmail的配额按账号计算，增加发件账号即增加总吞吐；不指定发件账号的发送（SMTP）
+    共用一个令牌桶。超限的请求在GMAIL_RATE_MAX_DELAY内平滑等待；需要等待更久时抛出429，
+    由调用方换账号或转入发件队列。Gmail返回的限流响应只暂停对应的发件账号，见GmailAccountPool。
+    """
+
+    def __init__(self, rate, burst, recipient_rate, recipient_burst, max_delay, max_recipients=10000):
+        self.max_delay = max_delay
+        self.max_recipients = max_recipients
+        self._rate = rate
+        self._burst = burst
+        self._senders = {}
+        self._recipient_rate = recipient_rate
+        self._recipient_burst = recipient_burst
+        self._recipients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sender_bucket(self, sender):
+        if self._rate <= 0:
+            return None
+        bucket = self._senders.get(sender)
+        if bucket is None:
+            bucket = self._senders[sender] = TokenBucket(self._rate, self._burst)
+        return bucket
+
+    def _recipient_bucket(self, recipient):
+        if self._recipient_rate <= 0 or not recipient:
+            return None
+        key = recipient.strip().lower()
+        bucket = self._recipients.get(key)
+        if bucket is None:
+            bucket = self._recipients[key] = TokenBucket(self._recipient_rate, self._recipient_burst)
+            # 淘汰最久未使用的收件人；被淘汰的桶早已回满，不影响限流效果
+            if len(self._recipients) > self.max_recipients:
+                self._recipients.popitem(last=False)
+        else:
+            self._recipients.move_to_end(key)
+        return bucket
+
+    def reserve(self, recipient, sender=None):
+        """预约sender的一次发送，返回需要等待的秒数；等待超过上限时抛出429且不占用令牌
+
+        recipient为None时只占用发件账号的令牌（同一封邮件换账号重试时）。
+        """
+        with self._lock:
+            buckets = [b for b in (self._sender_bucket(sender), self._recipient_bucket(recipient)) if b is not None]
+            now = time.monotonic()
+            wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+            if wait > self.max_delay:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Gmail send rate limit reached",
+                    headers={"Retry-After": str(math.ceil(wait))}
+                )
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    def acquire(self, recipient, sender=None):
+        """预约并等待到可以发送为止"""
+        wait = self.reserve(recipient, sender)
+        if wait > 0:
+            time.sleep(wait)
+
+
+gmail_rate_limiter = GmailRateLimiter(
+    GMAIL_RATE_LIMIT, GMAIL_RATE_BURST,
+    GMAIL_RECIPIENT_RATE_LIMIT, GMAIL_RECIPIENT_RATE_BURST,
+    GMAIL_RATE_MAX_DELAY
+)
+
+def gmail_rate_limit_hint(error):
+    """判断HttpError是否为限流错误，返回建议的暂停秒数，否则返回None"""
+    status = error.resp.status
+    message = str(error).lower()
+    if status in (403, 429) and ("dailylimitexceeded" in message or "quota exceeded" in message):
+        # 每日配额用完，短时间内重试没有意义
+        return GMAIL_ACCOUNT_QUOTA_COOLDOWN
+    if status != 429 and not (status == 403 and "ratelimitexceeded" in message):
+        return None
+    try:
+        return max(float(error.resp.get("retry-after")), 0)
+    except (TypeError, ValueError):
+        return GMAIL_RATE_DEFAULT_PENALTY
+
+def mime_subtype(is_html):
+    """根据内容类型选择邮件正文格式；is_html由prepare_email_message确定，这里不再检查正文"""
+    return 'html' if is_html else 'plain'
+
+def build_raw_message(to_email, subject, body, is_html=False):
+    """构建MIME邮件并编码为Gmail API需要的urlsafe base64字符串"""
+    subtype = mime_subtype(is_html)
+    return base64.urlsafe_b64encode(mime_skeleton.build(to_email, subject, body, subtype)).decode('ascii')
+
+# 可以重试的Gmail临时错误
+GMAIL_TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+def gmail_rejected(error):
+    """Gmail因为邮件本身（例如收件地址无效）拒绝发送；认证和权限错误不算"""
+    return 400 <= error.resp.status < 500 and error.resp.status not in (401, 403)
+
+class RetryBudget:
+    """带完全抖动的指数退避重试，次数和总耗时都有上限；clock可在测试时替换"""
+
+    def __init__(self, max_retries, base, budget, clock=time.monotonic):
+        self.clock = clock
+        self.max_retries = max_retries
+        self.base = base
+        self.deadline = clock() + budget
+        self.retries = 0
+
+    def next_delay(self):
+        """返回下一次重试前的等待秒数，次数或时间预算用完时返回None"""
+        if self.retries >= self.max_retries:
+            return None
+        delay = random.uniform(0, self.base * 2 ** self.retries)
+        if self.clock() + delay >= self.deadline:
+            return None
+        self.retries += 1
+        return delay
+
+def send_gmail_message(to_email, subject, body, is_html=False):
+    """发送Gmail邮件
+
+    从发件账号池中选择账号发送；账号被限流或认证失败时移出轮换，换下一个账号重试，
+    所有账号都不可用时抛出429或401。本地限流按账号计算，账号的令牌桶需要等待过久时
+    也换下一个账号，都不行时抛出等待最短的429。5xx和超时等临时错误在GMAIL_RETRY_BUDGET内
+    带抖动退避后重试。
+    """
+    raw_message = None
+    tried = set()
+    retry = RetryBudget(GMAIL_RETRY_MAX, GMAIL_RETRY_BASE, GMAIL_RETRY_BUDGET)
+    reserved = False
+    limited = None
+    while True:
+        try:
+            account = gmail_accounts.acquire(tried)
+        except HTTPException:
+            if limited is not None:
+                raise limited
+            raise
+        tried.add(account.name)
+        try:
+            # 超过限流时平滑等待；收件人的令牌只在第一次预约时占用
+            gmail_rate_limiter.acquire(None if reserved else to_email, account.name)
+            reserved = True
+            started = time.perf_counter()
+            service = account.client.get_service()
+            acquired = time.perf_counter()
+            SEND_STAGE_SECONDS.observe("client", acquired - started)
+            
+            if raw_message is None:
+                raw_message = build_raw_message(to_email, subject, body, is_html=is_html)
+            encoded = time.perf_counter()
+            SEND_STAGE_SECONDS.observe("mime", encoded - acquired)
+            
+            # 发送邮件
+            sent_message = service.users().messages().send(
+                userId='me', body={'raw': raw_message}
+            ).execute(http=account.client.http())
+            SEND_STAGE_SECONDS.observe("execute", time.perf_counter() - encoded)
+            gmail_accounts.record_sent(account)
+            EMAIL_SEND_TOTAL.inc("success")
+            log_event(
+                logging.INFO, "✅ 邮件发送成功", sampled=True,
+                to=redact_email(to_email), account=account.name, message_id=sent_message['id']
+            )
+            
+            return {
+                "status": "success",
+                "message_id": sent_message['id'],
+                "thread_id": sent_message['threadId'],
+                "account": account.name
+            }
+        except HTTPException as e:
+            if e.status_code == 429:
+                # 本地限流：这个账号的令牌桶（或收件人的令牌桶）需要等待过久
+                if limited is None or int(e.headers["Retry-After"]) < int(limited.headers["Retry-After"]):
+                    limited = e
+                continue
+            if e.status_code != 401:
+                raise
+            gmail_accounts.suspend(account, "auth_error", GMAIL_ACCOUNT_AUTH_COOLDOWN, e.detail)
+        except google_libs.errors.HttpError as error:
+            EMAIL_SEND_TOTAL.inc("error")
+            GMAIL_HTTP_ERRORS_TOTAL.inc(error.resp.status)
+            log_event(logging.ERROR, "❌ Gmail API错误", to=redact_email(to_email), account=account.name, error=str(error))
+            retry_after = gmail_rate_limit_hint(error)
+            if retry_after is not None:
+                gmail_accounts.suspend(account, "rate_limited", retry_after, str(error))
+            elif error.resp.status == 401:
+                gmail_accounts.suspend(account, "auth_error", GMAIL_ACCOUNT_AUTH_COOLDOWN, str(error))
+            elif error.resp.status in GMAIL_TRANSIENT_STATUSES and retry_transient(retry, tried, account):
+                pass
+            elif gmail_rejected(error):
+                raise HTTPException(status_code=400, detail=f"Gmail rejected the message: {error}")
+            else:
+                raise HTTPException(status_code=500, detail=f"Gmail API error: {error}")
+        except (TimeoutError, ConnectionError) as e:
+            EMAIL_SEND_TOTAL.inc("error")
+            log_event(logging.WARNING, "⚠️ Gmail API连接失败", to=redact_email(to_email), account=account.name, error=str(e))
+            if not retry_transient(retry, tried, account):
+                raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+        except Exception as e:
+            EMAIL_SEND_TOTAL.inc("error")
+            log_event(logging.ERROR, "❌ 发送邮件失败", exc_info=True, to=redact_email(to_email), error=str(e))
+            raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+        finally:
+            gmail_accounts.release(account)
+
+def retry_transient(retry, tried, account):
+    """临时错误时等待退避时间并允许同一账号重试，预算用完时返回False"""
+    delay = retry.next_delay()
+    if delay is None:
+        return False
+    log_event(logging.INFO, "🔁 Gmail临时错误，稍后重试", account=account.name, retry=retry.retries, delay_ms=round(delay * 1000))
+    time.sleep(delay)
+    tried.discard(account.name)
+    return True
+
+def new_batch_request(service, callback):
+    """创建批量请求；设置了GMAIL_API_ENDPOINT时批量地址也指向该地址"""
+    if GMAIL_API_ENDPOINT:
+        return google_libs.http.BatchHttpRequest(
+            callback=callback, batch_uri=GMAIL_API_ENDPOINT.rstrip('/') + '/batch'
+        )
+    return service.new_batch_http_request(callback=callback)
+
+def send_gmail_batch(messages):
+    """通过Gmail批量HTTP请求发送多封邮件
+
+    messages为prepare_email_message的返回值列表，按EMAIL_BATCH_CHUNK_SIZE
+    分块提交，每块只占用一次HTTP往返，每块各自从发件账号池中选择账号。
+    返回与输入顺序一致的逐条结果，单条失败不影响其他邮件。
+    """
+    results = [None] * len(messages)
+
+    def response_handler(account):
+        def on_response(request_id, response, exception):
+            index = int(request_id)
+            if exception is not None:
+                EMAIL_SEND_TOTAL.inc("error")
+                if isinstance(exception, google_libs.errors.HttpError):
+                    GMAIL_HTTP_ERRORS_TOTAL.inc(exception.resp.status)
+                    retry_after = gmail_rate_limit_hint(exception)
+                    if retry_after is not None:
+                        gmail_accounts.suspend(account, "rate_limited", retry_after, str(exception))
+                    elif gmail_rejected(exception):
+                        results[index] = {"status": "rejected", "error": f"Gmail rejected the message: {exception}"}
+                        return
+                    results[index] = {
+                        "status": "error", "error": f"Gmail API error: {exception}",
+                        "status_code": exception.resp.status
+                    }
+                    return
+                results[index] = {"status": "error", "error": f"Gmail API error: {exception}"}
+            else:
+                EMAIL_SEND_TOTAL.inc("success")
+                gmail_accounts.record_sent(account)
+                results[index] = {
+                    "status": "success",
+                    "message_id": response['id'],
+                    "thread_id": response['threadId'],
+                    "account": account.name
+                }
+        return on_response
+
+    for start in range(0, len(messages), EMAIL_BATCH_CHUNK_SIZE):
+        chunk = range(start, min(start + EMAIL_BATCH_CHUNK_SIZE, len(messages)))
+        tried = set()
+        while True:
+            try:
+                account = gmail_accounts.acquire(tried)
+            except HTTPException as e:
+                for index in chunk:
+                    if e.status_code == 429:
+                        results[index] = {"status": "rate_limited", "error": e.detail, "retry_after": int(e.headers["Retry-After"])}
+                    else:
+                        results[index] = {"status": "error", "error": e.detail, "status_code": e.status_code}
+                break
+            tried.add(account.name)
+            try:
+                if send_gmail_chunk(account, messages, chunk, results, response_handler(account)):
+                    break
+            finally:
+                gmail_accounts.release(account)
+
+    log_event(
+        logging.INFO, "📤 批量发送完成",
+        succeeded=sum(1 for r in results if r['status'] == 'success'), total=len(messages)
+    )
+    return results
+
+def send_gmail_chunk(account, messages, chunk, results, on_response):
+    """用一个账号的一次批量请求发送chunk中的邮件，结果写入results
+
+    账号认证失败时返回False，由调用方换一个账号重试。
+    """
+    try:
+        service = account.client.get_service()
+    except HTTPException as e:
+        if e.status_code == 401:
+            gmail_accounts.suspend(account, "auth_error", GMAIL_ACCOUNT_AUTH_COOLDOWN, e.detail)
+            return False
+        for index in chunk:
+            results[index] = {"status": "error", "error": e.detail, "status_code": e.status_code}
+        return True
+    batch = new_batch_request(service, on_response)
+    wait = 0.0
+    for index in chunk:
+        message = messages[index]
+        try:
+            wait = max(wait, gmail_rate_limiter.reserve(message["to"], account.name))
+        except HTTPException as e:
+            results[index] = {"status": "rate_limited", "error": e.detail, "retry_after": int(e.headers["Retry-After"])}
+            continue
+        try:
+            raw_message = build_raw_message(
+                message["to"], message["subject"], message["body"], is_html=message["is_html"]
+            )
+        except Exception as e:
+            results[index] = {"status": "error", "error": f"Failed to build email: {str(e)}"}
+            continue
+        batch.add(
+            service.users().messages().send(userId='me', body={'raw': raw_message}),
+            request_id=str(index)
+        )
+    if wait > 0:
+        time.sleep(wait)
+    try:
+        batch.execute(http=account.client.http())
+    except Exception as e:
+        # 整个批次失败时，为尚无结果的条目记录同一个错误
+        log_event(logging.ERROR, "❌ 批量发送失败", error=str(e))
+        for index in chunk:
+            if results[index] is None:
+                results[index] = {"status": "error", "error": f"Failed to send batch: {str(e)}"}
+    return True
+
+def warm_up_gmail_client():
+    """预先导入Google客户端库并构建每个发件账号的Gmail客户端，未认证时跳过"""
+    started = time.perf_counter()
+    for account in gmail_accounts.accounts:
+        try:
+            account.client.get_service()
+            log_event(logging.INFO, "✅ Gmail客户端已就绪", account=account.name)
+        except HTTPException as e:
+            log_event(logging.WARNING, "⚠️ Gmail客户端未就绪", account=account.name, detail=e.detail)
+        except Exception as e:
+            log_event(logging.WARNING, "⚠️ Gmail客户端预热失败", account=account.name, error=str(e))
+    STARTUP_TIMINGS["gmail_warmup"] = time.perf_counter() - started
+
+@app.on_event("startup")
+async def start_gmail_warmup():
+    """在后台线程中预热Gmail客户端，不阻塞服务启动"""
+    log_event(logging.INFO, "🚀 模块导入完成", import_ms=round(STARTUP_TIMINGS['module_import'] * 1000))
+    if GMAIL_WARMUP and EMAIL_TRANSPORT == "gmail":
+        asyncio.get_running_loop().run_in_executor(None, warm_up_gmail_client)
+
+class GmailTokenRefresher:
+    """每隔interval秒检查各发件账号的token，临近过期时提前刷新"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+
+    def refresh_all(self):
+        refreshed = 0
+        for account in gmail_accounts.accounts:
+            try:
+                refreshed += account.client.refresh_ahead()
+            except Exception as e:
+                log_event(logging.ERROR, "❌ 后台刷新token失败", account=account.name, exc_info=True, error=str(e))
+        return refreshed
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.to_thread(self.refresh_all)
+            await asyncio.sleep(self.interval)
+
+
+gmail_token_refresher = GmailTokenRefresher(GMAIL_TOKEN_CHECK_INTERVAL)
+
+@app.on_event("startup")
+async def start_gmail_token_refresher():
+    if EMAIL_TRANSPORT == "gmail":
+        gmail_token_refresher.start()
+
+@app.on_event("shutdown")
+async def stop_gmail_token_refresher():
+    await gmail_token_refresher.stop()
+
+class BoundedSendPool:
+    """有界的邮件发送线程池
+
+    Gmail客户端基于阻塞的httplib2，放在线程池中执行以免阻塞事件循环。
+    正在执行和排队的任务总数受max_pending限制，满载时立即返回503。
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gmail-send")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _release(self, _future):
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
+
+    async def run(self, func, *args, **kwargs):
+        """在线程池中执行func并等待结果，池已满时抛出503"""
+        if not self._slots.acquire(blocking=False):
+            raise HTTPException(
+                status_code=503,
+                detail="Email send pool is saturated, please retry later",
+                headers={"Retry-After": "1"}
+            )
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+send_pool = BoundedSendPool(EMAIL_SEND_WORKERS, EMAIL_SEND_MAX_PENDING)
+
+@app.on_event("shutdown")
+async def shutdown_send_pool():
+    send_pool.shutdown()
+
+def build_mime_message(from_email, to_email, subject, body, is_html=False):
+    """构建带From、Date、Message-ID头部的完整MIME邮件，返回(字节串, Message-ID)
+
+    Gmail API会自动补上这些头部，SMTP和文件通道需要自己生成。
+    """
+    compat32 = google_libs.email_policy.compat32
+    utils = google_libs.email_utils
+    # 显式指定域名，避免make_msgid调用getfqdn()做DNS查询
+    message_id = utils.make_msgid(domain=from_email.rpartition("@")[2] or "localhost")
+    headers = (
+        compat32.fold_binary('From', from_email)
+        + compat32.fold_binary('Date', utils.formatdate(usegmt=True))
+        + compat32.fold_binary('Message-ID', message_id)
+    )
+    return headers + mime_skeleton.build(to_email, subject, body, mime_subtype(is_html)), message_id
+
+class EmailTransport:
+    """发送通道的基类
+
+    send发送一封邮件并返回结果，失败时抛出HTTPException（429表示稍后重试）；
+    send_batch返回与输入顺序一致的逐条结果，被限流的条目状态为rate_limited并带retry_after，
+    因邮件本身（例如收件地址无效）被拒绝（400）的条目状态为rejected，其他错误为error
+    并尽量带status_code。
+    """
+
+    name = None
+
+    def send(self, to_email, subject, body, is_html=False):
+        raise NotImplementedError
+
+    def send_batch(self, messages):
+        results = []
+        for message in messages:
+            try:
+                results.append(self.send(message["to"], message["subject"], message["body"], is_html=message["is_html"]))
+            except HTTPException as e:
+                if e.status_code == 429:
+                    retry_after = int(e.headers.get("Retry-After", 1))
+                    results.append({"status": "rate_limited", "error": e.detail, "retry_after": retry_after})
+                elif e.status_code == 400:
+                    results.append({"status": "rejected", "error": e.detail})
+                else:
+                    # 认证、配置等通道问题可以稍后重试，保留状态码供熔断和调用方区分
+                    results.append({"status": "error", "error": e.detail, "status_code": e.status_code})
+        return results
+
+    def stats(self):
+        return {"name": self.name}
+
+    def close(self):
+        pass
+
+
+class GmailTransport(EmailTransport):
+    """通过Gmail API发送，使用发件账号池和批量HTTP请求"""
+
+    name = "gmail"
+
+    def send(self, to_email, subject, body, is_html=False):
+        return send_gmail_message(to_email, subject, body, is_html=is_html)
+
+    def send_batch(self, messages):
+        return send_gmail_batch(messages)
+
+    def stats(self):
+        return {"name": self.name, "accounts": len(gmail_accounts.accounts)}
+
+
+class NullTransport(EmailTransport):
+    """只构建MIME邮件然后丢弃，用于不依赖外部服务的压测"""
+
+    name = "null"
+
+    def __init__(self, sender):
+        self.sender = sender or "pillpal@localhost"
+
+    def send(self, to_email, subject, body, is_html=False):
+        started = time.perf_counter()
+        _, message_id = build_mime_message(self.sender, to_email, subject, body, is_html)
+        SEND_STAGE_SECONDS.observe("mime", time.perf_counter() - started)
+        EMAIL_SEND_TOTAL.inc("success")
+        return {"status": "success", "message_id": message_id, "thread_id": None}
+
+
+class FileTransport(EmailTransport):
+    """把每封邮件写成directory下的一个.eml文件"""
+
+    name = "file"
+
+    def __init__(self, sender, directory):
+        self.sender = sender or "pillpal@localhost"
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, to_email, subject, body, is_html=False):
+        started = time.perf_counter()
+        data, message_id = build_mime_message(self.sender, to_email, subject, body, is_html)
+        encoded = time.perf_counter()
+        SEND_STAGE_SECONDS.observe("mime", encoded - started)
+        path = os.path.join(self.directory, f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:12]}.eml")
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            EMAIL_SEND_TOTAL.inc("error")
+            raise HTTPException(status_code=500, detail=f"Failed to write email: {str(e)}")
+        SEND_STAGE_SECONDS.observe("execute", time.perf_counter() - encoded)
+        EMAIL_SEND_TOTAL.inc("success")
+        return {"status": "success", "message_id": message_id, "thread_id": None, "path": path}
+
+    def stats(self):
+        return {"name": self.name, "directory": self.directory}
+
+
+class SmtpConnectionPool:
+    """已认证SMTP连接的连接池
+
+    每个连接只在建立时做一次TLS握手和AUTH，之后被多次发送复用；同一时刻
+    一个连接只被一个线程使用。空闲连接按后进先出复用，让少数连接保持活跃，
+    空闲超过max_idle秒的连接关闭重建。
+    """
+
+    def __init__(self, host, port, username, password, security, timeout, size, max_idle):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.security = security
+        self.timeout = timeout
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.open = 0
+        self.connects = 0
+
+    def _connect(self):
+        smtplib = google_libs.smtplib
+        if self.security == "ssl":
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.ehlo()
+            if self.security == "starttls":
+                conn.starttls()
+                conn.ehlo()
+            if self.username:
+                conn.login(self.username, self.password)
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self.open += 1
+            self.connects += 1
+        return conn
+
+    def _close(self, conn):
+        with self._lock:
+            self.open -= 1
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    def acquire(self, fresh=False):
+        """取出一个连接，返回(连接, 是否为复用的连接)；池已满时最多等待timeout秒"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HTTPException(
+                status_code=503,
+                detail="SMTP connection pool is exhausted, please retry later",
+                headers={"Retry-After": "1"}
+            )
+        conn = None
+        stale = []
+        now = time.monotonic()
+        with self._lock:
+            while self._idle and not fresh:
+                candidate, last_used = self._idle.pop()
+                if now - last_used < self.max_idle:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            self._close(candidate)
+        if conn is not None:
+            return conn, True
+        try:
+            return self._connect(), False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """归还仍可用的连接"""
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def discard(self, conn):
+        """关闭出错的连接并释放名额"""
+        self._close(conn)
+        self._slots.release()
+
+    @staticmethod
+    def deliver(conn, sender, recipient, data):
+        """在一个连接上发送一封邮件
+
+        服务器支持PIPELINING时，MAIL、RCPT、DATA一次写出再依次读取应答，
+        每封邮件少两次网络往返；否则退回逐条命令的sendmail。
+        """
+        smtplib = google_libs.smtplib
+        # 地址中的CR/LF会把一条命令拆成两条（例如多出一个RCPT TO），发送前直接拒绝
+        if "\r" in sender or "\n" in sender:
+            raise smtplib.SMTPSenderRefused(501, b"Sender address contains a line break", sender)
+        if "\r" in recipient or "\n" in recipient:
+            raise smtplib.SMTPRecipientsRefused({recipient: (501, b"Recipient address contains a line break")})
+        if not conn.has_extn("pipelining"):
+            conn.sendmail(sender, [recipient], data)
+            return
+        # putcmd只写出命令不读应答，三条命令仍在一次往返内完成
+        conn.putcmd("mail", f"FROM:{smtplib.quoteaddr(sender)}")
+        conn.putcmd("rcpt", f"TO:{smtplib.quoteaddr(recipient)}")
+        conn.putcmd("data")
+        mail_code, mail_reply = conn.getreply()
+        rcpt_code, rcpt_reply = conn.getreply()
+        data_code, data_reply = conn.getreply()
+        if data_code == 354:
+            if mail_code == 250 and rcpt_code in (250, 251):
+                # 统一为CRLF换行并对行首的点加倍，与smtplib.SMTP.data相同
+                payload = re.sub(rb'(?m)^\.', b'..', re.sub(rb'\r\n|\r|\n', b'\r\n', data))
+                if not payload.endswith(b'\r\n'):
+                    payload += b'\r\n'
+                conn.send(payload + b'.\r\n')
+                code, reply = conn.getreply()
+                if code == 250:
+                    return
+                conn.rset()
+                raise smtplib.SMTPDataError(code, reply)
+            # 信封被拒绝但服务器仍进入了DATA状态，发送空正文结束
+            conn.send(b'.\r\n')
+            conn.getreply()
+        conn.rset()
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_reply, sender)
+        if rcpt_code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({recipient: (rcpt_code, rcpt_reply)})
+        raise smtplib.SMTPDataError(data_code, data_reply)
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "open": self.open, "idle": len(self._idle), "connects": self.connects}
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+
+def smtp_http_error(error):
+    """把SMTP错误转换为HTTPException
+
+    4xx临时错误转换为429，由调用方稍后重试；收件人被永久拒绝（5xx）是邮件本身的问题，
+    转换为400，不计入熔断。
+    """
+    if isinstance(error, HTTPException):
+        return error
+    code = getattr(error, "smtp_code", None)
+    refused = isinstance(error, google_libs.smtplib.SMTPRecipientsRefused)
+    if code is None and refused:
+        code = next(iter(error.recipients.values()))[0]
+    if code is not None and 400 <= code < 500:
+        return HTTPException(
+            status_code=429,
+            detail=f"SMTP temporary failure: {error}",
+            headers={"Retry-After": str(math.ceil(GMAIL_RATE_DEFAULT_PENALTY))}
+        )
+    if refused:
+        return HTTPException(status_code=400, detail=f"SMTP recipient refused: {error}")
+    return HTTPException(status_code=500, detail=f"SMTP error: {error}")
+
+class SmtpTransport(EmailTransport):
+    """通过SMTP发送，复用连接池中已认证的连接"""
+
+    name = "smtp"
+
+    def __init__(self, pool, sender):
+        self.pool = pool
+        self.sender = sender
+
+    def _run(self, func):
+        """在池中的一个连接上执行func(conn)；复用的连接已被服务器关闭时换新连接重试一次"""
+        smtplib = google_libs.smtplib
+        started = time.perf_counter()
+        conn, reused = self.pool.acquire()
+        SEND_STAGE_SECONDS.observe("client", time.perf_counter() - started)
+        while True:
+            try:
+                result = func(conn)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # 服务器拒绝了这封邮件，连接本身仍可用
+                self.pool.release(conn)
+                raise
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self.pool.discard(conn)
+                if not reused:
+                    raise
+                log_event(logging.INFO, "🔄 SMTP连接已断开，重新连接", error=str(e))
+                conn, reused = self.pool.acquire(fresh=True)
+                continue
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+            self.pool.release(conn)
+            return result
+
+    def _deliver(self, conn, to_email, subject, body, is_html):
+        started = time.perf_counter()
+        data, message_id = build_mime_message(self.sender, to_email, subject, body, is_html)
+        encoded = time.perf_counter()
+        SEND_STAGE_SECONDS.observe("mime", encoded - started)
+        self.pool.deliver(conn, self.sender, to_email, data)
+        SEND_STAGE_SECONDS.observe("execute", time.perf_counter() - encoded)
+        return {"status": "success", "message_id": message_id, "thread_id": None}
+
+    def send(self, to_email, subject, body, is_html=False):
+        gmail_rate_limiter.acquire(to_email)
+        try:
+            result = self._run(lambda conn: self._deliver(conn, to_email, subject, body, is_html))
+        except Exception as e:
+            EMAIL_SEND_TOTAL.inc("error")
+            log_event(logging.ERROR, "❌ SMTP发送失败", to=redact_email(to_email), error=str(e))
+            raise smtp_http_error(e)
+        EMAIL_SEND_TOTAL.inc("success")
+        log_event(logging.INFO, "✅ 邮件发送成功", sampled=True, to=redact_email(to_email), message_id=result["message_id"])
+        return result
+
+    def send_batch(self, messages):
+        """在同一个连接上依次发送全部邮件，连接断开时从断开处换新连接继续"""
+        smtplib = google_libs.smtplib
+        results = []
+
+        def deliver_all(conn):
+            while len(results) < len(messages):
+                message = messages[len(results)]
+                try:
+                    gmail_rate_limiter.acquire(message["to"])
+                    result = self._deliver(conn, message["to"], message["subject"], message["body"], message["is_html"])
+                except HTTPException as e:
+                    result = {"status": "rate_limited", "error": e.detail, "retry_after": int(e.headers["Retry-After"])}
+                except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                    EMAIL_SEND_TOTAL.inc("error")
+                    error = smtp_http_error(e)
+                    if error.status_code == 400:
+                        result = {"status": "rejected", "error": error.detail}
+                    else:
+                        result = {"status": "error", "error": error.detail, "status_code": error.status_code}
+                else:
+                    EMAIL_SEND_TOTAL.inc("success")
+                results.append(result)
+
+        try:
+            self._run(deliver_all)
+        except Exception as e:
+            log_event(logging.ERROR, "❌ 批量发送失败", error=str(e))
+            while len(results) < len(messages):
+                EMAIL_SEND_TOTAL.inc("error")
+                results.append({"status": "error", "error": f"Failed to send batch: {str(e)}"})
+        log_event(
+            logging.INFO, "📤 批量发送完成",
+            succeeded=sum(1 for r in results if r['status'] == 'success'), total=len(messages)
+        )
+        return results
+
+    def stats(self):
+        return {"name": self.name, "host": self.pool.host, "port": self.pool.port, **self.pool.stats()}
+
+    def close(self):
+        self.pool.close()
+
+
+def create_email_transport(kind):
+    """按EMAIL_TRANSPORT创建发送通道"""
+    if kind == "gmail":
+        return GmailTransport()
+    if kind == "smtp":
+        pool = SmtpConnectionPool(
+            SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_SECURITY,
+            SMTP_TIMEOUT, SMTP_POOL_SIZE, SMTP_MAX_IDLE
+        )
+        return SmtpTransport(pool, SMTP_FROM)
+    if kind == "null":
+        return NullTransport(SMTP_FROM)
+    if kind == "file":
+        return FileTransport(SMTP_FROM, EMAIL_FILE_DIR)
+    raise ValueError(f"Unknown EMAIL_TRANSPORT: {kind}")
+
+
+class CircuitOpenError(HTTPException):
+    """熔断器打开时快速失败，Retry-After为距离半开试探的秒数"""
+
+    def __init__(self, retry_after):
+        seconds = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=503,
+            detail="Email transport circuit is open",
+            headers={"Retry-After": str(seconds)},
+        )
+
+
+class CircuitBreaker:
+    """基于失败率的熔断器
+
+    按秒统计最近window秒内的请求数和失败数。请求数达到min_requests且失败率
+    达到failure_rate时打开，open_seconds内的请求直接失败；之后进入半开状态，
+    最多放行half_open_probes个试探请求：试探成功则关闭并清空统计，失败则重新打开。
+    线程安全。clock返回单调时间（秒），测试时可以替换。
+    """
+
+    def __init__(self, window, min_requests, failure_rate, open_seconds, half_open_probes, clock=time.monotonic):
+        self.clock = clock
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self.state = "closed"
+        self.opened_at = None
+        self.opened_total = 0
+        self.rejected_total = 0
+        self._probes = 0
+        # [秒, 请求数, 失败数]
+        self._buckets = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        horizon = int(now) - self.window
+        while self._buckets and self._buckets[0][0] <= horizon:
+            self._buckets.popleft()
+
+    def _counts(self):
+        return sum(b[1] for b in self._buckets), sum(b[2] for b in self._buckets)
+
+    def _open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.opened_total += 1
+        self._probes = 0
+
+    def _remaining(self, now):
+        """打开状态下距离半开的秒数，已到期时转为半开并返回0"""
+        if self.state != "open":
+            return 0
+        remaining = self.opened_at + self.open_seconds - now
+        if remaining > 0:
+            return remaining
+        self.state = "half_open"
+        self._probes = 0
+        log_event(logging.INFO, "🔌 发送通道熔断器半开，开始试探")
+        return 0
+
+    def open_remaining(self):
+        """不占用试探名额地查询熔断器是否打开，返回剩余秒数（0表示可以尝试）"""
+        with self._lock:
+            return self._remaining(self.clock())
+
+    def check(self):
+        """熔断器打开时抛出CircuitOpenError"""
+        remaining = self.open_remaining()
+        if remaining:
+            with self._lock:
+                self.rejected_total += 1
+            raise CircuitOpenError(remaining)
+
+    def allow(self):
+        """请求开始前调用；关闭状态总是放行，半开状态只放行有限个试探"""
+        with self._lock:
+            now = self.clock()
+            remaining = self._remaining(now)
+            if remaining:
+                self.rejected_total += 1
+                raise CircuitOpenError(remaining)
+            if self.state == "half_open":
+                if self._probes >= self.half_open_probes:
+                    self.rejected_total += 1
+                    raise CircuitOpenError(1)
+                self._probes += 1
+                return "probe"
+            return "closed"
+
+    def record(self, failed, mode="closed"):
+        """记录一次请求的结果，mode为allow的返回值"""
+        with self._lock:
+            now = self.clock()
+            if mode == "probe":
+                if self.state != "half_open":
+                    return
+                if failed:
+                    self._open(now)
+                    log_event(logging.WARNING, "🔌 发送通道试探失败，熔断器重新打开", open_seconds=self.open_seconds)
+                else:
+                    self.state = "closed"
+                    self._buckets.clear()
+                    log_event(logging.INFO, "✅ 发送通道恢复，熔断器关闭")
+                return
+            self._expire(now)
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            self._buckets[-1][1] += 1
+            if failed:
+                self._buckets[-1][2] += 1
+            if self.state != "closed" or not failed:
+                return
+            total, failures = self._counts()
+            if total >= self.min_requests and failures / total >= self.failure_rate:
+                self._open(now)
+                log_event(
+                    logging.WARNING, "🔌 发送通道失败率过高，熔断器打开",
+                    requests=total, failures=failures, open_seconds=self.open_seconds
+                )
+
+    def snapshot(self):
+        with self._lock:
+            now = self.clock()
+            self._remaining(now)
+            self._expire(now)
+            total, failures = self._counts()
+            retry_after = None
+            if self.state == "open":
+                retry_after = round(self.opened_at + self.open_seconds - now, 1)
+            return {
+                "state": self.state,
+                "window_requests": total,
+                "window_failures": failures,
+                "failure_rate": round(failures / total, 3) if total else 0.0,
+                "retry_after": retry_after,
+                "opened_total": self.opened_total,
+                "rejected_total": self.rejected_total,
+                "open_action": CIRCUIT_BREAKER_OPEN_ACTION,
+            }
+
+
+def transport_failed(error):
+    """判断异常是否说明发送通道本身不可用
+
+    只计入5xx、超时和连接错误；限流、邮件被拒绝（4xx）和线程池已满不计入。
+    """
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500 and error.status_code != 503
+    # 超时和连接错误都是OSError的子类
+    return isinstance(error, OSError)
+
+def batch_result_failed(result):
+    """批量结果中的一条是否说明发送通道本身不可用，口径与transport_failed相同"""
+    if result["status"] != "error":
+        return False
+    status_code = result.get("status_code", 500)
+    return status_code >= 500 and status_code != 503
+
+
+class CircuitBreakerTransport(EmailTransport):
+    """在发送通道外包一层熔断器"""
+
+    def __init__(self, transport, breaker):
+        self.transport = transport
+        self.breaker = breaker
+        self.name = transport.name
+
+    def send(self, to_email, subject, body, is_html=False):
+        mode = self.breaker.allow()
+        try:
+            result = self.transport.send(to_email, subject, body, is_html=is_html)
+        except Exception as e:
+            self.breaker.record(transport_failed(e), mode)
+            raise
+        self.breaker.record(False, mode)
+        return result
+
+    def send_batch(self, messages):
+        mode = self.breaker.allow()
+        try:
+            results = self.transport.send_batch(messages)
+        except Exception as e:
+            self.breaker.record(transport_failed(e), mode)
+            raise
+        # 整批都是通道故障才计为失败，被拒绝的邮件、本地限流和认证问题不影响熔断
+        failed = bool(messages) and all(batch_result_failed(r) for r in results)
+        self.breaker.record(failed, mode)
+        return results
+
+    def stats(self):
+        return self.transport.stats()
+
+    def close(self):
+        self.transport.close()
+
+
+email_circuit_breaker = CircuitBreaker(
+    CIRCUIT_BREAKER_WINDOW, CIRCUIT_BREAKER_MIN_REQUESTS, CIRCUIT_BREAKER_FAILURE_RATE,
+    CIRCUIT_BREAKER_OPEN_SECONDS, CIRCUIT_BREAKER_HALF_OPEN_PROBES
+)
+email_transport = CircuitBreakerTransport(create_email_transport(EMAIL_TRANSPORT), email_circuit_breaker)
+
+@app.on_event("shutdown")
+async def close_email_transport():
+    email_transport.close()
+
+class EventSubscription:
+    """一个SSE连接订阅的主题和它的有界缓冲"""
+
+    def __init__(self, topics, buffer_size):
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def put(self, frame):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(frame)
+
+
+class EventBroker:
+    """进程内的发布/订阅，通过SSE推送发送结果和服药提醒
+
+    事件按患者user_id分主题，每个事件只序列化一次为SSE帧，再分发给订阅了该主题
+    的连接。每个连接的缓冲有上限，慢客户端只会丢失自己最旧的事件，不影响其他连接。
+    最近replay_size个事件保留在内存中，重连时按Last-Event-ID补发；事件ID只在
+    当前进程内有效。订阅和分发都在事件循环中进行，publish可在任意线程中调用。
+    """
+
+    def __init__(self, buffer_size, max_subscribers, replay_size):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        # 主题 -> 订阅集合
+        self._topics = {}
+        # (事件ID, 主题, SSE帧)
+        self._recent = deque(maxlen=replay_size)
+        self._next_id = 0
+        self._loop = None
+        self.subscribers = 0
+        self.published = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    def publish(self, topic, event, data):
+        """发布一个事件；事件循环未启动时忽略"""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(topic, event, data)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, topic, event, data)
+
+    def _dispatch(self, topic, event, data):
+        self._next_id += 1
+        self.published += 1
+        payload = json.dumps(
+            {"type": event, "user_id": topic, "at": datetime.utcnow().isoformat(), **data},
+            ensure_ascii=False, default=str
+        )
+        frame = f"id: {self._next_id}\nevent: {event}\ndata: {payload}\n\n".encode("utf-8")
+        self._recent.append((self._next_id, topic, frame))
+        for subscription in self._topics.get(topic, ()):
+            subscription.put(frame)
+
+    def check_capacity(self):
+        if self.subscribers >= self.max_subscribers:
+            raise HTTPException(status_code=503, detail="Too many event stream connections", headers={"Retry-After": "5"})
+
+    def subscribe(self, topics, last_event_id=None):
+        subscription = EventSubscription(topics, self.buffer_size)
+        for topic in topics:
+            self._topics.setdefault(topic, set()).add(subscription)
+        self.subscribers += 1
+        if last_event_id is not None:
+            for event_id, topic, frame in self._recent:
+                if event_id > last_event_id and topic in topics:
+                    subscription.put(frame)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for topic in subscription.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[topic]
+        self.subscribers -= 1
+
+    def stats(self):
+        return {"subscribers": self.subscribers, "topics": len(self._topics), "published": self.published}
+
+
+event_broker = EventBroker(EVENT_STREAM_BUFFER, EVENT_STREAM_MAX_SUBSCRIBERS, EVENT_STREAM_REPLAY)
+
+@app.on_event("startup")
+async def start_event_broker():
+    event_broker.start()
+
+def publish_delivery(message, status, **fields):
+    """发布一封邮件的投递状态，只有带user_id的邮件才有订阅者
+
+    合并后的摘要邮件带user_ids（各条通知所属的患者），每位患者各收到一条事件。
+    """
+    user_ids = message.get("user_ids") or [message.get("user_id")]
+    for user_id in filter(None, user_ids):
+        event_broker.publish(user_id, "delivery", {
+            "status": status,
+            "to": redact_email(message["to"]),
+            "subject": message["subject"],
+            **fields
+        })
+
+class EmailQueue:
+    """基于SQLite的持久化发件队列
+
+    状态流转: pending -> sending -> sent，失败时回到pending并按指数退避
+    重新调度，超过最大重试次数后进入dead（死信）。进程重启时仍处于
+    sending的消息会被重新放回pending。sent的消息只保留收件人和主题，
+    next_attempt_at记为发送时间，超过保留时间后由purge_sent删除。
+    带digest_key的pending消息属于同一封摘要，取件时由merge合并为一条。
+    """
+
+    # 每次删除的行数，避免长时间占用写锁
+    PURGE_CHUNK = 1000
+
+    def __init__(self, path, merge=None):
+        self.path = path
+        self.merge = merge
+        self._lock = threading.Lock()
+        self._conn = None
+        self._read_lock = threading.Lock()
+        self._read_conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS email_queue (
+                    id TEXT PRIMARY KEY,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    message_id TEXT,
+                    thread_id TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    digest_key TEXT
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(email_queue)")}
+            if "digest_key" not in columns:
+                conn.execute("ALTER TABLE email_queue ADD COLUMN digest_key TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_email_queue_due ON email_queue (status, next_attempt_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_email_queue_digest ON email_queue (digest_key, status) "
+                "WHERE digest_key IS NOT NULL"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def _read(self, sql, params=()):
+        """统计类只读查询使用单独的连接，WAL模式下不阻塞入队和取件"""
+        with self._read_lock:
+            if self._read_conn is None:
+                with self._lock:
+                    self._connect()
+                self._read_conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            return self._read_conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _row_to_dict(row):
+        item = dict(row)
+        message = json.loads(item.pop("message"))
+        item["to"] = message.get("to")
+        item["subject"] = message.get("subject")
+        return item
+
+    def enqueue(self, message, delay=0):
+        """写入一条待发送消息，delay秒后才会被发送，返回队列ID"""
+        queue_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO email_queue (id, message, status, attempts, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, 'pending', 0, ?, ?, ?)",
+            (queue_id, json.dumps(message, ensure_ascii=False), now + delay, now, now)
+        )
+        return queue_id
+
+    def add_to_digest(self, message, key, window, max_items):
+        """把消息写入key对应的摘要，返回(摘要的队列ID, 摘要条数, 到期时间)
+
+        摘要的第一条消息在window秒后到期，后续消息沿用同一到期时间；
+        达到max_items时整封摘要立即到期，并换成只属于这封摘要的键封存，
+        之后的消息开启新的摘要，不会超过max_items条。
+        """
+        queue_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                head = conn.execute(
+                    "SELECT id, next_attempt_at FROM email_queue "
+                    "WHERE digest_key = ? AND status = 'pending' ORDER BY rowid LIMIT 1",
+                    (key,)
+                ).fetchone()
+                size = conn.execute(
+                    "SELECT COUNT(*) FROM email_queue WHERE digest_key = ? AND status = 'pending'", (key,)
+                ).fetchone()[0] + 1
+                deadline = head["next_attempt_at"] if head else now + window
+                head_id = head["id"] if head else queue_id
+                conn.execute(
+                    "INSERT INTO email_queue (id, message, status, attempts, next_attempt_at, created_at, updated_at, "
+                    "digest_key) VALUES (?, ?, 'pending', 0, ?, ?, ?, ?)",
+                    (queue_id, json.dumps(message, ensure_ascii=False), deadline, now, now, key)
+                )
+                if size >= max_items:
+                    deadline = now
+                    conn.execute(
+                        "UPDATE email_queue SET digest_key = ?, next_attempt_at = ?, updated_at = ? "
+                        "WHERE digest_key = ? AND status = 'pending'",
+                        (f"{key}\n#{head_id}", now, now, key)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return head_id, size, deadline
+
+    def _merge_digest(self, conn, key, now):
+        """把一封摘要的全部pending行合并到第一行，返回合并后的行"""
+        rows = conn.execute(
+            "SELECT id, message, attempts, created_at FROM email_queue "
+            "WHERE digest_key = ? AND status = 'pending' ORDER BY rowid",
+            (key,)
+        ).fetchall()
+        message = self.merge([json.loads(row["message"]) for row in rows])
+        conn.execute(
+            "UPDATE email_queue SET message = ?, digest_key = NULL, updated_at = ? WHERE id = ?",
+            (json.dumps(message, ensure_ascii=False), now, rows[0]["id"])
+        )
+        conn.executemany("DELETE FROM email_queue WHERE id = ?", [(row["id"],) for row in rows[1:]])
+        return {
+            "id": rows[0]["id"], "message": message,
+            "attempts": rows[0]["attempts"], "created_at": rows[0]["created_at"]
+        }
+
+    def claim_due(self, limit):
+        """取出到期的消息并标记为sending，同一摘要的消息合并为一条"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, message, attempts, created_at, digest_key FROM email_queue "
+                    "WHERE status = 'pending' AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                items = []
+                digests = set()
+                for row in rows:
+                    key = row["digest_key"]
+                    if key is None or self.merge is None:
+                        items.append({
+                            "id": row["id"], "message": json.loads(row["message"]),
+                            "attempts": row["attempts"], "created_at": row["created_at"]
+                        })
+                    elif key not in digests:
+                        digests.add(key)
+                        items.append(self._merge_digest(conn, key, now))
+                conn.executemany(
+                    "UPDATE email_queue SET status = 'sending', updated_at = ? WHERE id = ?",
+                    [(now, item["id"]) for item in items]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return items
+
+    def mark_sent(self, queue_id, result):
+        now = time.time()
+        self._execute(
+            "UPDATE email_queue SET status = 'sent', message_id = ?, thread_id = ?, last_error = NULL, "
+            "message = json_object('to', json_extract(message, '$.to'), 'subject', json_extract(message, '$.subject')), "
+            "next_attempt_at = ?, updated_at = ? WHERE id = ?",
+            (result.get("message_id"), result.get("thread_id"), now, now, queue_id)
+        )
+
+    def purge_sent(self, before):
+        """删除发送时间早于before的sent消息，分批执行，返回删除的行数"""
+        purged = 0
+        while True:
+            cursor = self._execute(
+                "DELETE FROM email_queue WHERE id IN ("
+                "SELECT id FROM email_queue WHERE status = 'sent' AND next_attempt_at < ? LIMIT ?)",
+                (before, self.PURGE_CHUNK)
+            )
+            purged += cursor.rowcount
+            if cursor.rowcount < self.PURGE_CHUNK:
+                return purged
+
+    def mark_failed(self, queue_id, attempts, error, permanent=False):
+        """记录一次失败，返回新的状态（pending或dead）；permanent为True时不再重试"""
+        now = time.time()
+        if permanent or attempts >= EMAIL_QUEUE_MAX_ATTEMPTS:
+            status = "dead"
+            next_attempt_at = now
+        else:
+            status = "pending"
+            delay = min(EMAIL_QUEUE_BACKOFF_BASE * (2 ** (attempts - 1)), EMAIL_QUEUE_BACKOFF_MAX)
+            next_attempt_at = now + delay * random.uniform(0.8, 1.2)
+        self._execute(
+            "UPDATE email_queue SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+            "updated_at = ? WHERE id = ?",
+            (status, attempts, next_attempt_at, error, now, queue_id)
+        )
+        return status
+
+    def release(self, queue_id, delay):
+        """不计失败次数地放回队列（例如发送线程池已满）"""
+        now = time.time()
+        self._execute(
+            "UPDATE email_queue SET status = 'pending', next_attempt_at = ?, updated_at = ? WHERE id = ?",
+            (now + delay, now, queue_id)
+        )
+
+    def requeue_inflight(self):
+        """将上次进程退出时未完成的消息放回队列"""
+        cursor = self._execute(
+            "UPDATE email_queue SET status = 'pending', updated_at = ? WHERE status = 'sending'",
+            (time.time(),)
+        )
+        return cursor.rowcount
+
+    def get(self, queue_id):
+        row = self._execute("SELECT * FROM email_queue WHERE id = ?", (queue_id,)).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def dead_letters(self, limit=100):
+        rows = self._execute(
+            "SELECT * FROM email_queue WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def seconds_until_next(self):
+        """距离下一条待发送消息到期的秒数，队列为空时返回None"""
+        row = self._execute(
+            "SELECT MIN(next_attempt_at) FROM email_queue WHERE status = 'pending'"
+        ).fetchone()
+        if row[0] is None:
+            return None
+        return max(row[0] - time.time(), 0)
+
+    def depth(self):
+        """按状态统计消息数；GROUP BY由(status, next_attempt_at)索引覆盖，不读表"""
+        rows = self._read("SELECT status, COUNT(*) FROM email_queue INDEXED BY idx_email_queue_due GROUP BY status")
+        return {row[0]: row[1] for row in rows}
+
+
+class EmailQueueDispatcher:
+    """后台发送协程，从EmailQueue中取出到期消息并通过发送线程池投递"""
+
+    # 清理过期sent消息的间隔（秒）
+    PURGE_INTERVAL = 300
+
+    def __init__(self, queue, batch_size):
+        self.queue = queue
+        self.batch_size = batch_size
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._next_purge = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """有新消息入队时唤醒调度协程，可在任意线程中调用"""
+        if self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _deliver(self, item):
+        message = item["message"]
+        try:
+            result = await send_pool.run(
+                email_transport.send, message["to"], message["subject"], message["body"],
+                is_html=message["is_html"]
+            )
+        except HTTPException as e:
+            if e.status_code == 503:
+                # 发送线程池已满或熔断器打开，按Retry-After稍后重试，不计入失败次数
+                await asyncio.to_thread(self.queue.release, item["id"], float((e.headers or {}).get("Retry-After", 1)))
+                return
+            if e.status_code == 429:
+                # 被限流时按Retry-After推迟，不计入失败次数
+                await asyncio.to_thread(self.queue.release, item["id"], float(e.headers.get("Retry-After", 1)))
+                return
+            if e.status_code in (401, 403):
+                # 认证或权限问题是发件账号的故障，不是这封邮件的问题：不计失败次数，退避后重试
+                delay = self._outage_delay(item)
+                log_event(logging.WARNING, "⚠️ 发送通道认证失败，稍后重试", queue_id=item['id'], delay=round(delay), error=e.detail)
+                await asyncio.to_thread(self.queue.release, item["id"], delay)
+                return
+            error = str(e.detail)
+            # 只有发送通道明确拒绝了这封邮件（例如收件地址无效）才不再重试
+            permanent = e.status_code == 400
+        except Exception as e:
+            error = str(e)
+            permanent = False
+        else:
+            await asyncio.to_thread(self.queue.mark_sent, item["id"], result)
+            publish_delivery(message, "sent", queue_id=item["id"], message_id=result.get("message_id"))
+            return
+
+        attempts = item["attempts"] + 1
+        status = await asyncio.to_thread(self.queue.mark_failed, item["id"], attempts, error, permanent=permanent)
+        publish_delivery(message, "dead" if status == "dead" else "failed", queue_id=item["id"], attempts=attempts, error=error)
+        if status == "dead":
+            log_event(logging.ERROR, "❌ 邮件重试耗尽，进入死信队列", queue_id=item['id'], attempts=attempts, error=error)
+        else:
+            log_event(logging.WARNING, "⚠️ 邮件发送失败，稍后重试", queue_id=item['id'], attempts=attempts, error=error)
+
+    @staticmethod
+    def _outage_delay(item):
+        """通道暂时不可用时的等待秒数：与消息已等待的时间相同（每次翻倍），不超过EMAIL_QUEUE_BACKOFF_MAX"""
+        waited = time.time() - item["created_at"]
+        return min(max(waited, EMAIL_QUEUE_BACKOFF_BASE), EMAIL_QUEUE_BACKOFF_MAX) * random.uniform(0.8, 1.2)
+
+    async def _purge(self):
+        """定期删除超过保留时间的sent消息"""
+        now = time.monotonic()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + self.PURGE_INTERVAL
+        try:
+            purged = await asyncio.to_thread(
+                self.queue.purge_sent, time.time() - EMAIL_QUEUE_SENT_RETENTION_HOURS * 3600
+            )
+            if purged:
+                log_event(logging.INFO, "🧹 已清理过期的已发送邮件", count=purged)
+        except Exception as e:
+            log_event(logging.WARNING, "⚠️ 清理已发送邮件失败", error=str(e))
+
+    async def _run(self):
+        # SQLite调用都放到线程中执行，不阻塞事件循环
+        requeued = await asyncio.to_thread(self.queue.requeue_inflight)
+        if requeued:
+            log_event(logging.INFO, "🔄 恢复未完成的排队邮件", count=requeued)
+        while True:
+            self._wakeup.clear()
+            await self._purge()
+            # 熔断器打开期间暂停取件，到期消息留在队列中等待半开试探
+            paused = email_circuit_breaker.open_remaining()
+            if paused:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(paused, EMAIL_QUEUE_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                batch = await asyncio.to_thread(self.queue.claim_due, self.batch_size)
+                if batch:
+                    await asyncio.gather(*(self._deliver(item) for item in batch))
+                    continue
+                timeout = await asyncio.to_thread(self.queue.seconds_until_next)
+            except Exception as e:
+                log_event(logging.ERROR, "❌ 发件队列调度失败", exc_info=True, error=str(e))
+                timeout = None
+            if timeout is None or timeout > EMAIL_QUEUE_POLL_INTERVAL:
+                timeout = EMAIL_QUEUE_POLL_INTERVAL
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def merge_digest_messages(messages):
+    """把同一摘要中的服药通知渲染为一封邮件，只有一条时直接使用原邮件"""
+    if len(messages) == 1:
+        message = messages[0]
+    else:
+        message = {
+            "to": messages[0]["to"],
+            "subject": messages[0]["subject"],
+            "body": generate_medication_digest_html([message["medication"] for message in messages]),
+            "is_html": True
+        }
+        # 看护人的摘要可能包含多位患者的通知，投递事件发给每一位
+        user_ids = list(dict.fromkeys(item["user_id"] for item in messages if item.get("user_id")))
+        if user_ids:
+            message["user_ids"] = user_ids
+    EMAIL_DIGEST_TOTAL.inc("flushed")
+    log_event(logging.INFO, "📨 摘要邮件已合并", sampled=True, to=redact_email(message["to"]), count=len(messages))
+    return message
+
+
+email_queue = EmailQueue(EMAIL_QUEUE_DB, merge=merge_digest_messages)
+email_dispatcher = EmailQueueDispatcher(email_queue, EMAIL_QUEUE_BATCH_SIZE)
+
+@app.on_event("startup")
+async def start_email_dispatcher():
+    email_dispatcher.start()
+
+@app.on_event("shutdown")
+async def stop_email_dispatcher():
+    await email_dispatcher.stop()
+
+class EmailDigestBuffer:
+    """按收件人合并服药通知
+
+    第一条通知到达时为(收件人, 主题)开启一个窗口，窗口内的后续通知作为同一摘要写入发件队列，
+    到期时间与第一条相同；达到max_items时整封摘要立即到期。发件队列取件时把摘要合并为一封
+    邮件，缓冲中的通知和普通队列消息一样在进程重启后仍会发送。add可在任意线程中调用。
+    """
+
+    def __init__(self, queue, window, max_items):
+        self.queue = queue
+        self.window = window
+        self.max_items = max_items
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, message):
+        """加入摘要，返回(状态码, 响应内容)"""
+        key = f"{message['to']}\n{message['subject']}"
+        queue_id, size, deadline = self.queue.add_to_digest(message, key, self.window, self.max_items)
+        EMAIL_DIGEST_TOTAL.inc("buffered")
+        if size == 1 or size >= self.max_items:
+            # 新摘要的到期时间可能早于调度协程的下一次轮询
+            email_dispatcher.notify()
+        return 202, {
+            "status": "buffered",
+            "message": "邮件已加入摘要，将与同一收件人的其他通知合并发送",
+            "data": {
+                "to": message["to"],
+                "subject": message["subject"],
+                "digest_size": size,
+                "flush_in": round(max(deadline - time.time(), 0), 1),
+                "queue_id": queue_id
+            }
+        }
+
+
+email_digest = EmailDigestBuffer(email_queue, EMAIL_DIGEST_WINDOW, EMAIL_DIGEST_MAX_ITEMS)
+
+def create_db_engine(url):
+    """创建数据库引擎，兼容Supabase常见的postgres://写法"""
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("sqlite"):
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(url, pool_pre_ping=True, pool_size=10, max_overflow=20)
+
+
+engine = create_db_engine(DATABASE_URL)
+
+class Medication(SQLModel, table=True):
+    """用户的药物及服用时间，每个服用时间一行"""
+
+    __tablename__ = "medications"
+    # 列表查询按 (user_id, time, id) 做keyset分页，复合索引覆盖过滤和排序
+    __table_args__ = (Index("ix_medications_user_time_id", "user_id", "time", "id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str = Field(max_length=64)
+    name: str = Field(max_length=255)
+    dosage: Optional[str] = Field(default=None, max_length=64)
+    frequency: Optional[str] = Field(default=None, max_length=64)
+    instructions: Optional[str] = None
+    time: str = Field(index=True, max_length=5)
+    reminder_email: Optional[str] = Field(default=None, max_length=255)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+def normalize_time(value):
+    """把"8:00"、"08:00:00"等写法统一为HH:MM，非法时抛出ValueError"""
+    parsed = datetime.strptime(str(value).strip()[:5].rstrip(':'), "%H:%M")
+    return parsed.strftime("%H:%M")
+
+def encode_cursor(medication):
+    return base64.urlsafe_b64encode(f"{medication.time}|{medication.id}".encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        time_value, medication_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return time_value, int(medication_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# 请求/响应模型。请求模型用AliasChoices兼容旧的字段名；响应模型让FastAPI用
+# pydantic-core校验和序列化返回值，端点以response_model_exclude_unset返回，
+# 只输出实际设置的字段，响应内容与原来的dict一致
+
+def loose_str(value):
+    """数字等非字符串值转为字符串，兼容客户端把ID、剂量写成数字"""
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+# 单个收件地址：不允许空白（包括CR/LF）、尖括号和逗号等，避免写入SMTP命令或邮件头时被拆成多行
+EMAIL_ADDRESS = re.compile(r"[^@\s<>()\[\],;:\\\"]+@[^@\s<>()\[\],;:\\\"]+")
+
+def email_address(value):
+    """校验收件地址，空字符串视为未填写"""
+    value = value.strip()
+    if not value:
+        return None
+    if not EMAIL_ADDRESS.fullmatch(value):
+        raise ValueError("Invalid email address")
+    return value
+
+LooseStr = Annotated[str, BeforeValidator(loose_str)]
+EmailAddress = Annotated[str, AfterValidator(email_address)]
+# StringConstraints必须写在BeforeValidator前面，否则约束不会生效
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1), BeforeValidator(loose_str)]
+
+def validation_error_message(error):
+    """把ValidationError的第一条错误转为一行文字"""
+    first = error.errors()[0]
+    location = ".".join(str(part) for part in first["loc"])
+    return f"{location}: {first['msg']}" if location else first["msg"]
+
+
+class MedicationCreate(BaseModel):
+    """POST /api/medications和批量导入的一行；time与times二选一，times也可以是分号分隔的字符串"""
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    user_id: Optional[LooseStr] = None
+    name: NonEmptyStr
+    dosage: Optional[LooseStr] = None
+    frequency: Optional[LooseStr] = None
+    instructions: Optional[LooseStr] = None
+    times: List[str] = PydanticField(validation_alias=AliasChoices("times", "time"))
+    reminder_email: Optional[EmailAddress] = PydanticField(
+        default=None, validation_alias=AliasChoices("reminder_email", "email")
+    )
+
+    @field_validator("times", mode="before")
+    @classmethod
+    def normalize_times(cls, value):
+        if isinstance(value, str):
+            value = value.split(';')
+        elif not isinstance(value, list):
+            value = [value]
+        try:
+            times = [normalize_time(item) for item in value if item]
+        except ValueError:
+            raise ValueError("Time must be in HH:MM format")
+        if not times:
+            raise ValueError("Medication time is required")
+        return times
+
+
+class MedicationRead(BaseModel):
+    id: int
+    user_id: str
+    name: str
+    dosage: Optional[str] = None
+    frequency: Optional[str] = None
+    instructions: Optional[str] = None
+    time: str
+    reminder_email: Optional[str] = None
+    created_at: datetime
+
+
+class MedicationCreateResponse(BaseModel):
+    status: str
+    message: str
+    medication: MedicationRead
+    medications: List[MedicationRead]
+
+
+class EmailRequest(BaseModel):
+    """POST /api/send-email的请求体
+
+    content_type为html或text时直接使用；省略时按正文是否像HTML判断（兼容旧客户端）。
+    """
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    to: Optional[EmailAddress] = PydanticField(default=None, validation_alias=AliasChoices("to", "email", "recipient", "to_email"))
+    subject: str = "药物提醒"
+    body: Optional[str] = PydanticField(default=None, validation_alias=AliasChoices("body", "message", "content"))
+    content_type: Optional[Literal["html", "text"]] = None
+    user_id: Optional[LooseStr] = None
+    medication_name: Optional[str] = None
+    scheduled_time: Optional[str] = None
+    status: Optional[str] = None
+
+
+class EmailDeliveryData(BaseModel):
+    to: str
+    subject: str
+    message_id: Optional[str] = None
+    thread_id: Optional[str] = None
+    account: Optional[str] = None
+    queue_id: Optional[str] = None
+    digest_size: Optional[int] = None
+    flush_in: Optional[float] = None
+
+
+class FamilyDeliveryResult(BaseModel):
+    member_id: int
+    name: str
+    to: str
+    status: str
+    status_code: int
+    replayed: Optional[bool] = None
+    error: Optional[Any] = None
+    subject: Optional[str] = None
+    message_id: Optional[str] = None
+    thread_id: Optional[str] = None
+    account: Optional[str] = None
+    queue_id: Optional[str] = None
+    digest_size: Optional[int] = None
+    flush_in: Optional[float] = None
+
+
+class FamilyDeliveryData(BaseModel):
+    user_id: str
+    total: int
+    succeeded: int
+    failed: int
+    results: List[FamilyDeliveryResult]
+
+
+class EmailSendResponse(BaseModel):
+    status: str
+    message: str
+    data: Union[EmailDeliveryData, FamilyDeliveryData]
+
+
+class BatchSendResult(BaseModel):
+    """批量发送的一条结果，各发送通道附带的其他字段原样保留"""
+
+    model_config = ConfigDict(extra="allow")
+
+    index: int
+    status: str
+    to: Optional[str] = None
+    subject: Optional[str] = None
+    message_id: Optional[str] = None
+    error: Optional[Any] = None
+
+
+class BatchSendData(BaseModel):
+    total: int
+    succeeded: int
+    queued: int = 0
+    failed: int
+    results: List[BatchSendResult]
+
+
+class BatchSendResponse(BaseModel):
+    status: str
+    message: str
+    data: BatchSendData
+
+
+class ReminderRequest(BaseModel):
+    """POST /api/gmail/send-reminder的请求体"""
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    to: Optional[EmailAddress] = PydanticField(default=None, validation_alias=AliasChoices("to", "email", "reminder_email"))
+    medication_name: str = PydanticField(default="薬", validation_alias=AliasChoices("medication_name", "name"))
+    scheduled_time: str = PydanticField(default="09:00", validation_alias=AliasChoices("scheduled_time", "time"))
+    user_id: Optional[LooseStr] = None
+
+
+class ReminderQueuedData(BaseModel):
+    to: str
+    medication_name: str
+    scheduled_time: str
+    queue_id: str
+
+
+class ReminderQueuedResponse(BaseModel):
+    status: str
+    message: str
+    data: ReminderQueuedData
+
+INTAKE_STATUSES = ("taken", "late", "missed", "postponed")
+ADHERENCE_PERIODS = ("day", "week", "month")
+
+class IntakeEvent(SQLModel, table=True):
+    """服药记录事件，只追加不修改
+
+    同一次服药（用户、药物、日期、预定时间）状态变化时追加新事件，以最新一条为准。
+    """
+
+    __tablename__ = "intake_events"
+    __table_args__ = (
+        Index("ix_intake_events_dose", "user_id", "date", "medication_id", "scheduled_time", "id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str = Field(max_length=64)
+    medication_id: int
+    medication_name: Optional[str] = Field(default=None, max_length=255)
+    date: str = Field(max_length=10)
+    scheduled_time: str = Field(max_length=5)
+    taken_time: Optional[str] = Field(default=None, max_length=5)
+    status: str = Field(max_length=16)
+    recorded_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class AdherenceRollup(SQLModel, table=True):
+    """按日/周/月预先汇总的服药统计，写入服药记录时增量更新
+
+    medication_id为0的行是该用户所有药物的合计；周从星期一开始。
+    """
+
+    __tablename__ = "adherence_rollups"
+    __table_args__ = (
+        UniqueConstraint("user_id", "medication_id", "period", "period_start", name="uq_adherence_rollups_key"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str = Field(max_length=64)
+    medication_id: int
+    period: str = Field(max_length=8)
+    period_start: str = Field(max_length=10)
+    total: int = 0
+    taken: int = 0
+    late: int = 0
+    missed: int = 0
+    postponed: int = 0
+
+
+class DoseState(SQLModel, table=True):
+    """每次服药（用户、药物、日期、预定时间）的当前状态
+
+    写入服药记录时先锁住这一行，同一次服药的并发记录因此串行执行，汇总计数按旧状态增减。
+    """
+
+    __tablename__ = "dose_states"
+    __table_args__ = (
+        UniqueConstraint("user_id", "medication_id", "date", "scheduled_time", name="uq_dose_states_dose"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str = Field(max_length=64)
+    medication_id: int
+    date: str = Field(max_length=10)
+    scheduled_time: str = Field(max_length=5)
+    status: Optional[str] = Field(default=None, max_length=16)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+def period_starts(day):
+    """返回某一天所属的日、周、月的起始日期（YYYY-MM-DD）"""
+    return {
+        "day": day.isoformat(),
+        "week": (day - timedelta(days=day.weekday())).isoformat(),
+        "month": day.replace(day=1).isoformat()
+    }
+
+def _upsert_rollup(session, key, deltas):
+    """把计数变化累加到一行汇总上，行不存在时插入"""
+    table = AdherenceRollup.__table__
+    insert = postgresql_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+    statement = insert(table).values(**key, **{column: max(delta, 0) for column, delta in deltas.items()})
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "medication_id", "period", "period_start"],
+        set_={column: table.c[column] + delta for column, delta in deltas.items()}
+    )
+    session.exec(statement)
+
+def _lock_dose_state(session, dose):
+    """确保这次服药的状态行存在并加锁，返回记录前的状态（首次记录为None）
+
+    PostgreSQL用SELECT ... FOR UPDATE锁行；SQLite的插入会占用写锁直到提交，效果相同。
+    """
+    table = DoseState.__table__
+    insert = postgresql_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+    session.exec(
+        insert(table).values(**dose).on_conflict_do_nothing(
+            index_elements=["user_id", "medication_id", "date", "scheduled_time"]
+        )
+    )
+    conditions = [table.c[column] == value for column, value in dose.items()]
+    previous = session.exec(select(DoseState.status).where(*conditions).with_for_update()).one()
+    return conditions, previous
+
+def record_intake_event(session, event):
+    """追加一条服药记录并增量更新相关的汇总行，调用方负责提交
+
+    同一次服药已有记录时只把计数从旧状态移到新状态，总数不变。旧状态取自加锁的dose_states行，
+    并发写入同一次服药时计数也不会重复。
+    """
+    dose = {
+        "user_id": event.user_id,
+        "medication_id": event.medication_id,
+        "date": event.date,
+        "scheduled_time": event.scheduled_time
+    }
+    conditions, previous = _lock_dose_state(session, dose)
+    session.add(event)
+    
+    deltas = {event.status: 1}
+    if previous is None:
+        deltas["total"] = 1
+    elif previous == event.status:
+        return
+    else:
+        deltas[previous] = -1
+    session.exec(
+        update(DoseState.__table__).where(*conditions).values(status=event.status, updated_at=datetime.utcnow())
+    )
+    
+    day = datetime.strptime(event.date, "%Y-%m-%d").date()
+    for period, period_start in period_starts(day).items():
+        for medication_id in {event.medication_id, 0}:
+            key = {
+                "user_id": event.user_id,
+                "medication_id": medication_id,
+                "period": period,
+                "period_start": period_start
+            }
+            _upsert_rollup(session, key, deltas)
+
+def adherence_rate(counts):
+    """按时和延迟服用都算已服用，返回百分比"""
+    if not counts["total"]:
+        return 0.0
+    return round((counts["taken"] + counts["late"]) / counts["total"] * 100, 1)
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field} must be in YYYY-MM-DD format")
+
+FAMILY_CONTACT_METHODS = ("email", "sms", "both", "line")
+
+class FamilyGroup(SQLModel, table=True):
+    """患者的家人组，每个患者一个"""
+
+    __tablename__ = "family_groups"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    patient_user_id: str = Field(max_length=64, unique=True)
+    name: Optional[str] = Field(default=None, max_length=255)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class FamilyMember(SQLModel, table=True):
+    """家人组中的一位家人或看护人
+
+    preferred_method为email或both且有邮箱的成员接收邮件通知。
+    """
+
+    __tablename__ = "family_members"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    group_id: int = Field(index=True)
+    name: str = Field(max_length=255)
+    relationship: Optional[str] = Field(default=None, max_length=64)
+    email: Optional[str] = Field(default=None, max_length=255)
+    phone: Optional[str] = Field(default=None, max_length=64)
+    preferred_method: str = Field(default="email", max_length=8)
+    line_user_id: Optional[str] = Field(default=None, max_length=64)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class FamilyInvite(SQLModel, table=True):
+    """加入家人组的邀请码，有效期内可被多位家人使用"""
+
+    __tablename__ = "family_invites"
+
+    code: str = Field(primary_key=True, max_length=32)
+    group_id: int
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+
+
+class FamilyRecipientCache:
+    """患者user_id -> 接收邮件通知的家人列表的缓存
+
+    按LRU淘汰，条目TTL秒后过期；成员变化时调用invalidate。invalidate会使
+    正在从数据库加载的结果作废，避免并发加载把旧名单写回缓存。线程安全。
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # user_id -> (加载时间, 收件人元组)
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_id):
+        """只查缓存，未命中或已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def load(self, user_id, loader):
+        """调用loader(user_id)加载并写入缓存，会访问数据库，不要在事件循环中直接调用"""
+        with self._lock:
+            generation = self._generation
+        now = time.monotonic()
+        recipients = tuple(loader(user_id))
+        with self._lock:
+            if self._generation == generation:
+                self._entries[user_id] = (now, recipients)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return recipients
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def load_family_recipients(user_id):
+    """从数据库读取患者的邮件收件人，返回[{"member_id", "name", "email"}]"""
+    statement = (
+        select(FamilyMember)
+        .join(FamilyGroup, FamilyGroup.id == FamilyMember.group_id)
+        .where(FamilyGroup.patient_user_id == user_id)
+        .where(FamilyMember.email.is_not(None))
+        .where(FamilyMember.preferred_method.in_(("email", "both")))
+        .order_by(FamilyMember.id)
+    )
+    with Session(engine) as session:
+        members = session.exec(statement).all()
+    return [{"member_id": member.id, "name": member.name, "email": member.email} for member in members]
+
+
+family_recipients = FamilyRecipientCache(FAMILY_CACHE_TTL, FAMILY_CACHE_MAX_ENTRIES)
+
+def get_or_create_family_group(session, user_id):
+    group = session.exec(select(FamilyGroup).where(FamilyGroup.patient_user_id == user_id)).first()
+    if group is None:
+        group = FamilyGroup(patient_user_id=user_id)
+        session.add(group)
+        session.flush()
+    return group
+
+def family_member_values(member):
+    """校验家人payload，返回FamilyMember的字段"""
+    name = (member.get('name') or member.get('nickname') or '').strip()
+    if not name:
+        raise HTTPException(status_code=400, detail="Family member name is required")
+    email = (member.get('email') or '').strip() or None
+    line_user_id = member.get('line_user_id') or None
+    method = member.get('preferred_method') or member.get('preferredMethod') or ("email" if email else "line")
+    if method not in FAMILY_CONTACT_METHODS:
+        raise HTTPException(status_code=400, detail=f"preferred_method must be one of {', '.join(FAMILY_CONTACT_METHODS)}")
+    if method in ("email", "both") and not email:
+        raise HTTPException(status_code=400, detail="Email is required for email notifications")
+    if email and not EMAIL_ADDRESS.fullmatch(email):
+        raise HTTPException(status_code=400, detail="Invalid email address")
+    return {
+        "name": name,
+        "relationship": member.get('relationship'),
+        "email": email,
+        "phone": member.get('phone'),
+        "preferred_method": method,
+        "line_user_id": line_user_id
+    }
+
+@app.on_event("startup")
+def create_db_tables():
+    """创建数据库表，数据库不可用时跳过"""
+    try:
+        SQLModel.metadata.create_all(engine)
+        log_event(logging.INFO, "✅ 数据库已就绪")
+    except Exception as e:
+        log_event(logging.WARNING, "⚠️ 数据库未就绪", error=str(e))
+
+def build_reminder_message(to_email, medication_name, scheduled_time, user_id=None):
+    """生成服药提醒邮件，复用服药通知模板"""
+    medication = {
+        "medication_name": medication_name,
+        "scheduled_time": scheduled_time,
+        "taken_time": "-",
+        "status": "未服用"
+    }
+    body = generate_medication_email_html(**medication)
+    message = {"to": to_email, "subject": REMINDER_SUBJECT, "body": body, "is_html": True, "medication": medication}
+    if user_id:
+        message["user_id"] = user_id
+    return message
+
+class ReminderScheduler:
+    """服药提醒调度器
+
+    每个药物的下一次服用时间放在最小堆中，调度协程只在最早的时间到期或
+    有更早的新计划加入时醒来，不轮询整张表。到期的提醒写入持久化发件队列，
+    由发件调度协程通过配置的发送通道发送，然后重新排到第二天。
+    修改计划时旧的堆条目不立即移除，出堆时与_due比对后丢弃；药物被删除或
+    取消提醒邮箱时，到期时在fire中跳过且不再重新排期。clock返回当前时间
+    （带时区的datetime），测试时可以替换。
+    """
+
+    def __init__(self, clock=None):
+        self._clock = clock or (lambda: datetime.now(REMINDER_TIMEZONE))
+        self._heap = []
+        self._due = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    @staticmethod
+    def next_due(time_value, now=None):
+        """返回HH:MM在now之后的下一次出现时刻（时间戳）"""
+        now = now or datetime.now(REMINDER_TIMEZONE)
+        hour, minute = map(int, time_value.split(":"))
+        due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if due <= now:
+            due += timedelta(days=1)
+        return due.timestamp()
+
+    def schedule(self, medication_id, time_value):
+        """加入或更新一个药物的提醒计划，可在任意线程中调用"""
+        due = self.next_due(time_value, self._clock())
+        with self._lock:
+            self._due[medication_id] = due
+            heapq.heappush(self._heap, (due, medication_id))
+            earliest = self._heap[0][1] == medication_id
+        if earliest:
+            self._notify()
+
+    def _notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _pop_due(self, now):
+        due_ids = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, medication_id = heapq.heappop(self._heap)
+                if self._due.get(medication_id) == due:
+                    del self._due[medication_id]
+                    due_ids.append(medication_id)
+        return due_ids
+
+    def _seconds_until_next(self):
+        with self._lock:
+            # 顺便丢弃堆顶的过期条目
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - self._clock().timestamp(), 0)
+
+    def load_all(self):
+        """启动时从数据库加载全部提醒计划，一次性建堆"""
+        now = self._clock()
+        entries = []
+        with Session(engine) as session:
+            statement = select(Medication.id, Medication.time).where(Medication.reminder_email.is_not(None))
+            for medication_id, time_value in session.exec(statement.execution_options(yield_per=1000)):
+                entries.append((self.next_due(time_value, now), medication_id))
+        with self._lock:
+            for due, medication_id in entries:
+                self._due.setdefault(medication_id, due)
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+        return len(entries)
+
+    def fire(self, medication_ids):
+        """将到期的提醒写入发件队列，并重新排到下一次服用时间"""
+        with Session(engine) as session:
+            medications = session.exec(select(Medication).where(Medication.id.in_(medication_ids))).all()
+        for medication in medications:
+            if not medication.reminder_email:
+                continue
+            event = {"medication_id": medication.id, "medication_name": medication.name, "scheduled_time": medication.time}
+            try:
+                message = build_reminder_message(
+                    medication.reminder_email, medication.name, medication.time, user_id=medication.user_id
+                )
+                if email_digest.enabled:
+                    email_digest.add(message)
+                else:
+                    email_queue.enqueue(message)
+                event_broker.publish(medication.user_id, "reminder", {"status": "fired", **event})
+            except Exception as e:
+                log_event(logging.ERROR, "❌ 服药提醒入队失败", medication_id=medication.id, error=str(e))
+                event_broker.publish(medication.user_id, "reminder", {"status": "failed", "error": str(e), **event})
+            self.schedule(medication.id, medication.time)
+        if medications:
+            email_dispatcher.notify()
+        return len(medications)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        try:
+            loaded = await asyncio.to_thread(self.load_all)
+            log_event(logging.INFO, "⏰ 已加载服药提醒计划", count=loaded)
+        except Exception as e:
+            log_event(logging.WARNING, "⚠️ 加载服药提醒计划失败", error=str(e))
+        while True:
+            self._wakeup.clear()
+            due_ids = self._pop_due(self._clock().timestamp())
+            if due_ids:
+                try:
+                    fired = await asyncio.to_thread(self.fire, due_ids)
+                    log_event(logging.INFO, "⏰ 触发服药提醒", count=fired)
+                except Exception as e:
+                    log_event(logging.ERROR, "❌ 触发服药提醒失败", exc_info=True, error=str(e))
+                continue
+            # 最长睡眠1小时，防止系统时间跳变导致错过提醒
+            timeout = self._seconds_until_next()
+            timeout = 3600 if timeout is None else min(timeout, 3600)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+reminder_scheduler = ReminderScheduler()
+
+@app.on_event("startup")
+async def start_reminder_scheduler():
+    if REMINDER_SCHEDULER_ENABLED:
+        reminder_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_reminder_scheduler():
+    await reminder_scheduler.stop()
+
+class ReadinessProbe:
+    """后台定期刷新的依赖探测结果
+
+    探测（token文件、数据库连接、发件队列深度）在后台线程中每
+    READINESS_PROBE_INTERVAL秒执行一次，/health/ready、/api/gmail/status
+    和/metrics只读取缓存的结果，频繁轮询不产生磁盘或网络I/O。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.snapshot = {"ready": False, "checked_at": None, "checks": {}}
+        self._task = None
+
+    @staticmethod
+    def check_gmail():
+        """检查每个发件账号的凭证；顶层字段汇总全部账号，client为主账号的状态"""
+        accounts = {account.name: ReadinessProbe.check_gmail_account(account) for account in gmail_accounts.accounts}
+        token_valid = any(account["token_valid"] for account in accounts.values())
+        return {
+            "credentials_file_exists": any(account["credentials_file_exists"] for account in accounts.values()),
+            "token_file_exists": any(account["token_file_exists"] for account in accounts.values()),
+            "token_valid": token_valid,
+            "gmail_api_ready": any(account["gmail_api_ready"] for account in accounts.values()),
+            "auth_required": not token_valid,
+            "client": accounts[gmail_accounts.primary.name]["client"],
+            "accounts": accounts
+        }
+
+    @staticmethod
+    def check_gmail_account(account):
+        credentials_file = account.client.credentials_file
+        token_file = account.client.token_file
+        
+        # 检查token是否有效
+        token_valid = False
+        if os.path.exists(token_file):
+            try:
+                with open(token_file, 'r') as f:
+                    token_data = f.read().strip()
+                    token_valid = bool(token_data and token_data != '{}')
+            except OSError:
+                pass
+        
+        credentials_file_exists = os.path.exists(credentials_file)
+        return {
+            "credentials_file_exists": credentials_file_exists,
+            "token_file_exists": os.path.exists(token_file),
+            "token_valid": token_valid,
+            "gmail_api_ready": credentials_file_exists and token_valid,
+            "auth_required": not token_valid,
+            "client": account.client.state()
+        }
+
+    @staticmethod
+    def check_database():
+        started = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+    @staticmethod
+    def check_queue():
+        try:
+            return {"ok": True, "depth": email_queue.depth()}
+        except Exception as e:
+            return {"ok": False, "error": str(e), "depth": {}}
+
+    def collect(self):
+        """执行一次全部探测并更新缓存"""
+        checks = {
+            "gmail": self.check_gmail(),
+            "database": self.check_database(),
+            "email_queue": self.check_queue()
+        }
+        self.snapshot = {
+            # Gmail未认证时仍可接收请求（可写入发件队列），不影响就绪状态
+            "ready": checks["database"]["ok"] and checks["email_queue"]["ok"],
+            "checked_at": datetime.utcnow().isoformat() + "Z",
+            "checks": checks
+        }
+        return self.snapshot
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.collect)
+            except Exception as e:
+                log_event(logging.ERROR, "❌ 就绪探测失败", exc_info=True, error=str(e))
+            await asyncio.sleep(self.interval)
+
+
+readiness_probe = ReadinessProbe(READINESS_PROBE_INTERVAL)
+
+@app.on_event("startup")
+async def start_readiness_probe():
+    readiness_probe.start()
+
+@app.on_event("shutdown")
+async def stop_readiness_probe():
+    await readiness_probe.stop()
+
+# 健康检查端点
+@app.get("/health")
+async def health_check():
+    return {"status": "healthy", "message": "LINE Reminder Bot API is running"}
+
+@app.get("/health/live")
+async def liveness_check():
+    """存活探测：进程能处理请求即可"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness_check(response: Response):
+    """就绪探测：返回后台缓存的依赖状态，未就绪时返回503"""
+    snapshot = readiness_probe.snapshot
+    if not snapshot["ready"]:
+        response.status_code = 503
+    return {
+        "status": "ready" if snapshot["ready"] else "not_ready",
+        "checked_at": snapshot["checked_at"],
+        "checks": snapshot["checks"],
+        "send_pool": send_pool.stats()
+    }
+
+# 根端点
+@app.get("/")
+async def root():
+    return {
+        "message": "LINE Reminder Bot API",
+        "version": "1.0.0",
+        "docs": "/docs",
+        "health": "/health",
+        "readiness": "/health/ready"
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus文本格式的指标"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    lines.append("# HELP email_send_pool_pending Sends running or waiting in the send pool")
+    lines.append("# TYPE email_send_pool_pending gauge")
+    lines.append(f"email_send_pool_pending {send_pool.pending}")
+    lines.append("# HELP email_circuit_breaker_state Email transport circuit breaker state (0 closed, 1 half-open, 2 open)")
+    lines.append("# TYPE email_circuit_breaker_state gauge")
+    breaker_state = {"closed": 0, "half_open": 1, "open": 2}[email_circuit_breaker.snapshot()["state"]]
+    lines.append(f"email_circuit_breaker_state {breaker_state}")
+    lines.append("# HELP email_queue_messages Messages in the durable email queue by status")
+    lines.append("# TYPE email_queue_messages gauge")
+    queue_depth = readiness_probe.snapshot["checks"].get("email_queue", {}).get("depth", {})
+    for status, count in queue_depth.items():
+        lines.append(f'email_queue_messages{{status="{status}"}} {count}')
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/api/startup-report")
+async def startup_report():
+    """启动耗时报告：模块导入、延迟导入的依赖和Gmail预热各自的耗时（毫秒）
+
+    imports把module_import拆分为各组依赖（pydantic、fastapi、sqlalchemy等）和
+    本模块自身定义（module_body）的耗时。
+    """
+    return {
+        "startup": {name: round(seconds * 1000, 1) for name, seconds in STARTUP_TIMINGS.items()},
+        "imports": {name: round(seconds * 1000, 1) for name, seconds in IMPORT_TIMINGS.items()},
+        "lazy_imports": {name: round(seconds * 1000, 1) for name, seconds in google_libs.timings.items()}
+    }
+
+# Gmail API相关端点
+@app.get("/api/gmail/status")
+async def gmail_status():
+    """检查Gmail API状态（读取后台缓存的探测结果），accounts中附带每个发件账号的轮换状态"""
+    checks = readiness_probe.snapshot["checks"]
+    gmail = checks.get("gmail") or await asyncio.to_thread(ReadinessProbe.check_gmail)
+    rotation = gmail_accounts.stats()
+    accounts = {name: {**gmail["accounts"].get(name, {}), **rotation[name]} for name in rotation}
+    return {
+        **gmail,
+        "accounts": accounts,
+        "checked_at": readiness_probe.snapshot["checked_at"],
+        "send_pool": send_pool.stats(),
+        "transport": email_transport.stats(),
+        "circuit_breaker": email_circuit_breaker.snapshot(),
+        "event_stream": event_broker.stats(),
+        "email_queue": checks.get("email_queue", {}).get("depth", {})
+    }
+
+def get_gmail_account(name):
+    """按名称查找发件账号，未指定时返回主账号"""
+    if not name:
+        return gmail_accounts.primary
+    account = gmail_accounts.get(name)
+    if account is None:
+        raise HTTPException(status_code=404, detail="Gmail sender account not found")
+    return account
+
+@app.get("/api/gmail/auth")
+async def gmail_auth(account: Optional[str] = None):
+    """启动Gmail OAuth认证流程，account指定要认证的发件账号"""
+    try:
+        sender = get_gmail_account(account)
+        credentials_file = sender.client.credentials_file
+        
+        if not os.path.exists(credentials_file):
+            raise HTTPException(status_code=500, detail="Gmail credentials file not found")
+        
+        # 创建OAuth流程，指定重定向URI
+        flow = google_libs.flow.InstalledAppFlow.from_client_secrets_file(
+            credentials_file, 
+            SCOPES,
+            redirect_uri='http://localhost:8000/api/gmail/auth/callback'
+        )
+        
+        # 生成授权URL，state带上账号名称，回调时据此写入对应的token文件
+        auth_url, _ = flow.authorization_url(
+            prompt='consent',
+            access_type='offline',
+            state=sender.name
+        )
+        
+        return {
+            "status": "auth_required",
+            "message": "请在浏览器中完成Gmail认证",
+            "account": sender.name,
+            "auth_url": auth_url,
+            "instructions": [
+                "1. 点击上面的auth_url链接",
+                "2. 在Google页面登录并授权",
+                "3. 授权成功后会自动重定向",
+                "4. 检查认证状态"
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to start auth flow: {str(e)}")
+
+@app.get("/api/gmail/auth/callback")
+async def gmail_auth_callback(code: str = None, state: str = None):
+    """处理OAuth回调"""
+    try:
+        if not code:
             raise HTTPException(status_code=400, detail="Authorization code is required")
         
-        credentials_file = os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
-        token_file = os.getenv("GMAIL_TOKEN_FILE", "token.json")
+        sender = gmail_accounts.get(state) or gmail_accounts.primary
+        credentials_file = sender.client.credentials_file
+        token_file = sender.client.token_file
         
         # 创建OAuth流程，指定重定向URI
-        flow = InstalledAppFlow.from_client_secrets_file(
+        flow = google_libs.flow.InstalledAppFlow.from_client_secrets_file(
             credentials_file, 
             SCOPES,
             redirect_uri='http://localhost:8000/api/gmail/auth/callback'
@@ -445,9 +3900,12 @@ async def gmail_auth_callback(code: str = None, state: str = None):
         # 交换授权码获取token
         flow.fetch_token(code=code)
         
-        # 保存token
-        with open(token_file, 'w') as token:
-            token.write(flow.credentials.to_json())
+        # 保存token，原子替换避免其他worker读到写了一半的文件
+        write_file_atomic(token_file, flow.credentials.to_json())
+        sender.client.invalidate()
+        gmail_accounts.reset(sender)
+        # 立即刷新探测结果，让状态端点马上反映认证成功
+        await asyncio.to_thread(readiness_probe.collect)
         
         # 返回HTML页面显示成功信息
         html_content = """
@@ -494,98 +3952,921 @@ async def gmail_auth_callback(code: str = None, state: str = None):
         from fastapi.responses import HTMLResponse
         return HTMLResponse(content=error_html, status_code=500)
 
-@app.post("/api/gmail/send-reminder")
-async def send_reminder(medication_data: dict):
-    """发送药物提醒邮件"""
+@app.post("/api/gmail/send-reminder", response_model=ReminderQueuedResponse)
+async def send_reminder(medication_data: ReminderRequest, response: Response):
+    """立即发送药物提醒邮件（写入发件队列）"""
+    to_email = medication_data.to
+    if not to_email:
+        raise HTTPException(status_code=400, detail="Recipient email is required")
+    medication_name = medication_data.medication_name or '薬'
+    scheduled_time = medication_data.scheduled_time or '09:00'
+    
+    message = build_reminder_message(to_email, medication_name, scheduled_time, user_id=medication_data.user_id)
+    queue_id = await asyncio.to_thread(email_queue.enqueue, message)
+    email_dispatcher.notify()
+    publish_delivery(message, "queued", queue_id=queue_id)
+    response.status_code = 202
     return {
-        "status": "success",
-        "message": "药物提醒邮件发送成功（演示模式）",
-        "data": medication_data
+        "status": "queued",
+        "message": "药物提醒邮件已加入发送队列",
+        "data": {
+            "to": to_email,
+            "medication_name": medication_name,
+            "scheduled_time": scheduled_time,
+            "queue_id": queue_id
+        }
     }
 
 # 药物管理端点
 @app.get("/api/medications")
-async def get_medications():
-    """获取药物列表"""
+def get_medications(
+    user_id: str = "default",
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """获取药物列表
+
+    按服用时间排序，from_time/to_time（HH:MM，含端点）筛选时间窗口，
+    cursor为上一页返回的next_cursor。
+    """
+    limit = max(1, min(limit, MEDICATION_PAGE_SIZE_MAX))
+    try:
+        from_time = normalize_time(from_time) if from_time else None
+        to_time = normalize_time(to_time) if to_time else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Time must be in HH:MM format")
+    
+    statement = select(Medication).where(Medication.user_id == user_id)
+    if from_time:
+        statement = statement.where(Medication.time >= from_time)
+    if to_time:
+        statement = statement.where(Medication.time <= to_time)
+    if cursor:
+        cursor_time, cursor_id = decode_cursor(cursor)
+        statement = statement.where(or_(
+            Medication.time > cursor_time,
+            (Medication.time == cursor_time) & (Medication.id > cursor_id)
+        ))
+    statement = statement.order_by(Medication.time, Medication.id).limit(limit + 1)
+    
+    with Session(engine) as session:
+        medications = session.exec(statement).all()
+    
+    next_cursor = None
+    if len(medications) > limit:
+        medications = medications[:limit]
+        next_cursor = encode_cursor(medications[-1])
+    
     return {
-        "medications": [
-            {
-                "id": 1,
-                "name": "阿司匹林",
-                "dosage": "100mg",
-                "frequency": "每日一次",
-                "time": "08:00"
-            }
-        ]
+        "medications": [medication.model_dump() for medication in medications],
+        "next_cursor": next_cursor
     }
 
-@app.post("/api/medications")
-async def add_medication(medication: dict):
-    """添加新药物"""
+def medication_values(medication, default_user_id="default"):
+    """把已校验的MedicationCreate展开为medications表的列值列表，每个服用时间一条
+
+    返回普通dict而不是Medication实例，批量导入时省去ORM对象的构造开销。
+    """
+    created_at = datetime.utcnow()
+    return [
+        {
+            "user_id": medication.user_id or default_user_id,
+            "name": medication.name,
+            "dosage": medication.dosage,
+            "frequency": medication.frequency,
+            "instructions": medication.instructions,
+            "time": time_value,
+            "reminder_email": medication.reminder_email or None,
+            "created_at": created_at
+        }
+        for time_value in medication.times
+    ]
+
+@app.post("/api/medications", response_model=MedicationCreateResponse, response_model_exclude_unset=True)
+def add_medication(medication: MedicationCreate):
+    """添加新药物
+
+    times为服用时间列表时，每个时间保存为一条记录。
+    """
+    rows = [Medication(**values) for values in medication_values(medication)]
+    with Session(engine) as session:
+        session.add_all(rows)
+        session.commit()
+        for row in rows:
+            session.refresh(row)
+        saved = [row.model_dump() for row in rows]
+    
+    for row in rows:
+        if row.reminder_email:
+            reminder_scheduler.schedule(row.id, row.time)
+    
     return {
         "status": "success",
         "message": "药物添加成功",
-        "medication": medication
+        "medication": saved[0],
+        "medications": saved
+    }
+
+async def iter_request_lines(request, max_line):
+    """逐行读取请求体，内存占用只与单行长度有关"""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        if len(buffer) > max_line:
+            raise HTTPException(status_code=413, detail=f"Line too long (max {max_line} bytes)")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8", errors="replace")
+    if buffer:
+        yield buffer.rstrip(b"\r").decode("utf-8", errors="replace")
+
+async def iter_ndjson_records(lines):
+    """NDJSON：每行一个JSON对象，产出(行号, dict或错误信息)"""
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_number, "Each line must be a JSON object"
+            continue
+        yield line_number, record
+
+async def iter_csv_records(lines):
+    """CSV：第一行为表头，支持引号内换行，产出(起始行号, dict或错误信息)"""
+    header = None
+    pending = []
+    quotes = 0
+    line_number = 0
+    start = 0
+    async for line in lines:
+        line_number += 1
+        if not pending:
+            start = line_number
+            if not line.strip():
+                continue
+        pending.append(line + "\n")
+        # 引号数为奇数说明字段内有换行，记录还没结束
+        quotes += line.count('"')
+        if quotes % 2:
+            if sum(len(part) for part in pending) > MEDICATION_IMPORT_MAX_LINE:
+                raise HTTPException(status_code=413, detail=f"Record too long (max {MEDICATION_IMPORT_MAX_LINE} bytes)")
+            continue
+        try:
+            values = next(csv.reader(pending))
+        except csv.Error as e:
+            values = e
+        pending = []
+        quotes = 0
+        if isinstance(values, csv.Error):
+            yield start, f"Invalid CSV: {values}"
+        elif header is None:
+            header = [column.strip().lower() for column in values]
+        elif len(values) != len(header):
+            yield start, f"Expected {len(header)} columns, got {len(values)}"
+        else:
+            yield start, {column: value.strip() or None for column, value in zip(header, values)}
+    if pending:
+        yield start, "Unterminated quoted field"
+
+def insert_medication_batch(rows):
+    """一条多行INSERT写入一批药物，返回(id, time, reminder_email)列表"""
+    statement = insert(Medication).returning(Medication.id, Medication.time, Medication.reminder_email)
+    with engine.begin() as connection:
+        return connection.execute(statement, rows).all()
+
+@app.post("/api/medications/import")
+async def import_medications(request: Request, fmt: Optional[str] = Query(None, alias="format"), user_id: str = "default"):
+    """批量导入药物
+
+    请求体为NDJSON（每行一个与POST /api/medications相同的对象）或带表头的CSV，
+    format省略时按Content-Type判断。边读边校验，每MEDICATION_IMPORT_BATCH_SIZE行
+    插入一次，行内未指定user_id时使用查询参数user_id。校验或写入失败的行逐行返回，
+    其余行照常导入。
+    """
+    if fmt is None:
+        fmt = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    
+    started = time.perf_counter()
+    lines = iter_request_lines(request, MEDICATION_IMPORT_MAX_LINE)
+    records = iter_csv_records(lines) if fmt == "csv" else iter_ndjson_records(lines)
+    total = imported = failed = 0
+    errors = []
+    batch = []
+    
+    def add_error(line_number, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MEDICATION_IMPORT_MAX_ERRORS:
+            errors.append({"line": line_number, "error": error})
+    
+    async def flush():
+        nonlocal imported
+        rows = [row for _, medications in batch for row in medications]
+        try:
+            saved = await asyncio.to_thread(insert_medication_batch, rows)
+        except Exception as e:
+            log_event(logging.ERROR, "❌ 批量导入药物写入失败", exc_info=True, rows=len(rows), error=str(e))
+            for line_number, _ in batch:
+                add_error(line_number, f"Database error: {str(e)}")
+        else:
+            imported += len(batch)
+            for medication_id, time_value, reminder_email in saved:
+                if reminder_email:
+                    reminder_scheduler.schedule(medication_id, time_value)
+        batch.clear()
+    
+    async for line_number, record in records:
+        total += 1
+        if isinstance(record, str):
+            add_error(line_number, record)
+            continue
+        try:
+            batch.append((line_number, medication_values(MedicationCreate.model_validate(record), user_id)))
+        except ValidationError as e:
+            add_error(line_number, validation_error_message(e))
+            continue
+        if len(batch) >= MEDICATION_IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    
+    elapsed = time.perf_counter() - started
+    log_event(
+        logging.INFO, "📥 批量导入药物完成",
+        format=fmt, total=total, imported=imported, failed=failed, elapsed_ms=round(elapsed * 1000)
+    )
+    return {
+        "status": "success" if not failed else ("partial" if imported else "error"),
+        "message": f"批量导入完成: 成功{imported}条，失败{failed}条",
+        "data": {
+            "total": total,
+            "imported": imported,
+            "failed": failed,
+            "errors": errors,
+            "errors_truncated": failed > len(errors),
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "rows_per_second": round(total / elapsed, 1) if elapsed else None
+        }
     }
 
-@app.post("/api/send-email")
-async def send_email(payload: dict):
-    """发送邮件接口"""
+# 服药记录端点
+@app.post("/api/intake-records")
+def add_intake_record(record: dict):
+    """记录一次服药
+
+    status为taken、late、missed、postponed之一，date省略时为提醒时区的今天。
+    """
+    status = record.get('status')
+    if status not in INTAKE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Status must be one of {', '.join(INTAKE_STATUSES)}")
     try:
-        print(f"收到邮件发送请求: {payload}")
-        
-        # 从payload中提取邮件信息，支持多种格式
-        to_email = payload.get('to') or payload.get('email') or payload.get('recipient')
-        subject = payload.get('subject', '药物提醒')
-        body = payload.get('body') or payload.get('message') or payload.get('content', '这是一封药物提醒邮件')
-        
-        # 如果没有指定收件人，使用默认邮箱（你需要替换为你的邮箱）
-        if not to_email:
-            to_email = "your-email@gmail.com"  # 请替换为你的真实邮箱
-            print(f"使用默认邮箱: {to_email}")
-        
-        print(f"准备发送邮件到: {to_email}")
-        print(f"主题: {subject}")
-        print(f"内容: {body}")
-        
-        # 检测是否为HTML内容或使用默认模板
-        is_html = '<html>' in body or '<body>' in body or '<h' in body or '<p>' in body
+        medication_id = int(record.get('medication_id'))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Medication id is required")
+    try:
+        scheduled_time = normalize_time(record.get('scheduled_time'))
+        taken_time = normalize_time(record['taken_time']) if record.get('taken_time') else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Time must be in HH:MM format")
+    day = parse_date(record['date'], "date") if record.get('date') else datetime.now(REMINDER_TIMEZONE).date()
+    
+    event = IntakeEvent(
+        user_id=str(record.get('user_id') or 'default'),
+        medication_id=medication_id,
+        medication_name=record.get('medication_name'),
+        date=day.isoformat(),
+        scheduled_time=scheduled_time,
+        taken_time=taken_time,
+        status=status
+    )
+    with Session(engine) as session:
+        record_intake_event(session, event)
+        session.commit()
+        session.refresh(event)
+        saved = event.model_dump()
+    
+    return {
+        "status": "success",
+        "message": "服药记录已保存",
+        "record": saved
+    }
+
+@app.get("/api/intake-records")
+def get_intake_records(
+    user_id: str = "default",
+    start: Optional[str] = None,
+    end: Optional[str] = None
+):
+    """获取某段日期内每次服药的最新记录，start/end省略时为今天"""
+    today = datetime.now(REMINDER_TIMEZONE).date()
+    start_day = parse_date(start, "start") if start else today
+    end_day = parse_date(end, "end") if end else start_day
+    if not 0 <= (end_day - start_day).days < INTAKE_RECORDS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range must be within {INTAKE_RECORDS_MAX_DAYS} days")
+    
+    statement = (
+        select(IntakeEvent)
+        .where(
+            IntakeEvent.user_id == user_id,
+            IntakeEvent.date >= start_day.isoformat(),
+            IntakeEvent.date <= end_day.isoformat()
+        )
+        .order_by(IntakeEvent.date, IntakeEvent.medication_id, IntakeEvent.scheduled_time, IntakeEvent.id)
+    )
+    latest = {}
+    with Session(engine) as session:
+        for event in session.exec(statement):
+            latest[(event.date, event.medication_id, event.scheduled_time)] = event.model_dump()
+    
+    return {"records": list(latest.values())}
+
+@app.get("/api/adherence")
+def get_adherence(
+    user_id: str = "default",
+    period: str = "day",
+    medication_id: int = 0,
+    start: Optional[str] = None,
+    end: Optional[str] = None
+):
+    """获取服药统计
+
+    只读取预先汇总的结果，不扫描服药记录。medication_id为0时为所有药物的合计，
+    start/end按period对齐到所在日、周、月的起始日期。
+    """
+    if period not in ADHERENCE_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Period must be one of {', '.join(ADHERENCE_PERIODS)}")
+    
+    statement = select(AdherenceRollup).where(
+        AdherenceRollup.user_id == user_id,
+        AdherenceRollup.medication_id == medication_id,
+        AdherenceRollup.period == period
+    )
+    if start:
+        statement = statement.where(AdherenceRollup.period_start >= period_starts(parse_date(start, "start"))[period])
+    if end:
+        statement = statement.where(AdherenceRollup.period_start <= period_starts(parse_date(end, "end"))[period])
+    # 取最近的若干行，再按时间正序返回
+    statement = statement.order_by(AdherenceRollup.period_start.desc()).limit(ADHERENCE_MAX_ROWS)
+    
+    with Session(engine) as session:
+        rows = session.exec(statement).all()
+    
+    summary = {"total": 0, "taken": 0, "late": 0, "missed": 0, "postponed": 0}
+    rollups = []
+    for row in reversed(rows):
+        counts = {column: getattr(row, column) for column in summary}
+        for column, value in counts.items():
+            summary[column] += value
+        rollups.append({"period_start": row.period_start, **counts, "adherence": adherence_rate(counts)})
+    
+    return {
+        "user_id": user_id,
+        "period": period,
+        "medication_id": medication_id,
+        "rollups": rollups,
+        "summary": {**summary, "adherence": adherence_rate(summary)}
+    }
+
+# 家人组端点
+@app.get("/api/family")
+def get_family(user_id: str = "default"):
+    """获取患者的家人组和成员"""
+    with Session(engine) as session:
+        group = session.exec(select(FamilyGroup).where(FamilyGroup.patient_user_id == user_id)).first()
+        members = []
+        if group is not None:
+            statement = select(FamilyMember).where(FamilyMember.group_id == group.id).order_by(FamilyMember.id)
+            members = [member.model_dump() for member in session.exec(statement).all()]
+    return {
+        "user_id": user_id,
+        "group": group.model_dump() if group else None,
+        "members": members
+    }
+
+@app.post("/api/family/members")
+def add_family_member(member: dict):
+    """把家人加入患者的家人组，组不存在时创建"""
+    user_id = str(member.get('user_id') or 'default')
+    values = family_member_values(member)
+    with Session(engine) as session:
+        group = get_or_create_family_group(session, user_id)
+        row = FamilyMember(group_id=group.id, **values)
+        session.add(row)
+        session.commit()
+        session.refresh(row)
+        saved = row.model_dump()
+    family_recipients.invalidate(user_id)
+    
+    return {
+        "status": "success",
+        "message": "家人添加成功",
+        "member": saved
+    }
+
+@app.delete("/api/family/members/{member_id}")
+def remove_family_member(member_id: int):
+    """从家人组中移除一位家人"""
+    with Session(engine) as session:
+        member = session.get(FamilyMember, member_id)
+        if member is None:
+            raise HTTPException(status_code=404, detail="Family member not found")
+        group = session.get(FamilyGroup, member.group_id)
+        user_id = group.patient_user_id if group else None
+        session.delete(member)
+        session.commit()
+    if user_id is not None:
+        family_recipients.invalidate(user_id)
+    
+    return {"status": "success", "message": "家人已移除"}
+
+@app.post("/api/invite/generate")
+def generate_invite(payload: dict):
+    """为患者生成家人邀请码"""
+    user_id = str(payload.get('owner_user_id') or payload.get('user_id') or 'default')
+    with Session(engine) as session:
+        group = get_or_create_family_group(session, user_id)
+        invite = FamilyInvite(
+            code=secrets.token_urlsafe(9),
+            group_id=group.id,
+            expires_at=datetime.utcnow() + timedelta(hours=FAMILY_INVITE_TTL_HOURS)
+        )
+        session.add(invite)
+        session.commit()
+        session.refresh(invite)
+        saved = invite.model_dump()
+    
+    return {
+        "status": "success",
+        "code": saved["code"],
+        "expires_at": saved["expires_at"]
+    }
+
+@app.post("/api/invite/bind")
+def bind_invite(payload: dict):
+    """通过邀请码加入家人组；同一LINE用户重复绑定时更新原有成员"""
+    code = payload.get('code')
+    values = family_member_values(payload)
+    with Session(engine) as session:
+        invite = session.get(FamilyInvite, code) if code else None
+        if invite is None or invite.expires_at < datetime.utcnow():
+            raise HTTPException(status_code=404, detail="Invite code is invalid or expired")
+        group = session.get(FamilyGroup, invite.group_id)
+        member = None
+        if values["line_user_id"]:
+            member = session.exec(
+                select(FamilyMember)
+                .where(FamilyMember.group_id == group.id)
+                .where(FamilyMember.line_user_id == values["line_user_id"])
+            ).first()
+        if member is None:
+            member = FamilyMember(group_id=group.id, **values)
+        else:
+            for field, value in values.items():
+                setattr(member, field, value)
+        session.add(member)
+        session.commit()
+        session.refresh(member)
+        saved = member.model_dump()
+        user_id = group.patient_user_id
+    family_recipients.invalidate(user_id)
+    
+    return {
+        "status": "success",
+        "message": "绑定成功",
+        "user_id": user_id,
+        "member": saved
+    }
+
+# 事件流端点
+def load_family_patients(line_user_id):
+    """返回LINE用户作为家人加入的所有家人组的患者user_id"""
+    statement = (
+        select(FamilyGroup.patient_user_id)
+        .join(FamilyMember, FamilyMember.group_id == FamilyGroup.id)
+        .where(FamilyMember.line_user_id == line_user_id)
+    )
+    with Session(engine) as session:
+        return set(session.exec(statement).all())
+
+async def event_stream(request, topics, last_event_id):
+    """SSE响应体：推送订阅主题的事件，空闲时按EVENT_STREAM_HEARTBEAT发送注释行保活"""
+    subscription = event_broker.subscribe(topics, last_event_id)
+    try:
+        yield f"retry: {int(EVENT_STREAM_HEARTBEAT * 1000)}\n\n".encode()
+        while True:
+            try:
+                frame = await asyncio.wait_for(subscription.queue.get(), timeout=EVENT_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                frame = b": ping\n\n"
+            yield frame
+    finally:
+        event_broker.unsubscribe(subscription)
+        if subscription.dropped:
+            log_event(logging.WARNING, "⚠️ 事件流客户端过慢，部分事件被丢弃", dropped=subscription.dropped)
+
+@app.get("/api/events")
+async def stream_events(
+    request: Request,
+    user_id: Optional[str] = None,
+    line_user_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """服务器推送事件流（text/event-stream）
+
+    user_id订阅该用户的邮件投递结果（delivery）和服药提醒（reminder）；
+    line_user_id订阅该家人加入的所有家人组的患者。重连时浏览器自动带上
+    Last-Event-ID，补发断线期间仍在内存中的事件。
+    """
+    topics = {user_id} if user_id else set()
+    if line_user_id:
+        topics |= await asyncio.to_thread(load_family_patients, line_user_id)
+    if not topics:
+        if line_user_id:
+            raise HTTPException(status_code=404, detail="No family groups for this LINE user")
+        raise HTTPException(status_code=400, detail="user_id or line_user_id is required")
+    event_broker.check_capacity()
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    return StreamingResponse(
+        event_stream(request, topics, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 旧客户端不带content_type时判断正文是否为HTML，一次扫描代替逐个查找标记
+HTML_MARKERS = re.compile(r"<(?:h|body>|p>)")
+
+def prepare_email_message(request):
+    """从EmailRequest中取出收件人、主题和正文，必要时套用默认模板"""
+    started = time.perf_counter()
+    to_email = request.to
+    subject = request.subject
+    body = request.body or '这是一封药物提醒邮件'
+    
+    # 如果没有指定收件人，使用DEFAULT_EMAIL_RECIPIENT
+    if not to_email:
+        if not DEFAULT_EMAIL_RECIPIENT:
+            raise HTTPException(status_code=400, detail="Recipient is required")
+        to_email = DEFAULT_EMAIL_RECIPIENT
+        log_event(logging.WARNING, "未指定收件人，使用默认邮箱", to=redact_email(to_email))
+    
+    log_event(
+        logging.DEBUG, "准备发送邮件",
+        to=redact_email(to_email), subject=subject, body=truncate_text(body)
+    )
+    
+    # 检测是否为HTML内容或使用默认模板
+    if request.content_type:
+        is_html = request.content_type == "html"
+    else:
+        is_html = HTML_MARKERS.search(body) is not None
+    SEND_STAGE_SECONDS.observe("parse", time.perf_counter() - started)
+    
+    # 如果没有提供HTML内容，使用默认的美观模板
+    if not is_html and subject == "お薬服用のお知らせ":
+        # 药品信息，摘要模式合并时也使用这些字段
+        medication = {
+            "medication_name": request.medication_name or '薬',
+            "scheduled_time": request.scheduled_time or '09:00',
+            "taken_time": datetime.now().strftime("%Y/%m/%d %H:%M"),
+            "status": request.status or '服用済み'
+        }
+        body = generate_medication_email_html(**medication)
+        log_event(logging.DEBUG, "✅ 使用美观的邮件模板")
+        message = {"to": to_email, "subject": subject, "body": body, "is_html": True, "medication": medication}
+    else:
+        message = {"to": to_email, "subject": subject, "body": body, "is_html": is_html}
+    # 带user_id的邮件会把投递状态推送到该用户的事件流
+    if request.user_id:
+        message["user_id"] = request.user_id
+    return message
+
+class IdempotencyCache:
+    """有界的幂等键索引
+
+    第一次请求执行发送并把结果保存TTL秒，窗口内相同键的请求直接返回该结果；
+    并发的相同请求等待同一个进行中的发送。发送失败时删除键，允许客户端重试。
+    传入fingerprint（请求内容的哈希）时，相同键但内容不同的请求返回422，
+    不会把旧结果重放给另一封邮件。只在事件循环中使用，不需要加锁。
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 键 -> (创建时间, Future, 请求指纹)，按创建顺序排列，过期键总在前面
+        self._entries = OrderedDict()
+
+    def _evict(self, now):
+        entries = self._entries
+        while entries:
+            key, (created, future, _) = next(iter(entries.items()))
+            if now - created < self.ttl and len(entries) <= self.max_entries:
+                break
+            if not future.done() and now - created < self.ttl:
+                break
+            entries.popitem(last=False)
+
+    async def run(self, key, func, fingerprint=None):
+        """执行func()或复用相同键的结果，返回(结果, 是否为重放)"""
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[2] != fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used with a different request"
+                )
+            return await asyncio.shield(entry[1]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now, future, fingerprint)
+        try:
+            result = await func()
+        except BaseException as e:
+            self._entries.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # 没有并发等待者时避免"exception was never retrieved"警告
+                future.exception()
+            raise
+        future.set_result(result)
+        return result, False
+
+    def __len__(self):
+        return len(self._entries)
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS)
+
+def derive_idempotency_key(request, message):
+    """根据收件人、药品、服用时间和状态生成幂等键；不是服药通知时返回None"""
+    if not request.medication_name:
+        return None
+    parts = (message["to"], request.medication_name, request.scheduled_time or '', request.status or '')
+    digest = hashlib.sha256("\x00".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f"auto:{digest}"
+
+def request_fingerprint(payload):
+    """规范化后的请求内容的哈希，用于校验同一个Idempotency-Key是否对应同一请求"""
+    normalized = json.dumps(payload.model_dump(mode="json"), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def enqueue_email(message, delay=0):
+    """写入发件队列，返回(状态码, 响应内容)"""
+    queue_id = email_queue.enqueue(message, delay=delay)
+    email_dispatcher.notify()
+    publish_delivery(message, "queued", queue_id=queue_id)
+    return 202, {
+        "status": "queued",
+        "message": "邮件已加入发送队列",
+        "data": {
+            "to": message["to"],
+            "subject": message["subject"],
+            "queue_id": queue_id
+        }
+    }
+
+async def deliver_email(message, queue, digest=False):
+    """直接发送、加入摘要或写入发件队列，返回(状态码, 响应内容)"""
+    if digest and "medication" in message:
+        status_code, body = email_digest.add(message)
+        publish_delivery(message, body["status"])
+        return status_code, body
+    if queue:
+        return enqueue_email(message)
+    
+    # 发送邮件（在线程池中执行，避免阻塞事件循环）；熔断器打开时不占用发送线程
+    try:
+        email_circuit_breaker.check()
+        result = await send_pool.run(
+            email_transport.send, message["to"], message["subject"], message["body"], is_html=message["is_html"]
+        )
+    except CircuitOpenError as e:
+        if CIRCUIT_BREAKER_OPEN_ACTION == "queue":
+            return enqueue_email(message, delay=float(e.headers["Retry-After"]))
+        publish_delivery(message, "failed", error=e.detail)
+        raise
+    except HTTPException as e:
+        if e.status_code == 429 and GMAIL_RATE_OVERFLOW == "queue":
+            return enqueue_email(message, delay=float(e.headers.get("Retry-After", 1)))
+        publish_delivery(message, "failed", error=e.detail)
+        raise
+    
+    publish_delivery(message, "sent", message_id=result.get("message_id"))
+    return 200, {
+        "status": "success",
+        "message": "邮件发送成功",
+        "data": {
+            "to": message["to"],
+            "subject": message["subject"],
+            "message_id": result.get("message_id"),
+            "thread_id": result.get("thread_id"),
+            "account": result.get("account")
+        }
+    }
+
+async def deliver_keyed(key, message, queue, digest, fingerprint=None):
+    """带幂等键时通过idempotency_cache投递，返回((状态码, 响应内容), 是否为重放)"""
+    if key is None:
+        return await deliver_email(message, queue, digest), False
+    return await idempotency_cache.run(key, lambda: deliver_email(message, queue, digest), fingerprint)
+
+async def send_family_email(request, queue, digest, idempotency_key):
+    """把一条通知发给患者家人组中所有接收邮件的成员
+
+    收件人来自family_recipients缓存；邮件只渲染一次，每位收件人各自投递，
+    Idempotency-Key按收件人区分。
+    """
+    user_id = request.user_id
+    recipients = family_recipients.lookup(user_id)
+    if recipients is None:
+        recipients = await asyncio.to_thread(family_recipients.load, user_id, load_family_recipients)
+    if not recipients:
+        raise HTTPException(status_code=404, detail="No family email recipients for this user")
+    
+    base = prepare_email_message(request.model_copy(update={"to": recipients[0]["email"]}))
+    
+    fingerprint = request_fingerprint(request) if idempotency_key else None
+    
+    async def deliver_to(recipient):
+        message = {**base, "to": recipient["email"]}
+        if idempotency_key:
+            key = f"header:{idempotency_key}:{recipient['email']}"
+        else:
+            key = derive_idempotency_key(request, message)
+        result = {"member_id": recipient["member_id"], "name": recipient["name"], "to": recipient["email"]}
+        try:
+            (status_code, body), replayed = await deliver_keyed(key, message, queue, digest, fingerprint)
+        except HTTPException as e:
+            return {**result, "status": "error", "status_code": e.status_code, "error": e.detail}
+        return {**result, **body.get("data", {}), "status": body["status"], "status_code": status_code, "replayed": replayed}
+    
+    results = await asyncio.gather(*(deliver_to(recipient) for recipient in recipients))
+    succeeded = sum(1 for result in results if result["status"] != "error")
+    if succeeded == len(results):
+        status = "success"
+    elif succeeded:
+        status = "partial"
+    else:
+        status = "error"
+    log_event(logging.INFO, "👪 家人通知已分发", user_id=user_id, recipients=len(results), succeeded=succeeded)
+    
+    return {
+        "status": status,
+        "message": f"家人通知完成: 成功{succeeded}位，失败{len(results) - succeeded}位",
+        "data": {
+            "user_id": user_id,
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results
+        }
+    }
+
+@app.post("/api/send-email", response_model=EmailSendResponse, response_model_exclude_unset=True)
+async def send_email(
+    payload: EmailRequest,
+    response: Response,
+    queue: bool = False,
+    digest: Optional[bool] = None,
+    idempotency_key: Optional[str] = Header(None)
+):
+    """发送邮件接口
+
+    queue=true时只写入持久化发件队列并立即返回队列ID，由后台调度协程发送。
+    未指定收件人但带user_id时，发给该患者家人组中所有接收邮件的成员。
+    设置EMAIL_DIGEST_WINDOW后服药通知默认进入摘要，窗口内发给同一收件人的通知
+    合并为一封邮件；digest=false时单独发送。
+    直接发送被限流时，若GMAIL_RATE_OVERFLOW=queue也会转入发件队列。
+    带Idempotency-Key请求头（或服药通知可自动生成幂等键）时，窗口内的重复请求
+    返回第一次的结果而不再调用Gmail，响应头带Idempotent-Replayed: true；
+    同一个Idempotency-Key配不同的请求内容时返回422。
+    """
+    try:
+        log_event(
+            logging.INFO, "收到邮件发送请求", sampled=True,
+            payload_keys=",".join(sorted(payload.model_fields_set)), queue=queue
+        )
         
-        # 如果没有提供HTML内容，使用默认的美观模板
-        if not is_html and subject == "お薬服用のお知らせ":
-            # 从payload中提取药品信息
-            medication_name = payload.get('medication_name', '薬')
-            scheduled_time = payload.get('scheduled_time', '09:00')
-            status = payload.get('status', '服用済み')
-            
-            body = generate_medication_email_html(
-                medication_name=medication_name,
-                scheduled_time=scheduled_time,
-                taken_time=datetime.now().strftime("%Y/%m/%d %H:%M"),
-                status=status
-            )
-            is_html = True
-            print("✅ 使用美观的邮件模板")
+        digest = email_digest.enabled and digest is not False
+        if not payload.to and payload.user_id:
+            return await send_family_email(payload, queue, digest, idempotency_key)
         
-        # 发送邮件
-        result = send_gmail_message(to_email, subject, body, is_html=is_html)
+        message = prepare_email_message(payload)
+        if idempotency_key:
+            # 客户端提供的键绑定请求内容；自动生成的键本身就由内容得出
+            key, fingerprint = f"header:{idempotency_key}", request_fingerprint(payload)
+        else:
+            key, fingerprint = derive_idempotency_key(payload, message), None
+        (status_code, body), replayed = await deliver_keyed(key, message, queue, digest, fingerprint)
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+            log_event(logging.INFO, "重复的发送请求，返回首次结果", sampled=True, to=redact_email(message["to"]))
         
-        return {
-            "status": "success",
-            "message": "邮件发送成功",
-            "data": {
-                "to": to_email,
-                "subject": subject,
-                "message_id": result.get("message_id"),
-                "thread_id": result.get("thread_id")
-            }
-        }
+        response.status_code = status_code
+        return body
     except HTTPException:
         raise
     except Exception as e:
-        print(f"发送邮件失败: {str(e)}")
+        log_event(logging.ERROR, "发送邮件失败", exc_info=True, error=str(e))
         raise HTTPException(status_code=500, detail=f"发送邮件失败: {str(e)}")
 
+@app.post("/api/send-email/batch", response_model=BatchSendResponse, response_model_exclude_unset=True)
+async def send_email_batch(payload: Union[List[dict], dict]):
+    """批量发送邮件接口
+
+    接受邮件payload列表（或{"messages": [...]}），每条的格式与/api/send-email相同。
+    """
+    items = payload.get("messages") if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="messages must be a non-empty list")
+    if len(items) > EMAIL_BATCH_MAX_MESSAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many messages in one batch (max {EMAIL_BATCH_MAX_MESSAGES})"
+        )
+    
+    log_event(logging.INFO, "收到批量邮件发送请求", count=len(items))
+    messages = []
+    results = [None] * len(items)
+    for index, item in enumerate(items):
+        try:
+            messages.append((index, prepare_email_message(EmailRequest.model_validate(item))))
+        except ValidationError as e:
+            results[index] = {"status": "error", "error": f"Invalid message: {validation_error_message(e)}"}
+        except HTTPException as e:
+            results[index] = {"status": "error", "error": f"Invalid message: {e.detail}"}
+        except Exception as e:
+            results[index] = {"status": "error", "error": f"Invalid message: {str(e)}"}
+    
+    if messages:
+        sent = await send_pool.run(email_transport.send_batch, [message for _, message in messages])
+        for (index, message), result in zip(messages, sent):
+            if result["status"] == "rate_limited" and GMAIL_RATE_OVERFLOW == "queue":
+                # 与单封发送一致：被限流的条目按Retry-After延迟写入发件队列
+                _, queued = enqueue_email(message, delay=float(result["retry_after"]))
+                result = {"status": "queued", "queue_id": queued["data"]["queue_id"], "retry_after": result["retry_after"]}
+            results[index] = {"to": message["to"], "subject": message["subject"], **result}
+    
+    for index, result in enumerate(results):
+        result["index"] = index
+    succeeded = sum(1 for result in results if result["status"] == "success")
+    queued = sum(1 for result in results if result["status"] == "queued")
+    failed = len(results) - succeeded - queued
+    if not failed:
+        status = "success" if not queued else "queued"
+    elif succeeded or queued:
+        status = "partial"
+    else:
+        status = "error"
+    
+    return {
+        "status": status,
+        "message": f"批量发送完成: 成功{succeeded}封，入队{queued}封，失败{failed}封",
+        "data": {
+            "total": len(results),
+            "succeeded": succeeded,
+            "queued": queued,
+            "failed": failed,
+            "results": results
+        }
+    }
+
+@app.get("/api/send-email/queue/dead-letters")
+async def get_dead_letters(limit: int = 100):
+    """列出重试耗尽的邮件"""
+    return {"dead_letters": await asyncio.to_thread(email_queue.dead_letters, limit)}
+
+@app.get("/api/send-email/queue/{queue_id}")
+async def get_queued_email(queue_id: str):
+    """查询排队邮件的发送状态"""
+    item = await asyncio.to_thread(email_queue.get, queue_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Queued email not found")
+    return item
+
+_record_import("module_body")
+STARTUP_TIMINGS["module_import"] = time.perf_counter() - _MODULE_IMPORT_STARTED
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
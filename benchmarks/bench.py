@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+离线基准测试
+在本地模拟Gmail API上运行后端，测量 /api/send-email、邮件模板渲染和MIME编码的
+吞吐量、p50/p95/p99延迟和每次操作的内存分配，结果保存为JSON以便对比回归。
+
+用法:
+    python benchmarks/bench.py
+    python benchmarks/bench.py --requests 2000 --concurrency 32 --latency 0.05
+    python benchmarks/bench.py --compare benchmarks/results/baseline.json
+    python benchmarks/bench.py --transport smtp
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "app"))
+
+from fake_gmail import FakeGmailServer
+from fake_smtp import FakeSmtpServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线基准测试（使用本地模拟Gmail API）")
+    parser.add_argument("--requests", type=int, default=500, help="/api/send-email 请求总数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--iterations", type=int, default=5000, help="模板渲染和MIME编码的迭代次数")
+    parser.add_argument("--memory-samples", type=int, default=100, help="测量内存分配时的操作次数")
+    parser.add_argument("--latency", type=float, default=0.02, help="模拟Gmail的固定延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟Gmail的随机额外延迟上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟Gmail返回错误的概率")
+    parser.add_argument("--error-status", type=int, default=500, help="注入错误的HTTP状态码")
+    parser.add_argument("--transport", choices=["gmail", "smtp", "null"], default="gmail",
+                        help="发送通道：gmail（模拟Gmail API）、smtp（模拟SMTP服务器）、null（不发送）")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="结果保存目录")
+    parser.add_argument("--compare", help="与之前保存的结果文件对比")
+    parser.add_argument("--threshold", type=float, default=0.10, help="判定为回归的相对变化（默认10%%）")
+    return parser.parse_args()
+
+
+def prepare_environment(workdir, endpoint, transport, smtp_address=None):
+    """写入假的Gmail凭证，并在导入后端之前设置环境变量"""
+    credentials_file = os.path.join(workdir, "credentials.json")
+    token_file = os.path.join(workdir, "token.json")
+    with open(credentials_file, "w") as f:
+        json.dump({"installed": {"client_id": "bench", "client_secret": "bench"}}, f)
+    with open(token_file, "w") as f:
+        json.dump({
+            "token": "bench-token",
+            "refresh_token": "bench-refresh",
+            "client_id": "bench",
+            "client_secret": "bench",
+            "token_uri": "https://oauth2.googleapis.com/token",
+            "expiry": (datetime.utcnow() + timedelta(days=365)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        }, f)
+
+    os.environ["GMAIL_CREDENTIALS_FILE"] = credentials_file
+    os.environ["GMAIL_TOKEN_FILE"] = token_file
+    os.environ["GMAIL_API_ENDPOINT"] = endpoint
+    os.environ["EMAIL_TRANSPORT"] = transport
+    if smtp_address:
+        os.environ["SMTP_HOST"], os.environ["SMTP_PORT"] = smtp_address[0], str(smtp_address[1])
+        os.environ["SMTP_SECURITY"] = "none"
+        os.environ["SMTP_FROM"] = "bench@example.com"
+    os.environ.setdefault("EMAIL_QUEUE_DB", os.path.join(workdir, "email_queue.db"))
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    # 基准测试测量的是服务本身，关闭限流、预热、调度和大部分日志
+    os.environ.setdefault("GMAIL_RATE_LIMIT", "0")
+    os.environ.setdefault("GMAIL_RECIPIENT_RATE_LIMIT", "0")
+    os.environ.setdefault("GMAIL_WARMUP", "false")
+    os.environ.setdefault("REMINDER_SCHEDULER_ENABLED", "false")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, duration, errors=None):
+    latencies = sorted(latencies)
+    ops = len(latencies)
+    return {
+        "ops": ops,
+        "duration_s": round(duration, 4),
+        "throughput_ops": round(ops / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / ops * 1000, 4) if ops else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 4),
+            "p95": round(percentile(latencies, 0.95) * 1000, 4),
+            "p99": round(percentile(latencies, 0.99) * 1000, 4),
+            "max": round(latencies[-1] * 1000, 4) if ops else 0.0
+        },
+        "errors": errors or {}
+    }
+
+
+def measure_memory(func, samples):
+    """返回每次操作的峰值分配和残留分配（字节）"""
+    func()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(samples):
+            func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_bytes": peak - baseline,
+        "retained_bytes_per_op": round((current - baseline) / samples, 1)
+    }
+
+
+def bench_sync(func, iterations, memory_samples):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        op_started = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - op_started)
+    result = summarize(latencies, time.perf_counter() - started)
+    counter = iter(range(iterations, iterations + memory_samples + 1))
+    result["memory"] = measure_memory(lambda: func(next(counter)), memory_samples)
+    return result
+
+
+async def bench_send_email(main, requests, concurrency, memory_samples):
+    import httpx
+
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def send(i):
+                payload = {
+                    "to": f"family{i % 50}@example.com",
+                    "subject": "お薬服用のお知らせ",
+                    "body": f"bench {i}"
+                }
+                op_started = time.perf_counter()
+                response = await client.post("/api/send-email", json=payload)
+                return time.perf_counter() - op_started, response.status_code
+
+            # 预热Gmail客户端和连接
+            await send(-1)
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def bounded(i):
+                async with semaphore:
+                    return await send(i)
+
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*(bounded(i) for i in range(requests)))
+            duration = time.perf_counter() - started
+
+            errors = {}
+            for _, status in outcomes:
+                if status != 200:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+            result = summarize([latency for latency, _ in outcomes], duration, errors)
+
+            # 顺序发送测量内存，避免并发放大峰值
+            await send(-2)
+            tracemalloc.start()
+            try:
+                baseline, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                for i in range(memory_samples):
+                    await send(requests + i)
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            result["memory"] = {
+                "peak_bytes": peak - baseline,
+                "retained_bytes_per_op": round((current - baseline) / memory_samples, 1)
+            }
+            return result
+    finally:
+        await main.app.router.shutdown()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline_path, threshold):
+    """对比两次结果，p95延迟上升或吞吐量下降超过阈值视为回归"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\n📊 与 {baseline_path} 对比（阈值 {threshold:.0%}）")
+    for name, result in current["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            print(f"  {name}: 基线中没有该项")
+            continue
+        p95_now, p95_before = result["latency_ms"]["p95"], previous["latency_ms"]["p95"]
+        tput_now, tput_before = result["throughput_ops"], previous["throughput_ops"]
+        p95_change = (p95_now - p95_before) / p95_before if p95_before else 0.0
+        tput_change = (tput_now - tput_before) / tput_before if tput_before else 0.0
+        regressed = p95_change > threshold or tput_change < -threshold
+        mark = "❌" if regressed else "✅"
+        print(f"  {mark} {name}: p95 {p95_before}ms -> {p95_now}ms ({p95_change:+.1%}), "
+              f"吞吐量 {tput_before} -> {tput_now} ops/s ({tput_change:+.1%})")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main_cli():
+    args = parse_args()
+    fake = FakeGmailServer(
+        latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, error_status=args.error_status
+    ).start()
+    fake_smtp = None
+    if args.transport == "smtp":
+        fake_smtp = FakeSmtpServer(latency=args.latency, error_rate=args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix="pillpal-bench-")
+    prepare_environment(workdir, fake.endpoint, args.transport, fake_smtp.address if fake_smtp else None)
+
+    import main
+
+    html = main.generate_medication_email_html("アスピリン", "08:00", "2025/01/01 08:00", "服用済み")
+    results = {}
+
+    print("🚀 模板渲染（缓存命中）...")
+    results["template_render_cached"] = bench_sync(
+        lambda i: main.generate_medication_email_html("アスピリン", "08:00", "2025/01/01 08:00", "服用済み"),
+        args.iterations, args.memory_samples
+    )
+    print("🚀 模板渲染（未命中缓存）...")
+    results["template_render_uncached"] = bench_sync(
+        lambda i: main.generate_medication_email_html(f"薬{i}", "08:00", "2025/01/01 08:00", "服用済み"),
+        args.iterations, args.memory_samples
+    )
+    print("🚀 MIME构建和编码...")
+    results["mime_encode"] = bench_sync(
+        lambda i: main.build_raw_message(f"family{i % 50}@example.com", "お薬服用のお知らせ", html, is_html=True),
+        args.iterations, args.memory_samples
+    )
+    print("🚀 /api/send-email ...")
+    results["send_email"] = asyncio.run(
+        bench_send_email(main, args.requests, args.concurrency, args.memory_samples)
+    )
+    fake.stop()
+    if fake_smtp:
+        fake_smtp.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "iterations": args.iterations,
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "error_rate": args.error_rate,
+                "error_status": args.error_status,
+                "transport": args.transport,
+                "send_workers": main.EMAIL_SEND_WORKERS
+            },
+            "fake_gmail_requests": fake.requests,
+            "fake_smtp_connections": fake_smtp.connections if fake_smtp else None
+        },
+        "results": results
+    }
+
+    print("\n📋 结果")
+    for name, result in results.items():
+        latency = result["latency_ms"]
+        print(f"  {name}: {result['throughput_ops']} ops/s, p50 {latency['p50']}ms, "
+              f"p95 {latency['p95']}ms, p99 {latency['p99']}ms, "
+              f"峰值内存 {result['memory']['peak_bytes']}B"
+              + (f", 错误 {result['errors']}" if result["errors"] else ""))
+
+    os.makedirs(args.output, exist_ok=True)
+    output_file = os.path.join(args.output, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output_file, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 结果已保存到 {output_file}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.threshold)
+        if regressions:
+            print(f"\n❌ 发现性能回归: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
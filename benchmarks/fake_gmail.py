@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+本地模拟Gmail API，用于离线基准测试
+只实现 messages.send 和 批量请求，支持注入延迟和错误
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGmailServer:
+    """在后台线程中运行的模拟Gmail服务
+
+    latency: 每个请求的固定延迟（秒）
+    jitter: 额外的随机延迟上限（秒）
+    error_rate: 返回错误的概率
+    error_status: 注入的错误状态码（500、429等）
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _simulate(self):
+        """等待注入的延迟，返回(状态码, 响应内容)"""
+        with self._lock:
+            self.requests += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, {"error": {"code": self.error_status, "message": "injected error"}}
+        message_id = uuid.uuid4().hex[:16]
+        return 200, {"id": message_id, "threadId": message_id, "labelIds": ["SENT"]}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 头部和正文分两次写出，关闭Nagle避免与延迟ACK叠加出40ms的停顿
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, content_type="application/json", headers=None):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = self.rfile.read(length)
+                path = self.path.split("?")[0]
+                if path.endswith("/messages/send"):
+                    status, body = server._simulate()
+                    headers = {"Retry-After": "1"} if status == 429 else None
+                    self._reply(status, body, headers=headers)
+                elif path.endswith("/batch"):
+                    self._reply_batch(payload)
+                else:
+                    self._reply(404, {"error": {"code": 404, "message": "not found"}})
+
+            def _reply_batch(self, payload):
+                content_ids = re.findall(rb"Content-ID: <([^>]+)>", payload)
+                boundary = "fake_gmail_batch"
+                parts = []
+                for content_id in content_ids:
+                    status, body = server._simulate()
+                    parts.append(
+                        f"--{boundary}\r\n"
+                        f"Content-Type: application/http\r\n"
+                        f"Content-ID: <response-{content_id.decode()}>\r\n\r\n"
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        f"Content-Type: application/json\r\n\r\n"
+                        f"{json.dumps(body)}\r\n"
+                    )
+                data = ("".join(parts) + f"--{boundary}--").encode()
+                self._reply(200, data, content_type=f"multipart/mixed; boundary={boundary}")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="运行本地模拟Gmail API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    fake = FakeGmailServer(
+        port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, error_status=args.error_status
+    ).start()
+    print(f"🚀 模拟Gmail API运行在 {fake.endpoint}")
+    print(f"   设置 GMAIL_API_ENDPOINT={fake.endpoint} 后启动后端即可")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
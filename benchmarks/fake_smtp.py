@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+本地模拟SMTP服务器，用于SMTP发送通道的离线测试和基准测试
+支持EHLO、PIPELINING、AUTH PLAIN/LOGIN（接受任意凭证），可注入延迟和临时错误
+"""
+
+import random
+import socketserver
+import threading
+import time
+
+
+class FakeSmtpServer:
+    """在后台线程中运行的模拟SMTP服务
+
+    latency: 每封邮件DATA结束后的固定延迟（秒）
+    error_rate: 对DATA返回错误的概率
+    error_code: 注入的SMTP错误码（451为临时错误，554为永久错误）
+    keep_messages: 保存收到的邮件原文，供测试检查
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, error_code=451, keep_messages=False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.keep_messages = keep_messages
+        self.messages = []
+        self.connections = 0
+        self.delivered = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _accept(self, sender, recipients, data):
+        """处理一封邮件，返回应答行"""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return f"{self.error_code} injected error"
+        with self._lock:
+            self.delivered += 1
+            if self.keep_messages:
+                self.messages.append({"from": sender, "to": recipients, "data": data})
+        return "250 OK queued"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            # 应答逐行写出，关闭Nagle避免与延迟ACK叠加出停顿
+            disable_nagle_algorithm = True
+
+            def reply(self, line):
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                with server._lock:
+                    server.connections += 1
+                self.reply("220 fake-smtp ready")
+                sender, recipients = None, []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode("utf-8", "replace").rstrip("\r\n")
+                    verb = command[:4].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250-fake-smtp")
+                        self.reply("250-PIPELINING")
+                        self.reply("250-8BITMIME")
+                        self.reply("250 AUTH PLAIN LOGIN")
+                    elif verb == "AUTH":
+                        self.handle_auth(command)
+                    elif verb == "MAIL":
+                        sender, recipients = command.partition(":")[2].strip(" <>"), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command.partition(":")[2].strip(" <>"))
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        if not recipients:
+                            self.reply("554 no valid recipients")
+                            continue
+                        self.reply("354 end with .")
+                        data = self.read_data()
+                        self.reply(server._accept(sender, recipients, data))
+                        sender, recipients = None, []
+                    elif verb == "RSET":
+                        sender, recipients = None, []
+                        self.reply("250 OK")
+                    elif verb == "NOOP":
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("502 command not implemented")
+
+            def handle_auth(self, command):
+                parts = command.split()
+                if len(parts) >= 2 and parts[1].upper() == "LOGIN":
+                    self.reply("334 VXNlcm5hbWU6")
+                    self.rfile.readline()
+                    self.reply("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                elif len(parts) == 2:
+                    self.reply("334 ")
+                    self.rfile.readline()
+                self.reply("235 authenticated")
+
+            def read_data(self):
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        return b"".join(lines)
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="运行本地模拟SMTP服务器")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-code", type=int, default=451)
+    args = parser.parse_args()
+
+    fake = FakeSmtpServer(
+        port=args.port, latency=args.latency, error_rate=args.error_rate, error_code=args.error_code
+    ).start()
+    host, port = fake.address
+    print(f"🚀 模拟SMTP服务运行在 {host}:{port}")
+    print(f"   设置 EMAIL_TRANSPORT=smtp SMTP_HOST={host} SMTP_PORT={port} SMTP_SECURITY=none 后启动后端即可")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,17 @@
+"""测试环境：使用临时SQLite数据库和null发送通道，关闭后台提醒调度和Gmail预热"""
+
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="pillpal-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/pillpal.db")
+os.environ.setdefault("EMAIL_QUEUE_DB", os.path.join(_tmp, "email_queue.db"))
+os.environ.setdefault("EMAIL_TRANSPORT", "null")
+os.environ.setdefault("REMINDER_SCHEDULER_ENABLED", "false")
+os.environ.setdefault("GMAIL_WARMUP", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,102 @@
+import pytest
+
+import main
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_breaker(clock):
+    return main.CircuitBreaker(window=10, min_requests=4, failure_rate=0.5, open_seconds=30, half_open_probes=1, clock=clock)
+
+
+def trip(breaker):
+    for failed in (True, True, False, True):
+        breaker.record(failed, breaker.allow())
+
+
+def test_breaker_opens_on_failure_rate_and_closes_after_probe():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+
+    # 请求数未达到min_requests时不打开
+    for failed in (False, True, True):
+        breaker.record(failed, breaker.allow())
+    assert breaker.state == "closed"
+    breaker.record(True, breaker.allow())
+    assert breaker.state == "open"
+
+    with pytest.raises(main.CircuitOpenError):
+        breaker.allow()
+    clock.advance(29)
+    assert breaker.open_remaining() == pytest.approx(1)
+
+    clock.advance(1)
+    assert breaker.allow() == "probe"
+    assert breaker.state == "half_open"
+    breaker.record(False, "probe")
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["window_requests"] == 0
+    assert breaker.allow() == "closed"
+
+
+def test_half_open_allows_single_probe_and_reopens_on_failure():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    trip(breaker)
+    clock.advance(30)
+
+    mode = breaker.allow()
+    assert mode == "probe"
+    with pytest.raises(main.CircuitOpenError):
+        breaker.allow()
+
+    breaker.record(True, mode)
+    assert breaker.state == "open"
+    assert breaker.opened_total == 2
+    assert breaker.open_remaining() == pytest.approx(30)
+
+
+def test_failures_outside_window_do_not_open():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    for _ in range(3):
+        breaker.record(True, breaker.allow())
+    clock.advance(11)
+    breaker.record(True, breaker.allow())
+    assert breaker.state == "closed"
+
+
+def test_retry_budget_stops_after_max_retries(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+    budget = main.RetryBudget(max_retries=3, base=1, budget=100, clock=FakeClock())
+
+    assert [budget.next_delay() for _ in range(4)] == [1, 2, 4, None]
+
+
+def test_retry_budget_stops_when_time_runs_out(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+    clock = FakeClock()
+    budget = main.RetryBudget(max_retries=10, base=1, budget=5, clock=clock)
+
+    assert budget.next_delay() == 1
+    clock.advance(1)
+    assert budget.next_delay() == 2
+    clock.advance(2)
+    # 剩余2秒，下一次需要等待4秒
+    assert budget.next_delay() is None
+
+
+def test_auth_errors_do_not_count_as_transport_failures():
+    assert not main.batch_result_failed({"status": "error", "error": "auth", "status_code": 401})
+    assert not main.batch_result_failed({"status": "rejected", "error": "bad address"})
+    assert main.batch_result_failed({"status": "error", "error": "boom"})
+    assert main.batch_result_failed({"status": "error", "error": "boom", "status_code": 502})
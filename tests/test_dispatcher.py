@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+import main
+
+
+def test_notify_from_worker_thread_wakes_dispatcher(tmp_path):
+    dispatcher = main.EmailQueueDispatcher(main.EmailQueue(str(tmp_path / "queue.db")), 10)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        dispatcher._loop = loop
+        dispatcher._wakeup = asyncio.Event()
+        waiter = asyncio.create_task(dispatcher._wakeup.wait())
+        await asyncio.sleep(0)
+        # 与ReminderScheduler.fire和EmailDigestBuffer.add一样，在工作线程中唤醒
+        await asyncio.to_thread(dispatcher.notify)
+        await asyncio.wait_for(waiter, timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_notify_on_loop_thread_sets_event_directly(tmp_path):
+    dispatcher = main.EmailQueueDispatcher(main.EmailQueue(str(tmp_path / "queue.db")), 10)
+
+    async def scenario():
+        dispatcher._loop = asyncio.get_running_loop()
+        dispatcher._wakeup = asyncio.Event()
+        dispatcher.notify()
+        assert dispatcher._wakeup.is_set()
+
+    asyncio.run(scenario())
+
+
+class RecordingQueue(main.EmailQueue):
+    """记录claim_due在哪个线程中执行"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.claim_threads = set()
+
+    def claim_due(self, limit):
+        self.claim_threads.add(threading.get_ident())
+        return super().claim_due(limit)
+
+
+def test_dispatcher_runs_sqlite_calls_off_the_event_loop(tmp_path):
+    queue = RecordingQueue(str(tmp_path / "queue.db"))
+    dispatcher = main.EmailQueueDispatcher(queue, 10)
+    queue_id = queue.enqueue({"to": "a@example.com", "subject": "s", "body": "b", "is_html": False})
+
+    async def scenario():
+        dispatcher.start()
+        try:
+            for _ in range(100):
+                if queue.get(queue_id)["status"] == "sent":
+                    break
+                await asyncio.sleep(0.02)
+        finally:
+            await dispatcher.stop()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert queue.get(queue_id)["status"] == "sent"
+    assert queue.claim_threads and loop_thread not in queue.claim_threads
+
+
+class FailingTransport(main.EmailTransport):
+    """每次发送都抛出给定状态码的HTTPException"""
+
+    name = "failing"
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def send(self, to_email, subject, body, is_html=False):
+        raise main.HTTPException(status_code=self.status_code, detail=f"error {self.status_code}")
+
+
+def deliver_once(tmp_path, monkeypatch, status_code):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"))
+    dispatcher = main.EmailQueueDispatcher(queue, 10)
+    monkeypatch.setattr(main, "email_transport", FailingTransport(status_code))
+    queue_id = queue.enqueue({"to": "a@example.com", "subject": "s", "body": "b", "is_html": False})
+    item = queue.claim_due(1)[0]
+    asyncio.run(dispatcher._deliver(item))
+    return queue.get(queue_id)
+
+
+def test_auth_failure_releases_message_without_counting_attempt(tmp_path, monkeypatch):
+    item = deliver_once(tmp_path, monkeypatch, 401)
+
+    assert item["status"] == "pending"
+    assert item["attempts"] == 0
+    assert item["next_attempt_at"] >= item["updated_at"] + main.EMAIL_QUEUE_BACKOFF_BASE * 0.8
+
+
+def test_bad_request_is_dead_lettered(tmp_path, monkeypatch):
+    assert deliver_once(tmp_path, monkeypatch, 400)["status"] == "dead"
+
+
+def test_other_client_errors_are_retried(tmp_path, monkeypatch):
+    item = deliver_once(tmp_path, monkeypatch, 404)
+
+    assert item["status"] == "pending"
+    assert item["attempts"] == 1
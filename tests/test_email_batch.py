@@ -0,0 +1,44 @@
+import asyncio
+
+from fastapi import HTTPException
+
+import main
+
+
+class LimitedTransport(main.EmailTransport):
+    """只放行前limit封，其余按429限流"""
+
+    name = "limited"
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = []
+
+    def send(self, to_email, subject, body, is_html=False):
+        if len(self.sent) >= self.limit:
+            raise HTTPException(status_code=429, detail="rate limited", headers={"Retry-After": "7"})
+        self.sent.append(to_email)
+        return {"status": "success", "message_id": f"m{len(self.sent)}"}
+
+
+def test_rate_limited_batch_items_are_queued(tmp_path, monkeypatch):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"))
+    transport = LimitedTransport(limit=2)
+    monkeypatch.setattr(main, "email_queue", queue)
+    monkeypatch.setattr(main, "GMAIL_RATE_OVERFLOW", "queue")
+    monkeypatch.setattr(
+        main, "email_transport",
+        main.CircuitBreakerTransport(transport, main.CircuitBreaker(20, 1, 0.5, 30, 1))
+    )
+    messages = [{"to": f"user{i}@example.com", "subject": "s", "body": "b"} for i in range(5)]
+
+    response = asyncio.run(main.send_email_batch(messages))
+
+    assert response["status"] == "queued"
+    assert response["data"]["succeeded"] == 2
+    assert response["data"]["queued"] == 3
+    assert response["data"]["failed"] == 0
+    queued = [r for r in response["data"]["results"] if r["status"] == "queued"]
+    assert [r["retry_after"] for r in queued] == [7, 7, 7]
+    assert queue.depth() == {"pending": 3}
+    assert queue.claim_due(10) == []
@@ -0,0 +1,19 @@
+import main
+
+
+def test_text_content_type_is_sent_as_plain_even_with_html_tags():
+    request = main.EmailRequest(to="a@example.com", subject="s", body="<html><body>x</body></html>", content_type="text")
+    message = main.prepare_email_message(request)
+
+    assert message["is_html"] is False
+    data, _ = main.build_mime_message("pillpal@example.com", message["to"], "s", message["body"], message["is_html"])
+    assert b"text/plain" in data and b"text/html" not in data
+
+
+def test_html_is_still_detected_without_content_type():
+    request = main.EmailRequest(to="a@example.com", subject="s", body="<html><body>x</body></html>")
+    message = main.prepare_email_message(request)
+
+    assert message["is_html"] is True
+    data, _ = main.build_mime_message("pillpal@example.com", message["to"], "s", message["body"], message["is_html"])
+    assert b"text/html" in data
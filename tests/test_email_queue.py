@@ -0,0 +1,92 @@
+import time
+
+import main
+
+
+def make_queue(tmp_path):
+    return main.EmailQueue(str(tmp_path / "queue.db"))
+
+
+def test_mark_sent_drops_body_and_purge_removes_old_rows(tmp_path):
+    queue = make_queue(tmp_path)
+    message = {"to": "a@example.com", "subject": "s", "body": "x" * 7000, "is_html": False}
+    old_id = queue.enqueue(message)
+    new_id = queue.enqueue(message)
+    queue.claim_due(10)
+    queue.mark_sent(old_id, {"message_id": "m1"})
+    queue.mark_sent(new_id, {"message_id": "m2"})
+
+    row = queue._execute("SELECT message FROM email_queue WHERE id = ?", (old_id,)).fetchone()
+    assert "body" not in row[0]
+    assert queue.get(old_id)["to"] == "a@example.com"
+
+    queue._execute("UPDATE email_queue SET next_attempt_at = ? WHERE id = ?", (time.time() - 7200, old_id))
+    assert queue.purge_sent(time.time() - 3600) == 1
+    assert queue.get(old_id) is None
+    assert queue.get(new_id)["status"] == "sent"
+    assert queue.depth() == {"sent": 1}
+
+
+def test_depth_does_not_take_write_lock(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue({"to": "a@example.com", "subject": "s", "body": "b", "is_html": False})
+    # 第一次调用会在写锁下建表，之后的统计不再需要写锁
+    queue.depth()
+    with queue._lock:
+        assert queue.depth() == {"pending": 1}
+
+
+def reminder(name):
+    medication = {"medication_name": name, "scheduled_time": "08:00", "taken_time": "-", "status": "未服用"}
+    return {"to": "a@example.com", "subject": "提醒", "body": name, "is_html": True, "medication": medication}
+
+
+def test_digest_items_are_persisted_and_merged_at_claim(tmp_path):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"), merge=main.merge_digest_messages)
+    head, size, deadline = queue.add_to_digest(reminder("A"), "k", 60, 5)
+    second, size, second_deadline = queue.add_to_digest(reminder("B"), "k", 60, 5)
+    assert (second, size, second_deadline) == (head, 2, deadline)
+    assert queue.claim_due(10) == []
+
+    # 模拟进程重启：缓冲的通知仍在队列中
+    queue = main.EmailQueue(str(tmp_path / "queue.db"), merge=main.merge_digest_messages)
+    queue._execute("UPDATE email_queue SET next_attempt_at = ?", (time.time() - 1,))
+    items = queue.claim_due(10)
+    assert [item["id"] for item in items] == [head]
+    assert "A" in items[0]["message"]["body"] and "B" in items[0]["message"]["body"]
+    assert queue.depth() == {"sending": 1}
+
+
+def test_full_digest_is_due_immediately(tmp_path):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"), merge=main.merge_digest_messages)
+    queue.add_to_digest(reminder("A"), "k", 60, 2)
+    queue.add_to_digest(reminder("B"), "k", 60, 2)
+    assert len(queue.claim_due(10)) == 1
+    # 已取出的摘要不再接收新通知，新通知开启下一封摘要
+    _, size, _ = queue.add_to_digest(reminder("C"), "k", 60, 2)
+    assert size == 1
+
+
+def test_full_digest_is_sealed_before_it_is_claimed(tmp_path):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"), merge=main.merge_digest_messages)
+    first, _, _ = queue.add_to_digest(reminder("Aspirin"), "k", 60, 2)
+    queue.add_to_digest(reminder("Bisoprolol"), "k", 60, 2)
+    # 达到上限后、取件前到达的通知开启新的摘要
+    second, size, _ = queue.add_to_digest(reminder("Cetirizine"), "k", 60, 2)
+    assert size == 1 and second != first
+
+    items = queue.claim_due(10)
+    assert [item["id"] for item in items] == [first]
+    assert "Cetirizine" not in items[0]["message"]["body"]
+
+
+def test_merged_digest_keeps_every_source_user_id(monkeypatch):
+    published = []
+    monkeypatch.setattr(main.event_broker, "publish", lambda user_id, kind, data: published.append(user_id))
+    messages = [{**reminder(name), "user_id": user_id} for name, user_id in (("A", "p1"), ("B", "p2"), ("C", "p1"))]
+
+    merged = main.merge_digest_messages(messages)
+    main.publish_delivery(merged, "sent")
+
+    assert merged["user_ids"] == ["p1", "p2"]
+    assert published == ["p1", "p2"]
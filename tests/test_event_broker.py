@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def parse(frame):
+    """把SSE帧解析为(事件ID, 事件类型, data)"""
+    fields = dict(line.split(": ", 1) for line in frame.decode("utf-8").strip().split("\n"))
+    return int(fields["id"]), fields["event"], json.loads(fields["data"])
+
+
+def drain(subscription):
+    frames = []
+    while not subscription.queue.empty():
+        frames.append(parse(subscription.queue.get_nowait()))
+    return frames
+
+
+def run(scenario, buffer_size=10, max_subscribers=10, replay_size=10):
+    async def main_task():
+        broker = main.EventBroker(buffer_size, max_subscribers, replay_size)
+        broker.start()
+        return await scenario(broker)
+
+    return asyncio.run(main_task())
+
+
+def test_publish_reaches_only_subscribers_of_the_topic():
+    async def scenario(broker):
+        alice = broker.subscribe({"alice"})
+        bob = broker.subscribe({"bob"})
+        family = broker.subscribe({"alice", "bob"})
+
+        broker.publish("alice", "delivery", {"status": "sent"})
+        broker.publish("bob", "reminder", {"status": "fired"})
+        return drain(alice), drain(bob), drain(family)
+
+    alice, bob, family = run(scenario)
+
+    assert [(event, data["user_id"], data["status"]) for _, event, data in alice] == [("delivery", "alice", "sent")]
+    assert [(event, data["user_id"], data["status"]) for _, event, data in bob] == [("reminder", "bob", "fired")]
+    assert [event_id for event_id, _, _ in family] == [1, 2]
+
+
+def test_publish_from_worker_thread_is_delivered_on_the_loop():
+    async def scenario(broker):
+        subscription = broker.subscribe({"alice"})
+        await asyncio.to_thread(broker.publish, "alice", "delivery", {"status": "queued"})
+        frame = await asyncio.wait_for(subscription.queue.get(), timeout=1)
+        return parse(frame)
+
+    assert run(scenario)[2]["status"] == "queued"
+
+
+def test_slow_subscriber_drops_its_oldest_events_only():
+    async def scenario(broker):
+        slow = broker.subscribe({"alice"})
+        fast = broker.subscribe({"alice"})
+        fast_seen = []
+        for i in range(5):
+            broker.publish("alice", "delivery", {"n": i})
+            fast_seen.extend(drain(fast))
+        return slow, drain(slow), fast_seen
+
+    slow, slow_seen, fast_seen = run(scenario, buffer_size=2)
+
+    assert [data["n"] for _, _, data in slow_seen] == [3, 4]
+    assert slow.dropped == 3
+    assert [data["n"] for _, _, data in fast_seen] == [0, 1, 2, 3, 4]
+
+
+def test_reconnect_replays_events_after_last_event_id():
+    async def scenario(broker):
+        for i in range(3):
+            broker.publish("alice", "delivery", {"n": i})
+            broker.publish("bob", "delivery", {"n": i})
+        return drain(broker.subscribe({"alice"}, last_event_id=2))
+
+    replayed = run(scenario)
+
+    assert [(event_id, data["n"]) for event_id, _, data in replayed] == [(3, 1), (5, 2)]
+
+
+def test_unsubscribe_stops_delivery_and_frees_capacity():
+    async def scenario(broker):
+        subscription = broker.subscribe({"alice"})
+        with pytest.raises(HTTPException) as error:
+            broker.check_capacity()
+        assert error.value.status_code == 503
+
+        broker.unsubscribe(subscription)
+        broker.publish("alice", "delivery", {"status": "sent"})
+        broker.check_capacity()
+        return drain(subscription), broker.stats()
+
+    frames, stats = run(scenario, max_subscribers=1)
+
+    assert frames == []
+    assert stats == {"subscribers": 0, "topics": 0, "published": 1}
@@ -0,0 +1,99 @@
+import threading
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel
+
+import main
+
+
+class RecordingTransport(main.EmailTransport):
+    name = "recording"
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to_email, subject, body, is_html=False):
+        with self._lock:
+            self.sent.append(to_email)
+            return {"status": "success", "message_id": f"m{len(self.sent)}"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    SQLModel.metadata.create_all(main.engine)
+    monkeypatch.setattr(main, "email_transport", RecordingTransport())
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def patient():
+    return f"patient-{uuid.uuid4().hex[:8]}"
+
+
+def notify(client, user_id, body):
+    response = client.post(
+        "/api/send-email",
+        json={"user_id": user_id, "subject": "s", "body": body, "content_type": "text"}
+    )
+    assert response.status_code == 200
+    return sorted(result["to"] for result in response.json()["data"]["results"])
+
+
+def test_bound_member_receives_family_notifications(client, patient):
+    client.post("/api/family/members", json={"user_id": patient, "name": "Alice", "email": "alice@example.com"})
+    assert notify(client, patient, "first") == ["alice@example.com"]
+
+    code = client.post("/api/invite/generate", json={"user_id": patient}).json()["code"]
+    response = client.post("/api/invite/bind", json={
+        "code": code, "name": "Bob", "email": "bob@example.com",
+        "preferred_method": "both", "line_user_id": "U-bob"
+    })
+    assert response.json()["user_id"] == patient
+
+    assert notify(client, patient, "second") == ["alice@example.com", "bob@example.com"]
+    assert sorted(main.email_transport.sent) == ["alice@example.com", "alice@example.com", "bob@example.com"]
+
+
+def test_rebinding_with_line_only_removes_email_recipient(client, patient):
+    code = client.post("/api/invite/generate", json={"user_id": patient}).json()["code"]
+    bind = {"code": code, "name": "Carol", "line_user_id": "U-carol"}
+    client.post("/api/invite/bind", json={**bind, "email": "carol@example.com"})
+    client.post("/api/family/members", json={"user_id": patient, "name": "Dave", "email": "dave@example.com"})
+    assert notify(client, patient, "first") == ["carol@example.com", "dave@example.com"]
+
+    # 同一LINE用户再次绑定会更新原有成员，而不是新增一位
+    client.post("/api/invite/bind", json={**bind, "preferred_method": "line"})
+
+    assert notify(client, patient, "second") == ["dave@example.com"]
+
+
+def test_member_changes_invalidate_cached_recipients(client, patient):
+    client.post("/api/family/members", json={"user_id": patient, "name": "Erin", "email": "erin@example.com"})
+    main.family_recipients.load(patient, main.load_family_recipients)
+    assert main.family_recipients.lookup(patient) is not None
+
+    client.post("/api/family/members", json={"user_id": patient, "name": "Frank", "email": "frank@example.com"})
+    assert main.family_recipients.lookup(patient) is None
+
+    main.family_recipients.load(patient, main.load_family_recipients)
+    code = client.post("/api/invite/generate", json={"user_id": patient}).json()["code"]
+    client.post("/api/invite/bind", json={"code": code, "name": "Grace", "email": "grace@example.com"})
+    assert main.family_recipients.lookup(patient) is None
+
+    recipients = main.family_recipients.load(patient, main.load_family_recipients)
+    assert [r["email"] for r in recipients] == ["erin@example.com", "frank@example.com", "grace@example.com"]
+
+
+def test_invalidate_during_load_discards_stale_result():
+    cache = main.FamilyRecipientCache(ttl=60, max_entries=10)
+
+    def loader(user_id):
+        # 加载过程中成员发生变化
+        cache.invalidate(user_id)
+        return [{"member_id": 1, "name": "Old", "email": "old@example.com"}]
+
+    assert len(cache.load("patient", loader)) == 1
+    assert cache.lookup("patient") is None
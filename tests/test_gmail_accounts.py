@@ -0,0 +1,53 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def write_token(path, token):
+    # 原子替换，与OAuth回调写入token文件的方式相同
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(token) if token else "{}")
+    tmp.replace(path)
+
+
+def test_rewritten_token_file_clears_auth_suspension(tmp_path):
+    credentials_file = tmp_path / "credentials.json"
+    credentials_file.write_text("{}")
+    token_file = tmp_path / "token.json"
+    write_token(token_file, None)
+    client = main.GmailClientHolder(main.SCOPES, "main", str(credentials_file), str(token_file))
+    account = main.GmailAccount(client, 100)
+    pool = main.GmailAccountPool([account], "least_loaded")
+
+    with pytest.raises(HTTPException) as exc:
+        client.get_service()
+    assert exc.value.status_code == 401
+    pool.suspend(account, "auth_error", 3600, exc.value.detail)
+
+    # 文件没有变化时不重复加载
+    client.refresh_ahead()
+    assert pool.stats()["main"]["status"] == "auth_error"
+
+    # 另一个worker完成OAuth回调，写入新的token
+    write_token(token_file, {
+        "token": "access", "refresh_token": "refresh",
+        "client_id": "id", "client_secret": "secret"
+    })
+    client.refresh_ahead()
+
+    assert pool.stats()["main"]["status"] == "ok"
+    assert pool.acquire() is account
+
+
+def test_reload_does_not_clear_rate_limit_suspension(tmp_path):
+    client = main.GmailClientHolder(main.SCOPES, "main", str(tmp_path / "c.json"), str(tmp_path / "t.json"))
+    account = main.GmailAccount(client, 100)
+    pool = main.GmailAccountPool([account], "least_loaded")
+    pool.suspend(account, "rate_limited", 3600)
+
+    client.on_reload()
+
+    assert pool.stats()["main"]["status"] == "rate_limited"
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+from fastapi import HTTPException, Response
+from fastapi.testclient import TestClient
+
+import main
+
+
+class CountingTransport(main.EmailTransport):
+    name = "counting"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to_email, subject, body, is_html=False):
+        time.sleep(self.delay)
+        with self._lock:
+            self.sent.append(to_email)
+            return {"status": "success", "message_id": f"m{len(self.sent)}"}
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    transport = CountingTransport(delay=0.05)
+    monkeypatch.setattr(main, "email_transport", transport)
+    return transport
+
+
+def payload(to="a@example.com", body="hello"):
+    return {"to": to, "subject": "s", "body": body, "content_type": "text"}
+
+
+def test_same_key_replays_first_result_with_header(transport):
+    client = TestClient(main.app)
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+
+    first = client.post("/api/send-email", json=payload(), headers=headers)
+    second = client.post("/api/send-email", json=payload(), headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.json()["data"]["message_id"] == first.json()["data"]["message_id"]
+    assert transport.sent == ["a@example.com"]
+
+
+def test_same_key_with_different_payload_is_rejected(transport):
+    client = TestClient(main.app)
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+
+    assert client.post("/api/send-email", json=payload(), headers=headers).status_code == 200
+    response = client.post("/api/send-email", json=payload(to="b@example.com"), headers=headers)
+
+    assert response.status_code == 422
+    assert transport.sent == ["a@example.com"]
+
+
+def test_concurrent_duplicates_collapse_into_one_send(transport):
+    key = uuid.uuid4().hex
+
+    async def scenario():
+        responses = [Response() for _ in range(5)]
+        await asyncio.gather(*(
+            main.send_email(main.EmailRequest.model_validate(payload()), response, idempotency_key=key)
+            for response in responses
+        ))
+        return responses
+
+    responses = asyncio.run(scenario())
+    assert transport.sent == ["a@example.com"]
+    assert sum(1 for r in responses if r.headers.get("Idempotent-Replayed") == "true") == 4
+
+
+def test_cache_rejects_mismatched_fingerprint():
+    cache = main.IdempotencyCache(60, 10)
+
+    async def send():
+        return "sent"
+
+    async def scenario():
+        assert await cache.run("k", send, "a") == ("sent", False)
+        assert await cache.run("k", send, "a") == ("sent", True)
+        with pytest.raises(HTTPException) as exc:
+            await cache.run("k", send, "b")
+        assert exc.value.status_code == 422
+
+    asyncio.run(scenario())
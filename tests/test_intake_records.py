@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlmodel import Session, SQLModel, select
+
+import main
+
+
+def rollup(user_id, period="day"):
+    with Session(main.engine) as session:
+        row = session.exec(
+            select(main.AdherenceRollup).where(
+                main.AdherenceRollup.user_id == user_id,
+                main.AdherenceRollup.medication_id == 0,
+                main.AdherenceRollup.period == period
+            )
+        ).one()
+        return {"total": row.total, "taken": row.taken, "missed": row.missed}
+
+
+def add(user_id, status):
+    return main.add_intake_record({
+        "user_id": user_id,
+        "medication_id": 1,
+        "date": "2026-10-18",
+        "scheduled_time": "08:00",
+        "status": status
+    })
+
+
+def test_concurrent_records_for_same_dose_count_once():
+    SQLModel.metadata.create_all(main.engine)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: add("concurrent", "taken"), range(4)))
+
+    assert rollup("concurrent") == {"total": 1, "taken": 1, "missed": 0}
+    assert rollup("concurrent", "month") == {"total": 1, "taken": 1, "missed": 0}
+
+
+def test_status_change_moves_count():
+    SQLModel.metadata.create_all(main.engine)
+    add("change", "missed")
+    add("change", "taken")
+    add("change", "taken")
+
+    assert rollup("change") == {"total": 1, "taken": 1, "missed": 0}
@@ -0,0 +1,71 @@
+import json
+
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel, select
+
+import main
+
+
+def import_body(body, content_type, **params):
+    SQLModel.metadata.create_all(main.engine)
+    client = TestClient(main.app)
+    response = client.post(
+        "/api/medications/import", content=body.encode("utf-8"),
+        headers={"Content-Type": content_type}, params=params
+    )
+    assert response.status_code == 200
+    return response.json()["data"]
+
+
+def imported_names(user_id):
+    with Session(main.engine) as session:
+        rows = session.exec(select(main.Medication).where(main.Medication.user_id == user_id)).all()
+        return sorted(row.name for row in rows)
+
+
+def test_ndjson_import_reports_failed_lines():
+    lines = [
+        json.dumps({"name": "Aspirin", "time": "08:00"}),
+        "not json",
+        "",
+        json.dumps({"name": "Bisoprolol", "time": "25:00"}),
+        json.dumps(["Cetirizine"]),
+        json.dumps({"name": "Donepezil", "times": "08:00;20:00"}),
+    ]
+
+    data = import_body("\n".join(lines), "application/x-ndjson", user_id="ndjson-import")
+
+    assert data["total"] == 5
+    assert data["imported"] == 2
+    assert data["failed"] == 3
+    # 空行也计入行号
+    assert [error["line"] for error in data["errors"]] == [2, 4, 5]
+    assert imported_names("ndjson-import") == ["Aspirin", "Donepezil", "Donepezil"]
+
+
+def test_csv_import_reports_record_start_lines():
+    body = (
+        "name,dosage,time\n"
+        "Aspirin,100mg,08:00\n"
+        ",5mg,09:00\n"
+        '"Bisoprolol","2.5mg\n'
+        'with food",07:30\n'
+        "Cetirizine,10mg,bedtime\n"
+    )
+
+    data = import_body(body, "text/csv", user_id="csv-import")
+
+    assert data["total"] == 4
+    assert data["imported"] == 2
+    # 跨行的记录按起始行号报告，之后的行号不受影响
+    assert [error["line"] for error in data["errors"]] == [3, 6]
+    assert imported_names("csv-import") == ["Aspirin", "Bisoprolol"]
+
+
+def test_format_query_parameter_overrides_content_type():
+    body = "name,time\nAspirin,08:00\n"
+
+    data = import_body(body, "application/octet-stream", format="csv", user_id="format-import")
+
+    assert data["imported"] == 1
+    assert imported_names("format-import") == ["Aspirin"]
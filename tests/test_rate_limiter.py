@@ -0,0 +1,24 @@
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def test_each_sender_account_has_its_own_bucket():
+    limiter = main.GmailRateLimiter(1, 2, 0, 0, max_delay=0)
+    for _ in range(2):
+        assert limiter.reserve("a@example.com", "main") == 0
+    with pytest.raises(HTTPException) as exc:
+        limiter.reserve("a@example.com", "main")
+    assert exc.value.status_code == 429
+    # 另一个账号的配额不受影响
+    assert limiter.reserve("a@example.com", "backup") == 0
+
+
+def test_recipient_bucket_is_shared_across_senders():
+    limiter = main.GmailRateLimiter(10, 10, 1, 1, max_delay=0)
+    assert limiter.reserve("a@example.com", "main") == 0
+    with pytest.raises(HTTPException):
+        limiter.reserve("a@example.com", "backup")
+    # 换账号重试时不再占用收件人的令牌
+    assert limiter.reserve(None, "backup") == 0
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import Session, SQLModel
+
+import main
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(datetime(2026, 10, 18, 7, 59, tzinfo=main.REMINDER_TIMEZONE))
+
+
+@pytest.fixture
+def scheduler(clock):
+    return main.ReminderScheduler(clock=clock)
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    queue = main.EmailQueue(str(tmp_path / "queue.db"))
+    monkeypatch.setattr(main, "email_queue", queue)
+    return queue
+
+
+def add_medication(time_value, reminder_email="a@example.com"):
+    SQLModel.metadata.create_all(main.engine)
+    with Session(main.engine) as session:
+        medication = main.Medication(user_id="scheduler", name="薬", time=time_value, reminder_email=reminder_email)
+        session.add(medication)
+        session.commit()
+        return medication.id
+
+
+def test_reminder_fires_at_due_time_and_moves_to_next_day(scheduler, clock, queue):
+    medication_id = add_medication("08:00")
+    scheduler.schedule(medication_id, "08:00")
+    assert scheduler._pop_due(clock().timestamp()) == []
+    assert scheduler._seconds_until_next() == 60
+
+    clock.now += timedelta(minutes=1)
+    due_ids = scheduler._pop_due(clock().timestamp())
+    assert due_ids == [medication_id]
+    assert scheduler.fire(due_ids) == 1
+
+    assert queue.depth() == {"pending": 1}
+    assert scheduler._due[medication_id] == (clock.now + timedelta(days=1)).timestamp()
+
+
+def test_rescheduling_discards_the_old_entry(scheduler, clock):
+    scheduler.schedule(1, "08:00")
+    scheduler.schedule(1, "09:00")
+    scheduler.schedule(2, "08:00")
+    scheduler.schedule(2, "08:00")
+
+    clock.now = clock.now.replace(hour=8, minute=0)
+    assert scheduler._pop_due(clock().timestamp()) == [2]
+    clock.now = clock.now.replace(hour=9, minute=0)
+    assert scheduler._pop_due(clock().timestamp()) == [1]
+    assert scheduler._seconds_until_next() is None
+
+
+def test_removed_reminder_is_not_rescheduled(scheduler, clock, queue):
+    medication_id = add_medication("08:00", reminder_email=None)
+    scheduler.schedule(medication_id, "08:00")
+
+    clock.now += timedelta(minutes=1)
+    scheduler.fire(scheduler._pop_due(clock().timestamp()))
+
+    assert queue.depth() == {}
+    assert medication_id not in scheduler._due
@@ -0,0 +1,66 @@
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+import main
+from fake_smtp import FakeSmtpServer
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSmtpServer(keep_messages=True).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def transport(smtp_server):
+    host, port = smtp_server.address
+    pool = main.SmtpConnectionPool(host, port, None, None, "none", 5, 2, 60)
+    transport = main.SmtpTransport(pool, "pillpal@example.com")
+    yield transport
+    transport.close()
+
+
+def test_pipelined_send_delivers_to_single_recipient(smtp_server, transport):
+    result = transport.send("a@example.com", "s", "body")
+
+    assert result["status"] == "success"
+    assert [(m["from"], m["to"]) for m in smtp_server.messages] == [("pillpal@example.com", ["a@example.com"])]
+
+
+def test_recipient_with_line_break_is_rejected_before_sending(smtp_server, transport):
+    with pytest.raises(HTTPException):
+        transport.send("victim@example.com>\r\nRCPT TO:<evil@example.com", "s", "body")
+
+    assert smtp_server.messages == []
+    # 连接仍可用于后续发送
+    transport.send("a@example.com", "s", "body")
+    assert [m["to"] for m in smtp_server.messages] == [["a@example.com"]]
+
+
+def test_request_models_reject_invalid_recipients():
+    with pytest.raises(ValidationError):
+        main.EmailRequest(to="victim@example.com>\r\nRCPT TO:<evil@example.com")
+    with pytest.raises(ValidationError):
+        main.ReminderRequest(to="a@example.com, b@example.com")
+    assert main.EmailRequest(to=" a@example.com ").to == "a@example.com"
+
+
+def test_refused_recipients_do_not_open_circuit_breaker(smtp_server, transport):
+    breaker = main.CircuitBreaker(30, 5, 0.5, 30, 1)
+    guarded = main.CircuitBreakerTransport(transport, breaker)
+    for i in range(10):
+        with pytest.raises(HTTPException) as exc:
+            guarded.send(f"bad{i}@example.com\r\n", "s", "body")
+        assert exc.value.status_code == 400
+    assert breaker.state == "closed"
+
+
+def test_transport_failed_counts_only_server_and_connection_errors():
+    assert main.transport_failed(HTTPException(status_code=500))
+    assert main.transport_failed(TimeoutError())
+    assert main.transport_failed(ConnectionResetError())
+    assert not main.transport_failed(HTTPException(status_code=400))
+    assert not main.transport_failed(HTTPException(status_code=503))
+    assert not main.transport_failed(ValueError("bad input"))
@@ -0,0 +1,11 @@
+import asyncio
+
+import main
+
+
+def test_startup_report_breaks_down_module_import():
+    report = asyncio.run(main.startup_report())
+
+    imports = report["imports"]
+    assert {"pydantic", "fastapi", "sqlalchemy", "sqlmodel", "module_body"} <= set(imports)
+    assert abs(sum(imports.values()) - report["startup"]["module_import"]) < 1